@@ -3,6 +3,7 @@
 ##
 import os
 import time
+import heapq
 import string
 import subprocess
 
@@ -32,6 +33,22 @@ def chunk_list(seq, num):
     return out
 
 
+def chunk_list_by_cost(seq, costs, num):
+    """
+    Split seq into at most num chunks of roughly equal total cost,
+    where costs[i] is the cost of seq[i]. Items are assigned
+    largest first, each to the chunk with the least cost so far.
+    """
+    chunks = [[] for chunk_num in range(num)]
+    chunk_costs = [(0, chunk_num) for chunk_num in range(num)]
+    order = sorted(range(len(seq)), key=lambda i: costs[i], reverse=True)
+    for i in order:
+        chunk_cost, chunk_num = heapq.heappop(chunk_costs)
+        chunks[chunk_num].append(seq[i])
+        heapq.heappush(chunk_costs, (chunk_cost + costs[i], chunk_num))
+    return [chunk for chunk in chunks if len(chunk) > 0]
+
+
 def make_bash_script(filename, cmd, crate_dir=None):
     """
     Make an executable bash script out of the given command.
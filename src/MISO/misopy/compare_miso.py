@@ -50,7 +50,10 @@ def main():
                       "given samples. Expects three directories: the first is " \
                       "sample1's MISO output, the second is sample2's MISO " \
                       "output, and the third is the directory where " \
-                      "results of the sample comparison will be outputted.")
+                      "results of the sample comparison will be outputted. " \
+                      "The second can be a comma-separated list of samples " \
+                      "to compare sample1 against each of them, loading " \
+                      "sample1's samples once.")
     parser.add_option("--comparison-labels", dest="comparison_labels",
                       nargs=2, default=None,
                       help="Use these labels for the sample comparison "
@@ -58,15 +61,40 @@ def main():
                       "Takes two arguments: the label for sample 1 "
                       "and the label for sample 2, where sample 1 and "
                       "sample 2 correspond to the order of samples given "
-                      "to --compare-samples.")
+                      "to --compare-samples. When sample1 is compared "
+                      "against several samples, the label for sample 2 "
+                      "is a comma-separated list of their labels.")
+    parser.add_option("--compare-all-samples", dest="all_samples_to_compare",
+                      nargs=2, default=None,
+                      help="Compute comparison statistics between every " \
+                      "pair of the given samples. Expects two arguments: " \
+                      "a comma-separated list of MISO output directories, " \
+                      "and the directory where results of the comparisons " \
+                      "will be outputted. Each pair is compared as with " \
+                      "--compare-samples, in the order the samples are given.")
+    parser.add_option("--all-samples-labels", dest="all_samples_labels",
+                      nargs=1, default=None,
+                      help="Use these labels for the samples compared by "
+                      "--compare-all-samples. Takes a comma-separated list "
+                      "of labels, one for each sample.")
+    parser.add_option("--combined-table", dest="combined_table",
+                      action="store_true", default=False,
+                      help="With --compare-all-samples, also output the "
+                      "comparisons of all pairs to a single table, "
+                      "all_pairs.miso_bf, in the results directory.")
     parser.add_option("--use-compressed", dest="use_compressed",
                       nargs=1, default=None,
                       help="Use compressed event IDs. Takes as input a "
-                      "genes_to_filenames.shelve file produced by the "
-                      "index_gff script.")
+                      "compressed_ids_to_genes.txt (or .shelve) file "
+                      "produced by the index_gff script.")
+    parser.add_option("-p", "--num-proc", dest="num_proc",
+                      type="int", default=1,
+                      help="Number of processes to compare events on. "
+                      "Default is 1.")
     (options, args) = parser.parse_args()
 
-    if options.samples_to_compare is None:
+    if (options.samples_to_compare is None) and \
+       (options.all_samples_to_compare is None):
         greeting()
 
     use_compressed = None
@@ -82,16 +110,52 @@ def main():
 
     if options.samples_to_compare is not None:
         sample1_dirname = os.path.abspath(options.samples_to_compare[0])
-        sample2_dirname = os.path.abspath(options.samples_to_compare[1])
+        other_dirnames = [os.path.abspath(dirname) for dirname in \
+                          options.samples_to_compare[1].split(",")]
         output_dirname = os.path.abspath(options.samples_to_compare[2])
         if not os.path.isdir(output_dirname):
             print "Making comparisons directory: %s" %(output_dirname)
             misc_utils.make_dir(output_dirname)
-        ht.output_samples_comparison(sample1_dirname,
-                                     sample2_dirname,
-                                     output_dirname,
-                                     sample_labels=options.comparison_labels,
-                                     use_compressed=use_compressed)
+        sample_labels = None
+        if options.comparison_labels is not None:
+            other_labels = options.comparison_labels[1].split(",")
+            if len(other_labels) != len(other_dirnames):
+                print "Error: Need one comparison label for each sample " \
+                      "compared against sample1."
+                sys.exit(1)
+            sample_labels = [options.comparison_labels[0], other_labels]
+        ht.output_samples_comparisons(sample1_dirname,
+                                      other_dirnames,
+                                      output_dirname,
+                                      sample_labels=sample_labels,
+                                      use_compressed=use_compressed,
+                                      num_proc=options.num_proc)
+
+    if options.all_samples_to_compare is not None:
+        sample_dirnames = [os.path.abspath(dirname) for dirname in \
+                           options.all_samples_to_compare[0].split(",")]
+        output_dirname = os.path.abspath(options.all_samples_to_compare[1])
+        if len(sample_dirnames) < 2:
+            print "Error: Need at least two samples to compare."
+            sys.exit(1)
+        sample_labels = None
+        if options.all_samples_labels is not None:
+            sample_labels = options.all_samples_labels.split(",")
+            if len(sample_labels) != len(sample_dirnames):
+                print "Error: Need one label for each sample to compare."
+                sys.exit(1)
+        if not os.path.isdir(output_dirname):
+            print "Making comparisons directory: %s" %(output_dirname)
+            misc_utils.make_dir(output_dirname)
+        combined_filename = None
+        if options.combined_table:
+            combined_filename = os.path.join(output_dirname, "all_pairs.miso_bf")
+        ht.output_all_pairs_comparisons(sample_dirnames,
+                                        output_dirname,
+                                        sample_labels=sample_labels,
+                                        use_compressed=use_compressed,
+                                        num_proc=options.num_proc,
+                                        combined_filename=combined_filename)
 
 
 if __name__ == '__main__':
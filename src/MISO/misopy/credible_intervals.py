@@ -7,51 +7,91 @@ def format_credible_intervals(event_name, samples,
     Returns a list of print-able credible intervals for an NxM samples
     matrix. Handles both the two isoform and multi-isoform cases.
     """
-    num_samples, num_isoforms = shape(samples)
-    if num_isoforms > 2:
-        cred_interval = compute_multi_iso_credible_intervals(samples,
-                                                             confidence_level=confidence_level)
-        cred_interval_lowbounds = ",".join([str("%.2f" %(ci[0])) for ci in cred_interval])
-        cred_interval_highbounds = ",".join([str("%.2f" %(ci[1])) for ci in cred_interval])
-        posterior_mean = ",".join("%.2f" %(val) for val in mean(samples, 0))
+    posterior_mean, ci_low, ci_high = \
+        compute_batch_credible_intervals(samples,
+                                         confidence_level=confidence_level)
+    return format_intervals(event_name, posterior_mean, ci_low, ci_high)
+
+
+def format_intervals(event_name, posterior_mean, ci_low, ci_high):
+    """
+    Returns a list of print-able posterior means and credible intervals,
+    given for each isoform. For two isoforms, only the first isoform's
+    are output.
+    """
+    if len(posterior_mean) > 2:
+        cred_interval_lowbounds = ",".join(["%.2f" %(val) for val in ci_low])
+        cred_interval_highbounds = ",".join(["%.2f" %(val) for val in ci_high])
+        posterior_mean = ",".join(["%.2f" %(val) for val in posterior_mean])
         output_fields = [event_name,
                          "%s" %(posterior_mean),
                          "%s" %(cred_interval_lowbounds),
                          "%s" %(cred_interval_highbounds)]
     else:
-        cred_interval = compute_credible_intervals(samples)
-        posterior_mean = mean(samples, 0)[0]
         output_fields = [event_name,
-                         "%.2f" %(posterior_mean),
-                         "%.2f" %(cred_interval[0]),
-                         "%.2f" %(cred_interval[1])]
+                         "%.2f" %(posterior_mean[0]),
+                         "%.2f" %(ci_low[0]),
+                         "%.2f" %(ci_high[0])]
     return output_fields
 
 
-def compute_credible_intervals(samples, confidence_level=.95):
+def get_credible_interval_indices(num_samples, confidence_level=.95):
     """
-    Compute Bayesian confidence intevals (credible intervals) for the set of samples given
-    based on the method of Chen and Shao (1998).
-
-    Assumes that samples is an Nx2 vector of posterior samples.
+    Return the indices of the lower and upper bounds of the credible
+    interval among num_samples sorted samples.
     """
-    if samples.ndim == 2:
-        samples = samples[:, 0]
-    num_samples = len(samples)
     # confidence percentage is 100(1-alpha)%
     alpha = 1 - confidence_level
     # compute the lower bound of the interval
     # the lower bound is the (alpha/2)*n-th smallest sample, where n is the
     # number of samples
-    lower_bound_indx = round((alpha/2)*num_samples) - 1
+    lower_bound_indx = int(round((alpha/2)*num_samples)) - 1
     # the upper bound is the (1-alpha/2)*n nth smallest sample, where n is
     # the number of samples
-    upper_bound_indx = round((1-alpha/2)*num_samples) - 1
+    upper_bound_indx = int(round((1-alpha/2)*num_samples)) - 1
     assert(lower_bound_indx > 0)
     assert(upper_bound_indx > 0)
-    # sort samples along first axis
-    samples.sort()
-    cred_interval = [samples[lower_bound_indx], samples[upper_bound_indx]]
+    return lower_bound_indx, upper_bound_indx
+
+
+def compute_batch_credible_intervals(samples, confidence_level=.95):
+    """
+    Compute posterior means and credible intervals (as in
+    compute_credible_intervals) of every isoform at once.
+
+    Takes an array of samples whose last two axes are samples and
+    isoforms, e.g. an events x samples x isoforms array, and returns
+    the posterior means, lower bounds and upper bounds, each an array
+    of the remaining axes (e.g. events x isoforms.) The samples are
+    not modified.
+    """
+    samples = asarray(samples)
+    num_samples = samples.shape[-2]
+    lower_bound_indx, upper_bound_indx = \
+        get_credible_interval_indices(num_samples,
+                                      confidence_level=confidence_level)
+    # Only the bounds need to be in their sorted positions
+    partitioned = partition(samples, [lower_bound_indx, upper_bound_indx],
+                            axis=-2)
+    return samples.mean(axis=-2), \
+           partitioned[..., lower_bound_indx, :], \
+           partitioned[..., upper_bound_indx, :]
+
+
+def compute_credible_intervals(samples, confidence_level=.95):
+    """
+    Compute Bayesian confidence intevals (credible intervals) for the set of samples given
+    based on the method of Chen and Shao (1998).
+
+    Assumes that samples is an Nx2 vector of posterior samples.
+    """
+    samples = asarray(samples)
+    if samples.ndim == 2:
+        samples = samples[:, 0]
+    posterior_mean, ci_low, ci_high = \
+        compute_batch_credible_intervals(samples[:, newaxis],
+                                         confidence_level=confidence_level)
+    cred_interval = [ci_low[0], ci_high[0]]
     return cred_interval
 
 
@@ -60,12 +100,8 @@ def compute_multi_iso_credible_intervals(multi_iso_samples,
     """
     Compute multiple isoforms credible intervals for a set of NxM matrix.
     """
-    credible_intervals = []
-    num_samples, num_isoforms = shape(multi_iso_samples)
-
-    for iso_num in range(num_isoforms):
-        ci = compute_credible_intervals(multi_iso_samples[:, iso_num],
-                                        confidence_level=confidence_level)
-        credible_intervals.append(ci)
-
+    posterior_mean, ci_low, ci_high = \
+        compute_batch_credible_intervals(multi_iso_samples,
+                                         confidence_level=confidence_level)
+    credible_intervals = [[low, high] for low, high in zip(ci_low, ci_high)]
     return credible_intervals
@@ -0,0 +1,223 @@
+##
+## Single-file SQLite representation of an indexed GFF
+##
+## Stores each serialized gene as one row, keyed by gene ID, instead
+## of writing one *.pickle file per gene. Genes can be retrieved
+## by ID, by compressed ID or by genomic region.
+##
+import os
+import sqlite3
+import cPickle as pickle
+
+# File extension for indexed GFF SQLite databases
+GFF_DB_EXT = ".gff_db"
+# Name of the database file within an indexed GFF directory
+GFF_DB_BASENAME = "genes%s" %(GFF_DB_EXT)
+# Largest number of genes to fetch in one query (SQLite allows
+# at most 999 parameters in a query)
+MAX_QUERY_GENES = 500
+
+
+class GFFIndexDatabase:
+    """
+    Representation of an indexed GFF SQLite database.
+    """
+    def __init__(self, db_fname, create=False):
+        if (not create) and (not os.path.isfile(db_fname)):
+            raise Exception, "%s does not exist." %(db_fname)
+        self.db_fname = db_fname
+        self.conn = sqlite3.connect(self.db_fname)
+        self.conn.text_factory = str
+        if create:
+            self.create_tables()
+
+
+    def create_tables(self):
+        """
+        Create the genes table and its lookup indices.
+        """
+        c = self.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS genes "
+                  "(gene_id text PRIMARY KEY, compressed_id text, "
+                  "chrom text, start integer, end integer, strand text, "
+                  "gene_data blob)")
+        c.execute("CREATE INDEX IF NOT EXISTS genes_region "
+                  "ON genes (chrom, start, end)")
+        c.execute("CREATE INDEX IF NOT EXISTS genes_compressed_id "
+                  "ON genes (compressed_id)")
+        self.conn.commit()
+
+
+    def add_genes(self, genes):
+        """
+        Add genes to the database. Takes a dictionary mapping gene
+        IDs to their gene information ('gene_object', 'hierarchy'
+        and optionally 'compressed_id'), as made by index_gff.
+        """
+        rows = []
+        for gene_id, gene_info in genes.iteritems():
+            gene_obj = gene_info['gene_object']
+            tx_start, tx_end = get_gene_bounds(gene_id, gene_info)
+            gene_data = pickle.dumps(gene_info, -1)
+            rows.append((gene_id,
+                         gene_info.get('compressed_id'),
+                         gene_obj.chrom,
+                         tx_start,
+                         tx_end,
+                         gene_obj.strand,
+                         sqlite3.Binary(gene_data)))
+        c = self.conn.cursor()
+        c.executemany("INSERT OR REPLACE INTO genes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      rows)
+        self.conn.commit()
+
+
+    def merge_db(self, other_db_fname):
+        """
+        Copy all the genes of another indexed GFF database into
+        this one.
+        """
+        c = self.conn.cursor()
+        c.execute("ATTACH DATABASE ? AS other_db", (other_db_fname,))
+        c.execute("INSERT OR REPLACE INTO genes SELECT * FROM other_db.genes")
+        self.conn.commit()
+        c.execute("DETACH DATABASE other_db")
+
+
+    def rows_to_genes(self, rows):
+        """
+        Deserialize (gene_id, gene_data) rows into a dictionary
+        of gene IDs to gene information.
+        """
+        genes = {}
+        for gene_id, gene_data in rows:
+            genes[gene_id] = pickle.loads(str(gene_data))
+        return genes
+
+
+    def get_gene(self, gene_id):
+        """
+        Return a dictionary with the given gene, or None if the
+        gene is not in the database.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT gene_id, gene_data FROM genes WHERE gene_id=?",
+                  (gene_id,))
+        genes = self.rows_to_genes(c.fetchall())
+        if len(genes) == 0:
+            return None
+        return genes
+
+
+    def get_genes(self, gene_ids):
+        """
+        Return a dictionary with the given genes. Genes not in
+        the database are omitted.
+        """
+        gene_ids = list(gene_ids)
+        genes = {}
+        c = self.conn.cursor()
+        for n in range(0, len(gene_ids), MAX_QUERY_GENES):
+            query_ids = gene_ids[n:n + MAX_QUERY_GENES]
+            c.execute("SELECT gene_id, gene_data FROM genes "
+                      "WHERE gene_id IN (%s)" %(",".join(["?"] * len(query_ids))),
+                      query_ids)
+            genes.update(self.rows_to_genes(c.fetchall()))
+        return genes
+
+
+    def get_gene_by_compressed_id(self, compressed_id):
+        """
+        Return a dictionary with the gene that has the given
+        compressed ID, or None if there is no such gene.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT gene_id, gene_data FROM genes WHERE compressed_id=?",
+                  (compressed_id,))
+        genes = self.rows_to_genes(c.fetchall())
+        if len(genes) == 0:
+            return None
+        return genes
+
+
+    def get_genes_in_region(self, chrom, start, end):
+        """
+        Return a dictionary of all genes whose transcribed region
+        overlaps chrom:start-end (inclusive coordinates).
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT gene_id, gene_data FROM genes "
+                  "WHERE chrom=? AND start<=? AND end>=?",
+                  (chrom, end, start))
+        return self.rows_to_genes(c.fetchall())
+
+
+    def get_all_genes(self):
+        """
+        Return a dictionary of all the genes in the database.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT gene_id, gene_data FROM genes")
+        return self.rows_to_genes(c.fetchall())
+
+
+    def get_all_gene_ids(self):
+        """
+        Return all gene IDs in the database.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT gene_id FROM genes")
+        return [row[0] for row in c.fetchall()]
+
+
+    def get_compressed_id_pairs(self):
+        """
+        Return all (compressed ID, gene ID) pairs.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT compressed_id, gene_id FROM genes "
+                  "WHERE compressed_id IS NOT NULL")
+        return c.fetchall()
+
+
+    def get_compressed_ids_to_genes(self):
+        """
+        Return mapping from compressed IDs to gene IDs.
+        """
+        return dict(self.get_compressed_id_pairs())
+
+
+    def close(self):
+        self.conn.close()
+
+
+def get_gene_bounds(gene_id, gene_info):
+    """
+    Return the most inclusive start and end coordinates of the
+    gene's mRNAs.
+    """
+    mRNAs = gene_info['hierarchy'][gene_id]['mRNAs']
+    tx_start = min([mRNA_info['record'].start \
+                    for mRNA_info in mRNAs.itervalues()])
+    tx_end = max([mRNA_info['record'].end \
+                  for mRNA_info in mRNAs.itervalues()])
+    return tx_start, tx_end
+
+
+def is_gff_db_fname(fname):
+    """
+    Return True if it's an indexed GFF database filename, like
+    genes.gff_db
+    """
+    return str(fname).endswith(GFF_DB_EXT)
+
+
+def get_gff_db_fname(indexed_gff_dir):
+    """
+    Return the indexed GFF database filename in the given directory
+    if it exists, otherwise None.
+    """
+    db_fname = os.path.join(indexed_gff_dir, GFF_DB_BASENAME)
+    if os.path.isfile(db_fname):
+        return db_fname
+    return None
@@ -33,6 +33,8 @@ import re
 import shelve
 import misopy
 import misopy.pickle_utils as pickle_utils
+import misopy.misc_utils as misc_utils
+import misopy.gff_db as gff_db
 from urllib import quote as url_quote, unquote as url_unquote
 
 from collections import defaultdict
@@ -52,14 +54,77 @@ from collections import defaultdict
 
 #     return gene_records
 
-def load_indexed_gff_file(indexed_gff_filename):
+# Recently unpickled indexed GFF files, keyed by filename and
+# modification time. A pickle cannot be read one gene at a time,
+# so keep the loaded mapping around for lookups of further genes
+# in the same file. Kept small since a file may index a whole
+# chromosome.
+indexed_pickles = misc_utils.LRUCache(max_size=4)
+
+def load_indexed_gff_file(indexed_gff_filename, gene_ids=None):
     """
     Load indexed representation of a set of genes.
+
+    The indexed file is either a pickle file or a single-file
+    indexed GFF database (*.gff_db). For a database, only the
+    genes in 'gene_ids' are loaded if given.
     """
+    if gff_db.is_gff_db_fname(indexed_gff_filename):
+        if not os.path.isfile(indexed_gff_filename):
+            return None
+        genes_db = gff_db.GFFIndexDatabase(indexed_gff_filename)
+        if gene_ids is None:
+            indexed_gff = genes_db.get_all_genes()
+        else:
+            indexed_gff = genes_db.get_genes(gene_ids)
+        genes_db.close()
+        return indexed_gff
     indexed_gff = pickle_utils.load_pickled_file(indexed_gff_filename)
     return indexed_gff
 
 
+def load_indexed_gene(indexed_gff_filename, gene_id):
+    """
+    Load the indexed representation of a single gene.
+    Return the gene's information ('gene_object', 'hierarchy')
+    or None if the gene is not in the indexed file.
+
+    For indexed GFF databases, only the requested gene's record
+    is deserialized. Pickled indexes are unpickled once and the
+    mapping is cached, so further genes in the same file are
+    looked up by key.
+    """
+    if gff_db.is_gff_db_fname(indexed_gff_filename):
+        if not os.path.isfile(indexed_gff_filename):
+            return None
+        genes_db = gff_db.GFFIndexDatabase(indexed_gff_filename)
+        indexed_gene = genes_db.get_gene(gene_id)
+        genes_db.close()
+    else:
+        indexed_gene = load_cached_pickle(indexed_gff_filename)
+    if indexed_gene is None:
+        return None
+    return indexed_gene.get(gene_id)
+
+
+def load_cached_pickle(indexed_gff_filename):
+    """
+    Return the unpickled mapping of an indexed GFF file, loading
+    it only if it is not already cached. Return None if the
+    file does not exist.
+    """
+    if not os.path.isfile(indexed_gff_filename):
+        return None
+    cache_key = (os.path.abspath(indexed_gff_filename),
+                 os.path.getmtime(indexed_gff_filename))
+    indexed_gff = indexed_pickles.get(cache_key)
+    if indexed_gff is None:
+        indexed_gff = pickle_utils.load_pickled_file(indexed_gff_filename)
+        if indexed_gff is not None:
+            indexed_pickles.put(cache_key, indexed_gff)
+    return indexed_gff
+
+
 def load_indexed_gff_chrom(indexed_gff_chrom_filename):
     """
     Load indexed representation of a GFF chromosome.
@@ -94,6 +159,17 @@ def get_gene_ids_to_gff_index(indexed_gff_dir):
           %(indexed_gff_dir)
     gff_chrom_dirs = os.listdir(indexed_gff_dir)
 
+    # If the GFF was indexed into a single database file, all
+    # genes map to that file
+    db_fname = gff_db.get_gff_db_fname(indexed_gff_dir)
+    if db_fname is not None:
+        print "  - Found indexed GFF database %s" %(db_fname)
+        genes_db = gff_db.GFFIndexDatabase(db_fname)
+        gene_ids_to_gff_index = \
+            dict.fromkeys(genes_db.get_all_gene_ids(), db_fname)
+        genes_db.close()
+        return gene_ids_to_gff_index
+
     # Load gene IDs to mapping from .shelve file
     # if it exists
     gene_ids_to_gff_index = load_shelved_genes_to_fnames(indexed_gff_dir)
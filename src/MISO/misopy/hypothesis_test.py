@@ -3,6 +3,9 @@
 ##
 from numpy import *
 import os
+import itertools
+import multiprocessing
+from collections import defaultdict
 import scipy
 from scipy import stats
 from scipy.stats import gaussian_kde
@@ -95,15 +98,14 @@ def compute_delta_densities(samples1_results,
                             smoothing_param=0.3):
     """
     Compute the Gaussian kernel density fitted distributions
-    over delta for the two sets of posterior samples filenames given.
-    Returns the posterior density and prior density as well, assuming
-    a uniform prior over the Psi of the samples
-    in the two conditions.
+    over delta for the two sets of posterior samples filenames given,
+    evaluated at delta = 0, and the resulting Bayes factors.
+    Returns the prior density as well, assuming a uniform prior
+    over the Psi of the samples in the two conditions.
     """
     densities = {}
     # Compute analytic prior density
     prior_density_fn = lambda x: 1 + x if x <= 0 else 1 - x
-    analytic_prior_density = map(prior_density_fn, diff_range)
     posterior_samples1 = samples1_results[0]
     posterior_samples2 = samples2_results[0]
 
@@ -129,60 +131,82 @@ def compute_delta_densities(samples1_results,
     densities['samples1'] = posterior_samples1
     densities['samples2'] = posterior_samples2
 
-    # Collection of posterior densities (only 1 in two-isoform case)
-    densities['posterior_density'] = []
+    posterior_diffs = get_posterior_diffs(posterior_samples1,
+                                          posterior_samples2,
+                                          event_name=event_name,
+                                          sample1_label=sample1_label,
+                                          sample2_label=sample2_label)
+
+    # For each isoform, compute its Bayes factor and the posterior
+    # density at delta = 0 (only 1 in two-isoform case.) Maintain
+    # them as lists to be consistent with multi-isoform case
+    bayes_factors, diff_posteriors = \
+        compute_bayes_factors(posterior_diffs,
+                              smoothing_param=smoothing_param)
+    densities['bayes_factor'] = list(bayes_factors)
+    densities['posterior_density_at_zero'] = list(diff_posteriors)
 
-    # Collection of Bayes factors (only 1 in two-isoform case)
-    densities['bayes_factor'] = []
-
-    # For each isoform, compute its Bayes factor and delta posterior
-    warning_outputted = False
-
-    for iso_num in range(num_isoforms):
-        ##
-        ## TODO: If distinct number of samples are used
-        ## in the two samples compared, take the minimum
-        ## number of samples
-        ##
-        posterior_diff = posterior_samples1[:, iso_num] - \
-                         posterior_samples2[:, iso_num]
-
-        # If the average difference is 0, don't try to fit a kernel to it
-        mean_abs_posterior_diff = mean(abs(posterior_diff))
-
-        # If the posterior differences are all identical, the sampler
-        # was probably unable to explore the space
-        all_same_diff = all(posterior_diff - posterior_diff[0] == 0)
-
-        if all_same_diff and not warning_outputted:
-            print "Warning: Event %s was not sampled properly in %s or %s" \
-                  %(event_name,
-                    sample1_label,
-                    sample2_label)
-            warning_outputted = True
+    return densities
 
-        if mean_abs_posterior_diff <= .009 or all_same_diff:
-            posterior_density = NullPeakedDensity(posterior_diff)
-        else:
-            # Smoothing by fitting Gaussian kernel density estimator
-            posterior_density = gaussian_kde_covfact(posterior_diff,
-                                                     smoothing_param)
-
-        bayes_factor, diff_prior, diff_posterior = \
-            compute_bayes_factor(analytic_prior_density,
-                                 posterior_density)
-        # Edge case: if improperly samples, maintain Bayes factors
-        # as list to be consistent with multi-isoform case
-        densities['bayes_factor'].append(bayes_factor)
-        densities['posterior_density'].append(posterior_density)
 
-    return densities
+def get_posterior_diffs(posterior_samples1, posterior_samples2,
+                        event_name="",
+                        sample1_label="",
+                        sample2_label=""):
+    """
+    Return the differences of the posterior samples of an event in
+    two samples, as an array of isoforms by samples.
+    """
+    # If the two samples have different numbers of samples, e.g.
+    # because their sampling stopped early, use the first samples
+    # of the larger one
+    num_diff_samples = min(len(posterior_samples1), len(posterior_samples2))
+    posterior_diffs = transpose(posterior_samples1[:num_diff_samples] - \
+                                posterior_samples2[:num_diff_samples])
+
+    # If the posterior differences are all identical, the sampler
+    # was probably unable to explore the space
+    all_same_diffs = all(posterior_diffs == posterior_diffs[:, 0:1], axis=1)
+    if any(all_same_diffs):
+        print "Warning: Event %s was not sampled properly in %s or %s" \
+              %(event_name,
+                sample1_label,
+                sample2_label)
+    return posterior_diffs
+
+
+# Fields of the Bayes factor (*.miso_bf) files
+COMPARISON_HEADER_FIELDS = ['event_name',
+                            'sample1_posterior_mean',
+                            'sample1_ci_low',
+                            'sample1_ci_high',
+                            'sample2_posterior_mean',
+                            'sample2_ci_low',
+                            'sample2_ci_high',
+                            'diff',
+                            'bayes_factor',
+                            'isoforms',
+                            'sample1_counts',
+                            'sample1_assigned_counts',
+                            'sample2_counts',
+                            'sample2_assigned_counts',
+                            'chrom',
+                            'strand',
+                            'mRNA_starts',
+                            'mRNA_ends']
+
+# Number of events compared in one task
+COMPARISON_TASK_SIZE = 500
+
+# Samples and parameters of the comparison worker processes
+comparison_params = {}
 
 
 def output_samples_comparison(sample1_dir, sample2_dir, output_dir,
                               alpha=.95,
                               sample_labels=None,
-                              use_compressed=None):
+                              use_compressed=None,
+                              num_proc=1):
     """
     Compute the bayes factors, posterior means, and other statistics
     between the two samples and output them to a directory.
@@ -190,26 +214,233 @@ def output_samples_comparison(sample1_dir, sample2_dir, output_dir,
     Expects two directories with samples from a MISO run, where corresponding
     events in the two samples' directories begin with the same event name.
     """
+    if sample_labels is not None:
+        sample_labels = [sample_labels[0], [sample_labels[1]]]
+    output_samples_comparisons(sample1_dir, [sample2_dir], output_dir,
+                               alpha=alpha,
+                               sample_labels=sample_labels,
+                               use_compressed=use_compressed,
+                               num_proc=num_proc)
+
+
+def output_samples_comparisons(sample1_dir, other_sample_dirs, output_dir,
+                               alpha=.95,
+                               sample_labels=None,
+                               use_compressed=None,
+                               num_proc=1):
+    """
+    Compare one sample against each of several others, outputting
+    a comparison directory for each pair as output_samples_comparison
+    does. Each event of sample 1 is loaded once for all comparisons.
+
+    sample_labels, if given, is the label of sample 1 and a list of
+    labels of the other samples.
+    """
     print "Given output dir: %s" %(output_dir)
     print "Retrieving MISO files in sample directories..."
-    sample1_obj = MISOSamples(sample1_dir,
-                              use_compressed=use_compressed)
-    sample2_obj = MISOSamples(sample2_dir,
-                              use_compressed=use_compressed)
-    print "Computing sample comparison between %s and %s..." %(sample1_dir,
-                                                               sample2_dir)
-    print "  - No. of events in %s: %d" %(sample1_dir, sample1_obj.num_events)
-    print "  - No. of events in %s: %d" %(sample2_dir, sample2_obj.num_events)
-    # Output header for Bayes factor file
+    sample_dirs = [sample1_dir] + list(other_sample_dirs)
+    sample_objs = [MISOSamples(sample_dir,
+                               use_compressed=use_compressed) \
+                   for sample_dir in sample_dirs]
     if sample_labels is None:
         # Use directory names as sample labels
-        sample1_label = os.path.basename(os.path.normpath(sample1_dir))
-        sample2_label = os.path.basename(os.path.normpath(sample2_dir))
+        sample_labels = get_sample_labels(sample_dirs)
     else:
         # If we're given sample labels, use them
-        sample1_label, sample2_label = sample_labels
-        print "Using user-given sample labels (sample1 = %s, sample2 = %s)" \
-              %(sample1_label, sample2_label)
+        print "Using user-given sample labels (sample1 = %s, others = %s)" \
+              %(sample_labels[0], ",".join(sample_labels[1]))
+        sample_labels = [sample_labels[0]] + list(sample_labels[1])
+    pairs = [(0, sample_num) for sample_num in range(1, len(sample_dirs))]
+    output_pairs_comparisons(sample_dirs, sample_objs, sample_labels, pairs,
+                             sample_objs[0].all_event_names, output_dir,
+                             alpha=alpha,
+                             num_proc=num_proc)
+
+
+def output_all_pairs_comparisons(sample_dirs, output_dir,
+                                 alpha=.95,
+                                 sample_labels=None,
+                                 use_compressed=None,
+                                 num_proc=1,
+                                 combined_filename=None):
+    """
+    Compare every pair of the given samples, outputting a comparison
+    directory for each pair as output_samples_comparison does (the
+    first of the pair being the one given first.) The samples of
+    each event are loaded once for all pairs.
+
+    If combined_filename is given, the comparisons of all pairs are
+    also output to it as one table, with the labels of the pair's
+    samples in its first two columns.
+    """
+    if len(sample_dirs) < 2:
+        raise Exception, "Need at least two samples to compare."
+    print "Given output dir: %s" %(output_dir)
+    print "Retrieving MISO files in sample directories..."
+    sample_objs = [MISOSamples(sample_dir,
+                               use_compressed=use_compressed) \
+                   for sample_dir in sample_dirs]
+    if sample_labels is None:
+        # Use directory names as sample labels
+        sample_labels = get_sample_labels(sample_dirs)
+    else:
+        print "Using user-given sample labels (%s)" %(",".join(sample_labels))
+    pairs = [(sample1_num, sample2_num) \
+             for sample1_num in range(len(sample_dirs)) \
+             for sample2_num in range(sample1_num + 1, len(sample_dirs))]
+    # Events of the first sample, then those only found in later samples
+    event_names = []
+    seen_event_names = set()
+    for sample_obj in sample_objs:
+        for event_name in sample_obj.all_event_names:
+            if event_name not in seen_event_names:
+                seen_event_names.add(event_name)
+                event_names.append(event_name)
+    output_pairs_comparisons(sample_dirs, sample_objs, sample_labels, pairs,
+                             event_names, output_dir,
+                             alpha=alpha,
+                             num_proc=num_proc,
+                             combined_filename=combined_filename)
+
+
+def get_sample_labels(sample_dirs):
+    """
+    Return the labels of samples from their directory names.
+    """
+    return [os.path.basename(os.path.normpath(sample_dir)) \
+            for sample_dir in sample_dirs]
+
+
+def output_pairs_comparisons(sample_dirs, sample_objs, sample_labels, pairs,
+                             event_names, output_dir,
+                             alpha=.95,
+                             num_proc=1,
+                             combined_filename=None):
+    """
+    Compare the given pairs of samples (pairs of indices into the
+    samples) on the given events, writing a Bayes factor file for
+    each pair and optionally a combined table of all pairs.
+
+    Events are compared in tasks on num_proc processes, and results
+    are written in the order of the events regardless of the number
+    of processes.
+    """
+    header_line = "\t".join(COMPARISON_HEADER_FIELDS) + "\n"
+    output_files = []
+    for sample1_num, sample2_num in pairs:
+        print "Computing sample comparison between %s and %s..." \
+              %(sample_dirs[sample1_num], sample_dirs[sample2_num])
+        for sample_num in (sample1_num, sample2_num):
+            print "  - No. of events in %s: %d" %(sample_dirs[sample_num],
+                                                  sample_objs[sample_num].num_events)
+        output_filename = \
+            make_comparison_dir(output_dir,
+                                sample_labels[sample1_num],
+                                sample_labels[sample2_num])
+        output_file = open(output_filename, 'w')
+        output_file.write(header_line)
+        output_files.append(output_file)
+    combined_file = None
+    if combined_filename is not None:
+        print "Outputting comparisons of all pairs to: %s" %(combined_filename)
+        combined_file = open(combined_filename, 'w')
+        combined_file.write("sample1\tsample2\t%s" %(header_line))
+
+    pair_labels = [(sample_labels[sample1_num], sample_labels[sample2_num]) \
+                   for sample1_num, sample2_num in pairs]
+
+    params = {"sample_objs": sample_objs,
+              "sample_labels": sample_labels,
+              "pairs": pairs,
+              "alpha": alpha}
+    tasks = [event_names[n:n + COMPARISON_TASK_SIZE] \
+             for n in range(0, len(event_names), COMPARISON_TASK_SIZE)]
+    nums_events_compared = [0] * len(output_files)
+    # Each pair's file lists events in the order of the pair's first
+    # sample. Pairs whose events are compared in another order keep
+    # their lines until all events are compared.
+    pairs_event_names = get_reordered_pairs_events(sample_objs, pairs,
+                                                   event_names)
+    pairs_lines = [{} for pair in pairs]
+
+    def write_task_results(task, task_results):
+        for pair_num, output_lines in enumerate(task_results):
+            if pairs_event_names[pair_num] is None:
+                output_files[pair_num].writelines(output_lines)
+            else:
+                for output_line in output_lines:
+                    event_name = output_line.split("\t", 1)[0]
+                    pairs_lines[pair_num][event_name] = output_line
+            nums_events_compared[pair_num] += len(output_lines)
+        if combined_file is not None:
+            combined_file.writelines(get_combined_lines(task, task_results,
+                                                        pair_labels))
+
+    if num_proc > 1:
+        print "Comparing %d events on %d processes" %(len(event_names),
+                                                     num_proc)
+        # Worker processes get the samples when they are forked
+        pool = multiprocessing.Pool(processes=num_proc,
+                                    initializer=init_comparison_worker,
+                                    initargs=(params,))
+        try:
+            # Results come back in the order of the tasks
+            for task, task_results in \
+                itertools.izip(tasks, pool.imap(compare_events, tasks)):
+                write_task_results(task, task_results)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        init_comparison_worker(params)
+        for task in tasks:
+            write_task_results(task, compare_events(task))
+    for pair_num, output_file in enumerate(output_files):
+        if pairs_event_names[pair_num] is not None:
+            pair_lines = pairs_lines[pair_num]
+            output_file.writelines([pair_lines[event_name] \
+                                    for event_name in pairs_event_names[pair_num] \
+                                    if event_name in pair_lines])
+        print "Compared a total of %d events." \
+              %(nums_events_compared[pair_num])
+        output_file.close()
+    if combined_file is not None:
+        combined_file.close()
+    for sample_obj in sample_objs:
+        sample_obj.close_dbs()
+
+
+def get_reordered_pairs_events(sample_objs, pairs, event_names):
+    """
+    Return, for each pair of samples, the events the pair has in
+    common in the order of its first sample if that differs from
+    their order in event_names, and None otherwise.
+    """
+    event_nums = dict((event_name, event_num) \
+                      for event_num, event_name in enumerate(event_names))
+    pairs_event_names = []
+    for sample1_num, sample2_num in pairs:
+        sample2_event_names = set(sample_objs[sample2_num].all_event_names)
+        pair_event_names = [event_name for event_name \
+                            in sample_objs[sample1_num].all_event_names \
+                            if event_name in sample2_event_names]
+        pair_event_nums = [event_nums[event_name] \
+                           for event_name in pair_event_names]
+        if pair_event_nums == sorted(pair_event_nums):
+            pairs_event_names.append(None)
+        else:
+            pairs_event_names.append(pair_event_names)
+    return pairs_event_names
+
+
+def make_comparison_dir(output_dir, sample1_label, sample2_label):
+    """
+    Make the directory of the comparison of two samples. Return
+    the name of its Bayes factor file.
+    """
     output_dir = os.path.join(output_dir, "%s_vs_%s" %(sample1_label,
                                                        sample2_label))
     print "Creating comparisons parent directory: %s" %(output_dir)
@@ -219,130 +450,250 @@ def output_samples_comparison(sample1_dir, sample2_dir, output_dir,
     # Create directory for Bayes factors
     bf_output_dir = os.path.join(output_dir, 'bayes-factors/')
     misc_utils.make_dir(bf_output_dir)
-
-    header_fields = ['event_name',
-                     'sample1_posterior_mean',
-                     'sample1_ci_low',
-                     'sample1_ci_high',
-                     'sample2_posterior_mean',
-                     'sample2_ci_low',
-                     'sample2_ci_high',
-                     'diff',
-                     'bayes_factor',
-                     'isoforms',
-                     'sample1_counts',
-                     'sample1_assigned_counts',
-                     'sample2_counts',
-                     'sample2_assigned_counts',
-                     'chrom',
-                     'strand',
-                     'mRNA_starts',
-                     'mRNA_ends']
-    header_line = "\t".join(header_fields) + "\n"
     output_filename = \
         os.path.join(bf_output_dir, "%s_vs_%s.miso_bf" %(sample1_label,
                                                          sample2_label))
-    output_file = open(output_filename, 'w')
-    output_file.write(header_line)
-
-    num_events_compared = 0
-    file_num = 0
-
-    # Compute the Bayes factors for each file
-    for event_name in sample1_obj.all_event_names:
-        sample1_results = sample1_obj.get_event_samples(event_name)
-        # Parameters from raw MISO samples file
-        samples1 = sample1_results[0]
-        header1 = sample1_results[1]
-        header1 = header1[0]
-        params1 = parse_sampler_params_from_header(header1)
-        # Extract gene information if available
-        gene_info = get_gene_info_from_params(params1)
-        # Find corresponding event filename in sample 2
-        sample2_results = sample2_obj.get_event_samples(event_name)
-        if sample2_results is None:
-            continue
-        num_events_compared += 1
-        # Compute delta of posterior samples and Bayes factors
-        diff_range = arange(-1, 1, 0.001)
-        delta_densities = \
-          compute_delta_densities(sample1_results,
-                                  sample2_results,
-                                  diff_range,
+    return output_filename
+
+
+def get_combined_lines(event_names, task_results, pair_labels):
+    """
+    Return the lines of the combined table for the results of a
+    comparison task on the given events: each pair's line prefixed
+    by the labels of the pair, with the lines of an event kept
+    together in the order of the events.
+    """
+    events_lines = defaultdict(list)
+    for output_lines, (sample1_label, sample2_label) in zip(task_results,
+                                                            pair_labels):
+        for output_line in output_lines:
+            event_name = output_line.split("\t", 1)[0]
+            events_lines[event_name].append("%s\t%s\t%s" %(sample1_label,
+                                                           sample2_label,
+                                                           output_line))
+    return [line for event_name in event_names \
+            for line in events_lines.get(event_name, [])]
+
+
+def init_comparison_worker(params):
+    comparison_params.update(params)
+
+
+def compare_events(event_names):
+    """
+    Compare the given events between each pair of samples. The
+    samples of the events, and their posterior means and credible
+    intervals, are computed once for all pairs. Return, for each
+    pair, the lines of its Bayes factor file.
+    """
+    sample_objs = comparison_params["sample_objs"]
+    sample_labels = comparison_params["sample_labels"]
+    pairs = comparison_params["pairs"]
+    alpha = comparison_params["alpha"]
+    task_results = [[] for pair in pairs]
+    # Load the task's events of each sample that is compared
+    compared_samples = set([sample_num for pair in pairs \
+                            for sample_num in pair])
+    events_samples = {}
+    events_intervals = {}
+    for sample_num in compared_samples:
+        events_samples[sample_num] = \
+          sample_objs[sample_num].get_events_samples(event_names)
+        events_intervals[sample_num] = \
+          compute_events_intervals(events_samples[sample_num],
+                                   confidence_level=alpha)
+    for pair_num, (sample1_num, sample2_num) in enumerate(pairs):
+        sample1_label = sample_labels[sample1_num]
+        sample2_label = sample_labels[sample2_num]
+        # Events of the pair, and the differences of their
+        # posterior samples
+        pair_events = []
+        for event_name in event_names:
+            sample1_results = events_samples[sample1_num].get(event_name)
+            sample2_results = events_samples[sample2_num].get(event_name)
+            if (sample1_results is None) or (sample2_results is None):
+                continue
+            posterior_diffs = \
+              get_posterior_diffs(sample1_results[0], sample2_results[0],
                                   event_name=event_name,
                                   sample1_label=sample1_label,
                                   sample2_label=sample2_label)
-        bf = delta_densities['bayes_factor']
-        num_isoforms = shape(delta_densities['samples1'])[1]
-        sample1_posterior_mean = mean(delta_densities['samples1'], 0)
-        sample2_posterior_mean = mean(delta_densities['samples2'], 0)
-        # Get the labels of the isoforms
-        isoforms_field = delta_densities['isoforms']
-        # Get the counts information about both samples
-        sample1_counts_info = delta_densities['sample1_counts']
-        sample2_counts_info = delta_densities['sample2_counts']
-
-        # Compute posterior mean and credible intervals for sample 1
-        sample1_cred_intervals = \
-          format_credible_intervals(event_name,
-                                    delta_densities['samples1'],
-                                    confidence_level=alpha)
-        sample1_ci_low = sample1_cred_intervals[2]
-        sample1_ci_high = sample1_cred_intervals[3]
-        # Compute posterior mean and credible intervals for sample 2
-        sample2_cred_intervals = \
-          format_credible_intervals(event_name,
-                                    delta_densities['samples2'],
-                                    confidence_level=alpha)
-        sample2_ci_low = sample2_cred_intervals[2]
-        sample2_ci_high = sample2_cred_intervals[3]
-        posterior_diff = sample1_posterior_mean - sample2_posterior_mean
-        # Use precision of two decimal places
-        if num_isoforms == 2:
-            sample1_posterior_mean = \
-                Decimal(str(sample1_posterior_mean[0])).quantize(Decimal('0.01'))
-            sample2_posterior_mean = \
-                Decimal(str(sample2_posterior_mean[0])).quantize(Decimal('0.01'))
-            posterior_diff = "%.2f" %(sample1_posterior_mean - sample2_posterior_mean)
-            bayes_factor = "%.2f" %(bf[0])
-        else:
-            posterior_diff = \
-                ",".join(["%.2f" %(v) for v in (sample1_posterior_mean - sample2_posterior_mean)])
-            sample1_posterior_mean = sample1_cred_intervals[1]
-            sample2_posterior_mean = sample2_cred_intervals[1]
-            bayes_factor = ",".join(["%.2f" %(max(v, 0)) for v in bf])
-
-        # Write comparison output line
-        output_fields = [event_name,
-                         # Mean and confidence bounds for sample 1
-                         "%s" %(sample1_posterior_mean),
-                         "%s" %(sample1_ci_low),
-                         "%s" %(sample1_ci_high),
-                         # Mean and confidence bounds for sample 2
-                         "%s" %(sample2_posterior_mean),
-                         "%s" %(sample2_ci_low),
-                         "%s" %(sample2_ci_high),
-                         # Delta Psi value
-                         "%s" %(posterior_diff),
-                         # Bayes factor
-                         "%s" %(bayes_factor),
-                         # Description of the isoforms
-                         "%s" %(isoforms_field),
-                         # Counts information for sample 1
-                         "%s" %(sample1_counts_info['counts']),
-                         "%s" %(sample1_counts_info['assigned_counts']),
-                         # Counts information for sample 2
-                         "%s" %(sample2_counts_info['counts']),
-                         "%s" %(sample2_counts_info['assigned_counts']),
-                         # Gene information
-                         gene_info["chrom"],
-                         gene_info["strand"],
-                         gene_info["mRNA_starts"],
-                         gene_info["mRNA_ends"]]
-        output_line = "%s\n" %("\t".join(output_fields))
-        output_file.write(output_line)
-    print "Compared a total of %d events." %(num_events_compared)
-    output_file.close()
+            pair_events.append((event_name, posterior_diffs))
+        # The Bayes factors of events with the same number of samples
+        # and isoforms are computed together
+        events_by_shape = defaultdict(list)
+        for event_num, (event_name, posterior_diffs) in enumerate(pair_events):
+            events_by_shape[shape(posterior_diffs)].append(event_num)
+        events_bayes_factors = [None] * len(pair_events)
+        for event_nums in events_by_shape.itervalues():
+            bayes_factors, diff_posteriors = \
+              compute_bayes_factors([pair_events[n][1] for n in event_nums])
+            for n, event_num in enumerate(event_nums):
+                events_bayes_factors[event_num] = list(bayes_factors[n])
+        for (event_name, posterior_diffs), bayes_factors in \
+            zip(pair_events, events_bayes_factors):
+            output_line = \
+                format_comparison(event_name,
+                                  events_samples[sample1_num][event_name],
+                                  events_samples[sample2_num][event_name],
+                                  events_intervals[sample1_num][event_name],
+                                  events_intervals[sample2_num][event_name],
+                                  bayes_factors)
+            task_results[pair_num].append(output_line)
+    return task_results
+
+
+def compute_events_intervals(events_samples, confidence_level=.95):
+    """
+    Compute the posterior means and credible intervals of events,
+    given as a dictionary of their samples as loaded by load_samples.
+    Return a dictionary of the events' posterior means and their
+    print-able credible intervals (as made by format_intervals.)
+
+    The credible intervals of events with the same number of samples
+    and isoforms are computed together.
+    """
+    events_by_shape = defaultdict(list)
+    for event_name, samples_results in events_samples.iteritems():
+        if samples_results is None:
+            continue
+        events_by_shape[shape(samples_results[0])].append(event_name)
+    events_intervals = {}
+    for shape_event_names in events_by_shape.itervalues():
+        posterior_means, ci_lows, ci_highs = \
+          compute_batch_credible_intervals([events_samples[event_name][0] \
+                                            for event_name in shape_event_names],
+                                           confidence_level=confidence_level)
+        for n, event_name in enumerate(shape_event_names):
+            events_intervals[event_name] = \
+              (posterior_means[n],
+               format_intervals(event_name, posterior_means[n],
+                                ci_lows[n], ci_highs[n]))
+    return events_intervals
+
+
+def format_comparison(event_name, sample1_results, sample2_results,
+                      sample1_intervals, sample2_intervals,
+                      bayes_factors):
+    """
+    Return the line of the Bayes factor file of an event compared
+    between two samples. Takes the samples of the event in each
+    sample, their posterior means and credible intervals (as made
+    by compute_events_intervals) and the Bayes factors of the
+    isoforms.
+    """
+    # Parameters from raw MISO samples file
+    header1 = sample1_results[1]
+    header1 = header1[0]
+    params1 = parse_sampler_params_from_header(header1)
+    # Extract gene information if available
+    gene_info = get_gene_info_from_params(params1)
+    bf = bayes_factors
+    num_isoforms = shape(sample1_results[0])[1]
+    sample1_posterior_mean, sample1_cred_intervals = sample1_intervals
+    sample2_posterior_mean, sample2_cred_intervals = sample2_intervals
+    # Get the labels of the isoforms
+    isoforms_field = get_isoforms_from_header(header1)
+    # Get the counts information about both samples
+    sample1_counts_info = sample1_results[5]
+    sample2_counts_info = sample2_results[5]
+
+    # Posterior mean and credible intervals for sample 1
+    sample1_ci_low = sample1_cred_intervals[2]
+    sample1_ci_high = sample1_cred_intervals[3]
+    # Posterior mean and credible intervals for sample 2
+    sample2_ci_low = sample2_cred_intervals[2]
+    sample2_ci_high = sample2_cred_intervals[3]
+    posterior_diff = sample1_posterior_mean - sample2_posterior_mean
+    # Use precision of two decimal places
+    if num_isoforms == 2:
+        sample1_posterior_mean = \
+            Decimal(str(sample1_posterior_mean[0])).quantize(Decimal('0.01'))
+        sample2_posterior_mean = \
+            Decimal(str(sample2_posterior_mean[0])).quantize(Decimal('0.01'))
+        posterior_diff = "%.2f" %(sample1_posterior_mean - sample2_posterior_mean)
+        bayes_factor = "%.2f" %(bf[0])
+    else:
+        posterior_diff = \
+            ",".join(["%.2f" %(v) for v in (sample1_posterior_mean - sample2_posterior_mean)])
+        sample1_posterior_mean = sample1_cred_intervals[1]
+        sample2_posterior_mean = sample2_cred_intervals[1]
+        bayes_factor = ",".join(["%.2f" %(max(v, 0)) for v in bf])
+
+    # Write comparison output line
+    output_fields = [event_name,
+                     # Mean and confidence bounds for sample 1
+                     "%s" %(sample1_posterior_mean),
+                     "%s" %(sample1_ci_low),
+                     "%s" %(sample1_ci_high),
+                     # Mean and confidence bounds for sample 2
+                     "%s" %(sample2_posterior_mean),
+                     "%s" %(sample2_ci_low),
+                     "%s" %(sample2_ci_high),
+                     # Delta Psi value
+                     "%s" %(posterior_diff),
+                     # Bayes factor
+                     "%s" %(bayes_factor),
+                     # Description of the isoforms
+                     "%s" %(isoforms_field),
+                     # Counts information for sample 1
+                     "%s" %(sample1_counts_info['counts']),
+                     "%s" %(sample1_counts_info['assigned_counts']),
+                     # Counts information for sample 2
+                     "%s" %(sample2_counts_info['counts']),
+                     "%s" %(sample2_counts_info['assigned_counts']),
+                     # Gene information
+                     gene_info["chrom"],
+                     gene_info["strand"],
+                     gene_info["mRNA_starts"],
+                     gene_info["mRNA_ends"]]
+    output_line = "%s\n" %("\t".join(output_fields))
+    return output_line
+
+
+def compute_kde_at_zero(posterior_diffs, smoothing_param=0.3):
+    """
+    Evaluate at 0 the Gaussian kernel density estimate of each set of
+    posterior differences, with the bandwidth of gaussian_kde_covfact
+    (the variance of the differences scaled by smoothing_param
+    squared.) Takes an array whose last axis is the samples, e.g.
+    isoforms or events by samples, and returns the densities.
+    """
+    posterior_diffs = asarray(posterior_diffs, dtype=float)
+    num_samples = posterior_diffs.shape[-1]
+    kernel_variance = \
+        var(posterior_diffs, axis=-1, ddof=1) * (smoothing_param ** 2)
+    with errstate(divide='ignore', invalid='ignore'):
+        energy = (posterior_diffs ** 2) / (2 * kernel_variance[..., newaxis])
+        density = exp(-energy).sum(axis=-1) / \
+                  (num_samples * sqrt(2 * pi * kernel_variance))
+    return density
+
+
+def compute_bayes_factors(posterior_diffs, smoothing_param=0.3,
+                          max_bf=1e12):
+    """
+    Compute Bayes factors for delta = 0 of sets of posterior
+    differences, given as an array whose last axis is the samples.
+    Equivalent to compute_bayes_factor with a uniform prior and the
+    posterior density fitted as in compute_delta_densities, for all
+    the sets at once.
+
+    Returns the Bayes factors and the posterior densities at 0.
+    """
+    posterior_diffs = asarray(posterior_diffs, dtype=float)
+    diff_posterior = compute_kde_at_zero(posterior_diffs,
+                                         smoothing_param=smoothing_param)
+    # If the average difference is (close to) 0, or the differences
+    # are all identical, the density is peaked at 0
+    null_peaked = (mean(abs(posterior_diffs), axis=-1) <= .009) | \
+                  all(posterior_diffs == posterior_diffs[..., 0:1], axis=-1)
+    diff_posterior = where(null_peaked, inf, diff_posterior)
+    # Prior density of delta = 0 is 1
+    with errstate(divide='ignore'):
+        bayes_factors = 1. / diff_posterior
+    bayes_factors = minimum(bayes_factors, max_bf)
+    return bayes_factors, diff_posterior
 
 
 def compute_bayes_factor(prior_density, posterior_density,
@@ -8,6 +8,11 @@ import sys
 import time
 import glob
 import shelve
+import shutil
+import fcntl
+import hashlib
+import tempfile
+import multiprocessing
 
 from collections import defaultdict
 # Add misopy path
@@ -17,6 +22,7 @@ sys.path.insert(0, miso_path)
 
 import misopy
 import misopy.gff_utils as gff_utils
+import misopy.gff_db as gff_db
 import misopy.pickle_utils as pickle_utils
 import misopy.Gene as gene_utils
 import misopy.misc_utils as misc_utils
@@ -24,26 +30,62 @@ print(misopy)
 
 
 COMPRESS_PREFIX = misc_utils.COMPRESS_PREFIX
+# Version of the indexed GFF layout. Part of the index cache key,
+# so that it must be bumped whenever the indexed output changes.
+INDEX_VERSION = 1
+# Marker file written into a cached index once it is complete
+CACHE_COMPLETE_BASENAME = ".index_complete"
+# Number of GFF lines buffered before they are appended to the
+# chromosome partitions
+PARTITION_BUFFER_LINES = 100000
 
 def compress_event_name(event_name,
                         prefix=COMPRESS_PREFIX):
-    event_hash = hash(event_name)
+    """
+    Return the compressed ID of the event name. The ID is derived
+    from a stable hash of the name, so the same GFF always yields
+    the same compressed IDs, regardless of the Python version or
+    of the process that indexed it.
+    """
+    event_hash = misc_utils.get_event_name_hash(event_name)
     compressed_event_name = "%s_%s" %(prefix, event_hash)
     return compressed_event_name
 
 
-def serialize_genes(gff_genes,
-                    gff_filename,
-                    output_dir,
-                    compress_id=False):
+def add_compressed_ids(compressed_id_to_gene_id, new_compressed_ids):
     """
-    Output genes into pickle files by chromosome, by gene.
+    Add mapping from compressed IDs to gene IDs into
+    compressed_id_to_gene_id, checking that no two genes share
+    a compressed ID.
+    """
+    for compressed_id, gene_id in new_compressed_ids.iteritems():
+        if compressed_id_to_gene_id.get(compressed_id, gene_id) != gene_id:
+            raise Exception, "Compressed ID collision: %s and %s both " \
+                  "map to %s" %(compressed_id_to_gene_id[compressed_id],
+                                gene_id,
+                                compressed_id)
+        compressed_id_to_gene_id[compressed_id] = gene_id
+
+
+def get_chrom_dir_name(chrom):
+    """
+    Return the name of the directory that holds the indexed
+    genes of the given chromosome.
+    """
+    if chrom.startswith("chr"):
+        return chrom
+    # Add chr-prefix for ease of finding directory
+    # in downstream steps.
+    return "chr%s" %(str(chrom))
+
+
+def group_genes_by_chrom(gff_genes, compress_id=False):
+    """
+    Split up genes by chromosome.
 
     If asked, use compressed IDs (hashes) of the 'ID=' field in the GFF.
     """
     genes_by_chrom = defaultdict(dict)
-
-    # Split up genes by chromosome
     for gene_id, gene_info in gff_genes.iteritems():
         gene_obj = gene_info["gene_object"]
         gene_hierarchy = gene_info["hierarchy"]
@@ -55,58 +97,64 @@ def serialize_genes(gff_genes,
             # Store compressed ID
             genes_by_chrom[gene_obj.chrom][gene_id]['compressed_id'] \
                 = gene_compressed_id
+    return genes_by_chrom
 
-    # Mapping from gene IDs to pickled filename
+
+def serialize_chrom_genes(chrom, chrom_genes, output_dir,
+                          compress_id=False):
+    """
+    Serialize all the genes of a chromosome into their own
+    directory, one pickle file per gene.
+
+    Return the mapping from gene IDs to pickled filenames and
+    the mapping from compressed IDs (hashes) to gene IDs.
+    """
     gene_id_to_filename = {}
-    # Mapping from compressed IDs (hashes) to gene IDs
     compressed_id_to_gene_id = {}
 
-    # Serialize all the genes in each chromosome into their
-    # own directory
-    for chrom, chrom_genes in genes_by_chrom.iteritems():
-        if chrom.startswith("chr"):
-            chrom_dir_name = chrom
-        else:
-            # Add chr-prefix for ease of finding directory
-            # in downstream steps.
-            chrom_dir_name = "chr%s" %(str(chrom))
+    # Make directory for chromosome if it doesn't already exist
+    chrom_dir = os.path.join(output_dir, get_chrom_dir_name(chrom))
+    if not os.path.isdir(chrom_dir):
+        print "Making directory: %s" %(chrom_dir)
+        os.makedirs(chrom_dir)
 
-        # Make directory for chromosome if it doesn't already exist
-        chrom_dir = os.path.join(output_dir, chrom_dir_name)
-        if not os.path.isdir(chrom_dir):
-            print "Making directory: %s" %(chrom_dir)
-            os.makedirs(chrom_dir)
-
-        t1 = time.time()
-        # Serialize each gene into a separate file
-        num_genes = len(genes_by_chrom[chrom])
+    t1 = time.time()
+    # Serialize each gene into a separate file
+    for gene_id, gene_info in chrom_genes.iteritems():
+        gene_compressed_id = None
+        if compress_id:
+            gene_compressed_id = gene_info['compressed_id']
+            gene_filename = \
+                os.path.abspath(os.path.join(chrom_dir,
+                                             "%s.pickle" \
+                                             %(gene_compressed_id)))
+        else:
+            gene_filename = \
+                os.path.abspath(os.path.join(chrom_dir,
+                                             "%s.pickle" %(gene_id)))
+        # Write each gene/event's pickle file
+        pickle_utils.write_pickled_file({gene_id: gene_info},
+                                        gene_filename)
+        # Record what filename was associated with this gene ID
+        gene_id_to_filename[gene_id] = gene_filename
+        # Record compressed ID (hash) to gene ID
+        if gene_compressed_id is not None:
+            compressed_id_to_gene_id[gene_compressed_id] = gene_id
 
-        for gene_id, gene_info in genes_by_chrom[chrom].iteritems():
-            gene_compressed_id = None
-            if compress_id:
-                gene_compressed_id = \
-                    genes_by_chrom[chrom][gene_id]['compressed_id']
-                gene_filename = \
-                    os.path.abspath(os.path.join(chrom_dir,
-                                                 "%s.pickle" \
-                                                 %(gene_compressed_id)))
-            else:
-                gene_filename = \
-                    os.path.abspath(os.path.join(chrom_dir,
-                                                 "%s.pickle" %(gene_id)))
-            # Write each gene/event's pickle file
-            pickle_utils.write_pickled_file({gene_id:
-                                             genes_by_chrom[chrom][gene_id]},
-                                            gene_filename)
-            # Record what filename was associated with this gene ID
-            gene_id_to_filename[gene_id] = gene_filename
-            # Record compressed ID (hash) to gene ID
-            if gene_compressed_id is not None:
-                compressed_id_to_gene_id[gene_compressed_id] = gene_id
+    t2 = time.time()
+    print "  - Chromosome %s serialization took %.2f seconds" \
+          %(chrom, t2 - t1)
+    return gene_id_to_filename, compressed_id_to_gene_id
 
-        t2 = time.time()
-        print "  - Chromosome serialization took %.2f seconds" %(t2 - t1)
 
+def output_index_mappings(output_dir,
+                          gene_id_to_filename,
+                          compressed_id_to_gene_id):
+    """
+    Shelve the mappings from gene IDs to filenames and from
+    compressed gene IDs to gene IDs. The latter is also written as
+    a plain-text file.
+    """
     # Shelve the mapping from gene ids to filenames
     shelved_filename = os.path.join(output_dir,
                                     "genes_to_filenames.shelve")
@@ -122,8 +170,26 @@ def serialize_genes(gff_genes,
     for k, v in compressed_id_to_gene_id.iteritems():
         shelved_data[k] = v
     shelved_data.close()
+    output_compressed_ids(output_dir, compressed_id_to_gene_id)
+
 
-    # Output a list of genes in ordinary GFF format
+def output_compressed_ids(output_dir, compressed_id_to_gene_id):
+    """
+    Output the mapping from compressed gene IDs to gene IDs as a
+    plain-text file, if there are compressed IDs.
+    """
+    if len(compressed_id_to_gene_id) == 0:
+        return
+    compressed_filename = os.path.join(output_dir,
+                                       misc_utils.COMPRESSED_IDS_BASENAME)
+    misc_utils.write_compressed_ids_to_genes(compressed_id_to_gene_id,
+                                             compressed_filename)
+
+
+def output_genes_gff(gff_filename, output_dir):
+    """
+    Output a list of genes in ordinary GFF format.
+    """
     genes_filename = os.path.join(output_dir, "genes.gff")
     print "Outputting gene records in GFF format..."
     print "  - Output file: %s" %(genes_filename)
@@ -136,17 +202,351 @@ def serialize_genes(gff_genes,
                     gff_out.write(line)
 
 
+def serialize_genes_to_db(genes_by_chrom, db_fname):
+    """
+    Serialize genes, grouped by chromosome, into a single
+    indexed GFF database file.
+    """
+    genes_db = gff_db.GFFIndexDatabase(db_fname, create=True)
+    for chrom, chrom_genes in genes_by_chrom.iteritems():
+        t1 = time.time()
+        genes_db.add_genes(chrom_genes)
+        t2 = time.time()
+        print "  - Chromosome %s serialization took %.2f seconds" \
+              %(chrom, t2 - t1)
+    genes_db.close()
+
+
+def output_db_compressed_ids(db_fname, output_dir):
+    """
+    Output the mapping from compressed gene IDs to gene IDs of
+    an indexed GFF database, checking for collisions.
+    """
+    genes_db = gff_db.GFFIndexDatabase(db_fname)
+    compressed_id_to_gene_id = {}
+    for compressed_id, gene_id in genes_db.get_compressed_id_pairs():
+        add_compressed_ids(compressed_id_to_gene_id,
+                           {compressed_id: gene_id})
+    genes_db.close()
+    output_compressed_ids(output_dir, compressed_id_to_gene_id)
+
+
+def serialize_genes(gff_genes,
+                    gff_filename,
+                    output_dir,
+                    compress_id=False,
+                    single_file=False):
+    """
+    Output genes into pickle files by chromosome, by gene.
+
+    If asked, use compressed IDs (hashes) of the 'ID=' field in the GFF.
+
+    If single_file is True, output all genes into a single indexed
+    GFF database (genes.gff_db) instead of one pickle file per gene.
+    """
+    genes_by_chrom = group_genes_by_chrom(gff_genes,
+                                          compress_id=compress_id)
+
+    if single_file:
+        db_fname = os.path.join(output_dir, gff_db.GFF_DB_BASENAME)
+        print "Outputting genes to database: %s" %(db_fname)
+        serialize_genes_to_db(genes_by_chrom, db_fname)
+        if compress_id:
+            output_db_compressed_ids(db_fname, output_dir)
+        output_genes_gff(gff_filename, output_dir)
+        return
+
+    # Mapping from gene IDs to pickled filename
+    gene_id_to_filename = {}
+    # Mapping from compressed IDs (hashes) to gene IDs
+    compressed_id_to_gene_id = {}
+
+    # Serialize all the genes in each chromosome into their
+    # own directory
+    for chrom, chrom_genes in genes_by_chrom.iteritems():
+        chrom_fnames, chrom_compressed_ids = \
+            serialize_chrom_genes(chrom, chrom_genes, output_dir,
+                                  compress_id=compress_id)
+        gene_id_to_filename.update(chrom_fnames)
+        add_compressed_ids(compressed_id_to_gene_id, chrom_compressed_ids)
+
+    output_index_mappings(output_dir,
+                          gene_id_to_filename,
+                          compressed_id_to_gene_id)
+    output_genes_gff(gff_filename, output_dir)
+
+
+def partition_gff_by_chrom(gff_filename, partition_dir):
+    """
+    Split the records of a GFF into one GFF file per chromosome
+    (seqid). A gene and all of its mRNAs and exons share the
+    same seqid, so each partition can be indexed on its own.
+
+    Return a list of (chrom, partition filename) pairs, largest
+    partition first.
+    """
+    partition_fnames = {}
+    partition_sizes = defaultdict(int)
+    # Lines waiting to be appended to each partition. Partitions
+    # are only opened to append their lines, so that GFFs with many
+    # seqids (e.g. scaffolds) do not need a file open per seqid
+    partition_lines = defaultdict(list)
+    num_buffered = 0
+    with open(gff_filename) as gff_in:
+        for line in gff_in:
+            if line.startswith("#") or (line.strip() == ""):
+                continue
+            chrom = line.split("\t", 1)[0]
+            if chrom not in partition_fnames:
+                partition_fnames[chrom] = \
+                    os.path.join(partition_dir,
+                                 "partition_%d.gff" %(len(partition_fnames)))
+                # Start the partition empty
+                open(partition_fnames[chrom], "w").close()
+            partition_lines[chrom].append(line)
+            partition_sizes[chrom] += 1
+            num_buffered += 1
+            if num_buffered >= PARTITION_BUFFER_LINES:
+                flush_partition_lines(partition_lines, partition_fnames)
+                num_buffered = 0
+    flush_partition_lines(partition_lines, partition_fnames)
+    partitions = sorted(partition_fnames.items(),
+                        key=lambda p: partition_sizes[p[0]],
+                        reverse=True)
+    return partitions
+
+
+def flush_partition_lines(partition_lines, partition_fnames):
+    """
+    Append the buffered lines of each partition to its file and
+    empty the buffers.
+    """
+    for chrom, lines in partition_lines.iteritems():
+        with open(partition_fnames[chrom], "a") as partition_file:
+            partition_file.writelines(lines)
+    partition_lines.clear()
+
+
+def index_gff_partition(partition_args):
+    """
+    Load and serialize the genes of a single chromosome partition.
+    Runs in a worker process.
+
+    When indexing into a single file, the partition's genes are
+    written to their own database next to the partition, to be
+    merged by the parent process.
+    """
+    chrom, partition_filename, output_dir, compress_id, single_file = \
+        partition_args
+    gff_genes = gene_utils.load_genes_from_gff(partition_filename)
+    gene_id_to_filename = {}
+    compressed_id_to_gene_id = {}
+    genes_by_chrom = group_genes_by_chrom(gff_genes,
+                                          compress_id=compress_id)
+    if single_file:
+        partition_db_fname = \
+            "%s%s" %(os.path.splitext(partition_filename)[0],
+                     gff_db.GFF_DB_EXT)
+        serialize_genes_to_db(genes_by_chrom, partition_db_fname)
+        return chrom, len(gff_genes), partition_db_fname, \
+               gene_id_to_filename, compressed_id_to_gene_id
+    for gene_chrom, chrom_genes in genes_by_chrom.iteritems():
+        chrom_fnames, chrom_compressed_ids = \
+            serialize_chrom_genes(gene_chrom, chrom_genes, output_dir,
+                                  compress_id=compress_id)
+        gene_id_to_filename.update(chrom_fnames)
+        compressed_id_to_gene_id.update(chrom_compressed_ids)
+    return chrom, len(gff_genes), None, \
+           gene_id_to_filename, compressed_id_to_gene_id
+
+
+def parallel_serialize_genes(gff_filename,
+                             output_dir,
+                             num_proc,
+                             compress_id=False,
+                             single_file=False):
+    """
+    Index the GFF by chromosome using a pool of worker processes.
+    Each worker loads and serializes the genes of one chromosome;
+    the gene to filename mappings (or the per-chromosome databases,
+    if indexing into a single file) are then merged.
+    """
+    partition_dir = tempfile.mkdtemp(prefix=".partitions_",
+                                     dir=output_dir)
+    try:
+        partitions = partition_gff_by_chrom(gff_filename, partition_dir)
+        print "  - Indexing %d chromosomes using %d processes" \
+              %(len(partitions), num_proc)
+        partition_args = [(chrom, partition_fname, output_dir,
+                           compress_id, single_file) \
+                          for chrom, partition_fname in partitions]
+        gene_id_to_filename = {}
+        compressed_id_to_gene_id = {}
+        partition_db_fnames = []
+        pool = multiprocessing.Pool(processes=num_proc)
+        try:
+            for chrom, num_genes, partition_db_fname, chrom_fnames, \
+                chrom_compressed_ids in \
+                pool.imap_unordered(index_gff_partition, partition_args):
+                print "  - Indexed %d genes on %s" %(num_genes, chrom)
+                gene_id_to_filename.update(chrom_fnames)
+                add_compressed_ids(compressed_id_to_gene_id,
+                                   chrom_compressed_ids)
+                if partition_db_fname is not None:
+                    partition_db_fnames.append(partition_db_fname)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if single_file:
+            # Merge the per-chromosome databases into one
+            db_fname = os.path.join(output_dir, gff_db.GFF_DB_BASENAME)
+            print "Merging chromosome databases into: %s" %(db_fname)
+            genes_db = gff_db.GFFIndexDatabase(db_fname, create=True)
+            for partition_db_fname in partition_db_fnames:
+                genes_db.merge_db(partition_db_fname)
+            genes_db.close()
+            if compress_id:
+                output_db_compressed_ids(db_fname, output_dir)
+    finally:
+        shutil.rmtree(partition_dir, ignore_errors=True)
+    if not single_file:
+        output_index_mappings(output_dir,
+                              gene_id_to_filename,
+                              compressed_id_to_gene_id)
+    output_genes_gff(gff_filename, output_dir)
+
+
+def get_index_cache_key(gff_filename,
+                        compress_id=False,
+                        single_file=False):
+    """
+    Return the key of an indexed GFF in the index cache: a hash
+    of the GFF's contents and of the indexing options that change
+    the indexed output.
+    """
+    gff_hash = hashlib.sha1()
+    with open(gff_filename, "rb") as gff_in:
+        while True:
+            data = gff_in.read(1 << 20)
+            if not data:
+                break
+            gff_hash.update(data)
+    gff_hash.update("version=%d;compress_id=%s;single_file=%s" \
+                    %(INDEX_VERSION, compress_id, single_file))
+    return gff_hash.hexdigest()
+
+
+def link_index_dir(cached_dir, output_dir):
+    """
+    Make the indexed GFF in cached_dir available in output_dir
+    by symlinking its top-level files and directories (or copying
+    them, where symlinks are not supported). Existing entries of
+    output_dir are kept.
+    """
+    for entry in sorted(os.listdir(cached_dir)):
+        if entry == CACHE_COMPLETE_BASENAME:
+            continue
+        cached_entry = os.path.join(cached_dir, entry)
+        output_entry = os.path.join(output_dir, entry)
+        if os.path.lexists(output_entry):
+            print "  - Keeping existing %s" %(output_entry)
+            continue
+        if hasattr(os, "symlink"):
+            os.symlink(cached_entry, output_entry)
+        elif os.path.isdir(cached_entry):
+            shutil.copytree(cached_entry, output_entry)
+        else:
+            shutil.copy2(cached_entry, output_entry)
+
+
+def index_gff_with_cache(gff_filename, output_dir, cache_dir,
+                         compress_id=False,
+                         num_proc=1,
+                         single_file=False):
+    """
+    Index the GFF into the index cache, unless the same GFF was
+    already indexed there with the same options, and link the
+    cached index into the output directory.
+
+    Cached indices are stored in directories named after their
+    cache key. Each index is built in place (the pickled gene
+    filenames it records are absolute), guarded by a lock on a lock
+    file so that concurrent runs on the same GFF build it only once.
+    """
+    print "  - Using index cache: %s" %(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    t1 = time.time()
+    cache_key = get_index_cache_key(gff_filename,
+                                    compress_id=compress_id,
+                                    single_file=single_file)
+    t2 = time.time()
+    print "  - Hashing of GFF took %.2f seconds" %(t2 - t1)
+    cached_dir = os.path.join(cache_dir, cache_key)
+    complete_fname = os.path.join(cached_dir, CACHE_COMPLETE_BASENAME)
+    if os.path.isfile(complete_fname):
+        print "  - Found cached index: %s" %(cached_dir)
+    else:
+        # Whoever holds the lock on the lock file builds the index.
+        # The lock is released by the system if its holder dies, so
+        # an interrupted build does not block later runs
+        lock_file = open("%s.lock" %(cached_dir), "a")
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                print "  - Waiting for %s to be released..." %(lock_file.name)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # The index may have been built while we were waiting
+            if os.path.isfile(complete_fname):
+                print "  - Found cached index: %s" %(cached_dir)
+            else:
+                # Remove any index left behind by an interrupted run
+                if os.path.isdir(cached_dir):
+                    shutil.rmtree(cached_dir)
+                os.makedirs(cached_dir)
+                index_gff(gff_filename, cached_dir,
+                          compress_id=compress_id,
+                          num_proc=num_proc,
+                          single_file=single_file)
+                with open(complete_fname, "w") as complete_out:
+                    complete_out.write("%s\n" %(gff_filename))
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+    link_index_dir(cached_dir, output_dir)
+
+
 def index_gff(gff_filename, output_dir,
-              compress_id=False):
+              compress_id=False,
+              num_proc=1,
+              single_file=False,
+              cache_dir=None):
     """
     Index the given GFF and placed the indexed representation
     in the output directory.
+
+    If num_proc is greater than 1, the GFF is partitioned by
+    chromosome and the partitions are indexed in parallel.
+
+    If single_file is True, the genes are stored in a single
+    indexed GFF database rather than one pickle file per gene.
+
+    If cache_dir is given, the index is built in (or reused from)
+    the index cache and linked into the output directory.
     """
     print "Indexing GFF..."
     if compress_id:
         print "  - Using compressed IDs to create indexed filenames."
+    if single_file:
+        print "  - Indexing into a single database file."
     # First check that the GFF is not already indexed
     indexed_files = glob.glob(os.path.join(output_dir, "chr*"))
+    indexed_files.extend(glob.glob(os.path.join(output_dir,
+                                                gff_db.GFF_DB_BASENAME)))
     if len(indexed_files) >= 1:
         print "%s appears to already be indexed. Aborting." \
             %(gff_filename)
@@ -155,22 +555,39 @@ def index_gff(gff_filename, output_dir,
     print "  - GFF: %s" %(gff_filename)
     print "  - Outputting to: %s" %(output_dir)
     overall_t1 = time.time()
-    t1 = time.time()
-    gff_genes = gene_utils.load_genes_from_gff(gff_filename)
-    t2 = time.time()
-    print "  - Loading of genes from GFF took %.2f seconds" %(t2 - t1)
+    if cache_dir is not None:
+        index_gff_with_cache(gff_filename, output_dir, cache_dir,
+                             compress_id=compress_id,
+                             num_proc=num_proc,
+                             single_file=single_file)
+    elif num_proc > 1:
+        t1 = time.time()
+        parallel_serialize_genes(gff_filename,
+                                 output_dir,
+                                 num_proc,
+                                 compress_id=compress_id,
+                                 single_file=single_file)
+        t2 = time.time()
+        print "  - Parallel loading and serialization of genes took " \
+              "%.2f seconds" %(t2 - t1)
+    else:
+        t1 = time.time()
+        gff_genes = gene_utils.load_genes_from_gff(gff_filename)
+        t2 = time.time()
+        print "  - Loading of genes from GFF took %.2f seconds" %(t2 - t1)
 
-    t1 = time.time()
-    serialize_genes(gff_genes,
-                    gff_filename,
-                    output_dir,
-                    compress_id=compress_id)
-    t2 = time.time()
-    print "  - Serialization of genes from GFF took %.2f seconds" %(t2 - t1)
+        t1 = time.time()
+        serialize_genes(gff_genes,
+                        gff_filename,
+                        output_dir,
+                        compress_id=compress_id,
+                        single_file=single_file)
+        t2 = time.time()
+        print "  - Serialization of genes from GFF took %.2f seconds" \
+              %(t2 - t1)
     overall_t2 = time.time()
     print "Indexing of GFF took %.2f seconds." %(overall_t2 - overall_t1)
 
-
 def main():
     from optparse import OptionParser
     parser = OptionParser()
@@ -182,6 +599,22 @@ def main():
                       help="Use the compressed version of the GFF \'ID=\' "
                       "field rather than the ID itself when creating "
                       ".miso output filenames.")
+    parser.add_option("--num-proc", dest="num_proc", default=1, type="int",
+                      help="Number of processes to use. If greater than 1, "
+                      "the GFF is split by chromosome and each chromosome "
+                      "is indexed in its own process. Default is 1.")
+    parser.add_option("--single-file", dest="single_file", default=False,
+                      action="store_true",
+                      help="Store the indexed genes in a single SQLite "
+                      "database (genes.gff_db) instead of one pickle "
+                      "file per gene.")
+    parser.add_option("--cache-dir", dest="cache_dir", default=None,
+                      help="Directory of previously indexed GFFs, which "
+                      "can be shared between runs and users. The index "
+                      "is reused from the cache if the same GFF (by "
+                      "content) was indexed there with the same options, "
+                      "and added to the cache otherwise. The output "
+                      "directory then links to the cached index.")
     (options, args) = parser.parse_args()
 
     if options.index_gff != None:
@@ -191,9 +624,16 @@ def main():
             os.path.abspath(os.path.expanduser(options.index_gff[1]))
         if not os.path.isdir(output_dir):
             os.makedirs(output_dir)
+        cache_dir = None
+        if options.cache_dir is not None:
+            cache_dir = \
+                os.path.abspath(os.path.expanduser(options.cache_dir))
 
         index_gff(gff_filename, output_dir,
-                  compress_id=options.compress_id)
+                  compress_id=options.compress_id,
+                  num_proc=options.num_proc,
+                  single_file=options.single_file,
+                  cache_dir=cache_dir)
     else:
         print "Indexer of GFF files for use with MISO."
         print "Need to pass --index, for example:\n"
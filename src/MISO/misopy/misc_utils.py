@@ -5,11 +5,18 @@ import os
 import sys
 import time
 import shelve
+import whichdb
+import hashlib
 
 import time
 from time import strftime
+from collections import OrderedDict
 
 COMPRESS_PREFIX = "misocomp"
+# Number of hex digits of the event name hash kept in compressed IDs
+COMPRESS_HASH_LEN = 16
+# Plain-text mapping from compressed IDs to event IDs
+COMPRESSED_IDS_BASENAME = "compressed_ids_to_genes.txt"
 
 
 def get_timestamp():
@@ -30,17 +37,58 @@ def inv_dict(mydict):
     return new_dict
 
 
+def get_event_name_hash(event_name,
+                        hash_len=COMPRESS_HASH_LEN):
+    """
+    Return a stable hash of the event name: a truncated SHA-1 hex
+    digest, which (unlike the built-in hash()) is the same across
+    interpreter builds, processes and machines.
+    """
+    if isinstance(event_name, unicode):
+        event_name = event_name.encode("utf-8")
+    return hashlib.sha1(event_name).hexdigest()[0:hash_len]
+
+
+def write_compressed_ids_to_genes(compressed_ids_to_genes,
+                                  compressed_filename):
+    """
+    Write mapping from compressed IDs to genes as a two-column,
+    tab-delimited file, sorted by compressed ID.
+    """
+    with open(compressed_filename, "w") as compressed_out:
+        for compressed_id in sorted(compressed_ids_to_genes):
+            compressed_out.write("%s\t%s\n" \
+                                 %(compressed_id,
+                                   compressed_ids_to_genes[compressed_id]))
+
+
 def load_compressed_ids_to_genes(compressed_filename):
     """
     Load mapping from compressed IDs to genes.
+
+    The mapping is either a plain-text file written by
+    write_compressed_ids_to_genes or a .shelve file.
     """
-    if not os.path.exists(compressed_filename):
+    if compressed_filename.endswith(".shelve"):
+        # The shelve's database may add an extension to the filename,
+        # so ask the database modules whether it exists
+        shelve_exists = whichdb.whichdb(compressed_filename) is not None
+    else:
+        shelve_exists = False
+    if not (os.path.exists(compressed_filename) or shelve_exists):
         print "Error: %s compressed file does not exist." \
               %(compressed_filename)
         sys.exit(1)
     compressed_ids_to_genes = {}
-    # Load mapping from gene IDs to their hashes
-    compressed_ids_to_genes = shelve.open(compressed_filename)
+    if compressed_filename.endswith(".shelve"):
+        # Load mapping from gene IDs to their hashes. Open it
+        # read-only, which never creates a new shelve.
+        compressed_ids_to_genes = shelve.open(compressed_filename, flag='r')
+        return compressed_ids_to_genes
+    with open(compressed_filename) as compressed_in:
+        for line in compressed_in:
+            compressed_id, gene_id = line.rstrip("\n").split("\t")
+            compressed_ids_to_genes[compressed_id] = gene_id
     return compressed_ids_to_genes
 
 
@@ -59,6 +107,46 @@ def is_compressed_index(index_filename):
     return False
 
 
+class LRUCache:
+    """
+    Mapping that holds at most 'max_size' entries, evicting
+    the least recently used entry when full.
+    """
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        # Move entry to the most recently used position
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+
+    def put(self, key, value):
+        if key in self.entries:
+            del self.entries[key]
+        elif len(self.entries) >= self.max_size:
+            # Evict the least recently used entry
+            self.entries.popitem(last=False)
+        self.entries[key] = value
+
+
+    def clear(self):
+        self.entries.clear()
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
 def make_dir(dirpath):
     if os.path.isfile(dirpath):
         print "Error: %s is a file!" %(dirpath)
@@ -5,8 +5,11 @@
 import os
 import csv
 import time
+import math
 import sys
 import subprocess
+import traceback
+import multiprocessing
 from collections import defaultdict
 import logging
 
@@ -15,7 +18,9 @@ import pysam
 import misopy
 import misopy.gff_utils as gff_utils
 import misopy.as_events as as_events
+import misopy.sam_utils as sam_utils
 import misopy.run_miso as run_miso
+import misopy.miso_db as miso_db
 import misopy.misc_utils as misc_utils
 import misopy.run_events_analysis as run_events
 from misopy.parse_csv import *
@@ -26,6 +31,17 @@ import misopy.cluster_utils as cluster_utils
 miso_path = os.path.dirname(os.path.abspath(__file__))
 manual_url = "http://genes.mit.edu/burgelab/miso/docs/"
 
+# Backends for running MISO locally (i.e. not on cluster)
+LOCAL_BACKENDS = ["pool", "subprocess"]
+
+# Number of reads at which to stop counting the reads of a gene
+# when estimating its cost
+MAX_COST_READS = 2000
+
+# Parameters of the genes run by the current pool worker,
+# set by init_pool_worker
+worker_params = {}
+
 
 def get_main_logger(log_outdir,
                     level=logging.WARNING,
@@ -67,6 +83,61 @@ def greeting(parser=None):
         parser.print_help()
 
 
+def init_pool_worker(settings_fname, worker_params_to_use,
+                     batch_logs_dir):
+    """
+    Initialize a process of the local pool: load the settings
+    and redirect the worker's output to its own log file.
+
+    The worker's database writers stay open across its tasks,
+    so that their events are inserted in batches, and are closed
+    when the worker exits as the pool shuts down.
+    """
+    if settings_fname is not None:
+        Settings.load(settings_fname)
+    worker_params.update(worker_params_to_use)
+    multiprocessing.util.Finalize(None, miso_db.close_miso_db_writers,
+                                  exitpriority=10)
+    time_str = time.strftime("%m-%d-%y_%H:%M:%S")
+    worker_logfile = os.path.join(batch_logs_dir,
+                                  "worker-%d-%s.log" %(os.getpid(),
+                                                       time_str))
+    sys.stdout = open(worker_logfile, "a")
+    sys.stderr = sys.stdout
+
+
+def run_pool_task(task):
+    """
+    Compute Psi for a task of the local pool: a list of
+    (gene ID, indexed GFF filename) pairs.
+
+    Return the task number, the number of genes, the time
+    taken and the error (a traceback) if the task failed,
+    otherwise None.
+    """
+    task_num, genes = task
+    t1 = time.time()
+    error = None
+    try:
+        run_miso.compute_genes_psi(genes,
+                                   worker_params["bam_filename"],
+                                   worker_params["output_dir"],
+                                   worker_params["read_len"],
+                                   worker_params["overhang_len"],
+                                   paired_end=worker_params["paired_end"],
+                                   event_type=worker_params["event_type"],
+                                   chrom_sweep=worker_params["chrom_sweep"],
+                                   close_db_writers=False)
+    except (Exception, SystemExit):
+        # Also catch exits, which would otherwise take down
+        # the worker along with its task
+        error = traceback.format_exc()
+        print error
+    sys.stdout.flush()
+    t2 = time.time()
+    return task_num, len(genes), t2 - t1, error
+
+
 class GenesDispatcher:
     """
     Send MISO commands to cluster or locally
@@ -83,7 +154,10 @@ class GenesDispatcher:
                  sge_job_name="misojob",
                  gene_ids=None,
                  num_proc=None,
-                 wait_on_jobs=True):
+                 wait_on_jobs=True,
+                 local_backend="pool",
+                 max_task_retries=2,
+                 chrom_sweep=False):
         self.main_logger = main_logger
         self.threads = {}
         self.gff_dir = gff_dir
@@ -110,6 +184,27 @@ class GenesDispatcher:
         self.cluster_cmd = Settings.get_cluster_command()
         self.sge_job_name = sge_job_name
         self.wait_on_jobs = wait_on_jobs
+        if local_backend not in LOCAL_BACKENDS:
+            self.main_logger.error("Unknown local backend %s (must be one " \
+                                   "of: %s)" %(local_backend,
+                                               ", ".join(LOCAL_BACKENDS)))
+            sys.exit(1)
+        self.local_backend = local_backend
+        # Databases are written in SQLite's WAL mode, which does not
+        # work when jobs on different hosts write them over a shared
+        # filesystem
+        if self.use_cluster and (Settings.get_output_format() == "miso_db"):
+            self.main_logger.error("output_format = miso_db cannot be used " \
+                                   "with --use-cluster. Use the miso or " \
+                                   "miso_bin output format and pack the " \
+                                   "output with miso_pack instead.")
+            sys.exit(1)
+        self.max_task_retries = max_task_retries
+        self.chrom_sweep = chrom_sweep
+        # Estimated cost and region of each gene, computed
+        # when first needed
+        self.gene_costs = None
+        self.gene_regions = None
         # if chunk_jobs not given (i.e. set to False),
         # then set it to arbitrary value
         if not self.chunk_jobs:
@@ -152,11 +247,228 @@ class GenesDispatcher:
         self.batch_filenames = self.output_batch_files()
 
 
+    def get_gene_regions(self):
+        """
+        Return mapping from gene IDs to their region (chromosome,
+        start and end) and number of isoforms. Genes are loaded
+        one indexed file at a time.
+        """
+        if self.gene_regions is not None:
+            return self.gene_regions
+        gene_ids_by_index = defaultdict(list)
+        for gene_id in self.gene_ids:
+            if gene_id in self.gene_ids_to_gff_index:
+                index_fname = self.gene_ids_to_gff_index[gene_id]
+                gene_ids_by_index[index_fname].append(gene_id)
+        self.gene_regions = {}
+        for index_fname, gene_ids in gene_ids_by_index.iteritems():
+            gff_genes = gff_utils.load_indexed_gff_file(index_fname,
+                                                        gene_ids=gene_ids)
+            if gff_genes is None:
+                continue
+            for gene_id in gene_ids:
+                if gene_id not in gff_genes:
+                    continue
+                gene_info = gff_genes[gene_id]
+                gene_obj = gene_info['gene_object']
+                tx_start, tx_end = \
+                    gff_utils.get_inclusive_txn_bounds(\
+                        gene_info['hierarchy'][gene_id])
+                self.gene_regions[gene_id] = (gene_obj.chrom,
+                                              tx_start,
+                                              tx_end,
+                                              len(gene_obj.isoforms))
+        return self.gene_regions
+
+
+    def get_gene_costs(self):
+        """
+        Return mapping from gene IDs to the estimated cost of
+        running MISO on them: the number of reads in the gene's
+        span, times its number of isoforms, times the number of
+        sampler iterations.
+
+        Reads are counted up to MAX_COST_READS per gene, so that
+        highly expressed genes do not make estimating costs slow.
+        """
+        if self.gene_costs is not None:
+            return self.gene_costs
+        print "Estimating the cost of %d genes..." %(len(self.gene_ids))
+        t1 = time.time()
+        num_iters = Settings.get_sampler_params()["num_iters"]
+        bamfile = pysam.Samfile(self.bam_filename, "rb")
+        self.gene_costs = defaultdict(int)
+        for gene_id, (chrom, tx_start, tx_end, num_isoforms) \
+            in self.get_gene_regions().iteritems():
+            num_reads = \
+                sam_utils.count_bam_reads_in_gene(bamfile, chrom,
+                                                  tx_start, tx_end,
+                                                  max_reads=MAX_COST_READS)
+            self.gene_costs[gene_id] = \
+                (num_reads + 1) * num_isoforms * num_iters
+        bamfile.close()
+        t2 = time.time()
+        print "  - Estimating costs took %.2f seconds" %(t2 - t1)
+        return self.gene_costs
+
+
+    def get_gene_groups(self):
+        """
+        Return the genes to run as groups of gene IDs that must
+        be run together: groups of genes with overlapping regions
+        when sweeping over chromosomes (so that their reads are
+        read once), and otherwise single genes.
+        """
+        if not self.chrom_sweep:
+            return [[gene_id] for gene_id in self.gene_ids]
+        gene_regions = self.get_gene_regions()
+        genes_by_chrom = defaultdict(list)
+        gene_groups = []
+        for gene_id in self.gene_ids:
+            if gene_id not in gene_regions:
+                gene_groups.append([gene_id])
+                continue
+            chrom, tx_start, tx_end, num_isoforms = gene_regions[gene_id]
+            genes_by_chrom[chrom].append((gene_id, tx_start, tx_end))
+        for chrom, chrom_genes in genes_by_chrom.iteritems():
+            chrom_genes.sort(key=lambda gene: gene[1])
+            for start, end, cluster_genes in \
+                sam_utils.merge_gene_regions(chrom_genes):
+                gene_groups.append([gene[0] for gene in cluster_genes])
+        return gene_groups
+
+
+    def get_gene_tasks(self):
+        """
+        Return the tasks to run on the local pool. Each task is
+        a task number and a list of (gene ID, indexed GFF filename)
+        pairs; tasks consist of a single gene (or, when sweeping
+        over chromosomes, a group of overlapping genes) so that
+        genes are dealt out to the workers as they become free.
+
+        Tasks are ordered by decreasing cost, so that the most
+        costly genes are started first and the workers finish
+        at about the same time.
+
+        When events are sampled in batches (the batch_events
+        setting), groups are instead dealt into a few tasks per
+        worker of about equal cost, so that each task has many
+        events to batch.
+        """
+        gene_costs = self.get_gene_costs()
+        group_cost = lambda group: sum([gene_costs[gene_id] \
+                                        for gene_id in group])
+        gene_groups = sorted(self.get_gene_groups(), key=group_cost,
+                             reverse=True)
+        sampler_params = Settings.get_sampler_params()
+        if sampler_params["batch_events"]:
+            num_tasks = max(self.num_processors * 4,
+                            int(math.ceil(len(gene_groups) / \
+                                          float(sampler_params["batch_size"]))))
+            gene_groups = \
+                cluster_utils.chunk_list_by_cost(gene_groups,
+                                                 map(group_cost, gene_groups),
+                                                 num_tasks)
+            gene_groups = [[gene_id for group in chunk for gene_id in group]
+                           for chunk in gene_groups]
+            gene_groups.sort(key=group_cost, reverse=True)
+        tasks = []
+        for gene_group in gene_groups:
+            genes = []
+            for gene_id in gene_group:
+                if gene_id not in self.gene_ids_to_gff_index:
+                    print "Skipping: %s" %(gene_id)
+                    continue
+                index_fname = self.gene_ids_to_gff_index[gene_id]
+                genes.append((gene_id, index_fname))
+            if len(genes) > 0:
+                tasks.append((len(tasks), genes))
+        return tasks
+
+
+    def run_pool(self):
+        """
+        Run genes locally on a pool of worker processes, which
+        compute Psi directly (without going through run_miso.py).
+        Failed tasks are retried up to max_task_retries times.
+        """
+        paired_end = None
+        if self.paired_end != None:
+            paired_end = float(self.paired_end[0]), \
+                         float(self.paired_end[1])
+        params = {"bam_filename": self.bam_filename,
+                  "output_dir": self.output_dir,
+                  "read_len": self.read_len,
+                  "overhang_len": self.overhang_len,
+                  "paired_end": paired_end,
+                  "event_type": None,
+                  "chrom_sweep": self.chrom_sweep}
+        tasks = self.get_gene_tasks()
+        num_genes = sum([len(genes) for task_num, genes in tasks])
+        print "Running %d genes on %d processes..." %(num_genes,
+                                                      self.num_processors)
+        print "  - Output of the processes is in: %s" %(self.batch_logs_dir)
+        t_start = time.time()
+        num_done = 0
+        failed_tasks = []
+        for attempt in range(self.max_task_retries + 1):
+            if len(tasks) == 0:
+                break
+            if attempt > 0:
+                print "Retrying %d failed tasks (attempt %d of %d)..." \
+                      %(len(tasks), attempt, self.max_task_retries)
+            tasks_by_num = dict(tasks)
+            failed_tasks = []
+            pool = multiprocessing.Pool(processes=self.num_processors,
+                                        initializer=init_pool_worker,
+                                        initargs=(self.settings_fname,
+                                                  params,
+                                                  self.batch_logs_dir))
+            try:
+                for task_num, task_size, duration, error in \
+                    pool.imap_unordered(run_pool_task, tasks, chunksize=1):
+                    if error is not None:
+                        failed_tasks.append((task_num, tasks_by_num[task_num]))
+                        self.main_logger.warning("Task %d failed: %s" \
+                                                 %(task_num,
+                                                   error.strip().split("\n")[-1]))
+                        continue
+                    num_done += task_size
+                    elapsed = time.time() - t_start
+                    remaining = \
+                        (elapsed / num_done) * (num_genes - num_done)
+                    print "Completed %d of %d genes (%.1f%%) in %.1f mins " \
+                          "(about %.1f mins left)" \
+                          %(num_done, num_genes,
+                            (num_done / float(num_genes)) * 100,
+                            elapsed / 60., remaining / 60.)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            tasks = failed_tasks
+        if len(failed_tasks) > 0:
+            failed_genes = [gene_id for task_num, genes in failed_tasks \
+                            for gene_id, index_fname in genes]
+            self.main_logger.error("Failed to compute Psi for %d genes: %s" \
+                                   %(len(failed_genes),
+                                     ", ".join(failed_genes)))
+        t_end = time.time()
+        duration = ((t_end - t_start) / 60.) / 60.
+        self.main_logger.info("Pool completed in %.2f hours." %(duration))
+
+
     def output_batch_files(self):
         """
         Output a series of batch files containing
         gene IDs and their indexed GFF filenames.
 
+        Genes that must run together (see get_gene_groups) are
+        put in the same batch, and batches are of about equal
+        estimated cost (see get_gene_costs.)
+
         Return the batch filenames and their size.
         """
         batch_filenames = []
@@ -167,9 +479,21 @@ class GenesDispatcher:
             # When not using cluster, use local multi-cores
             # using default number of processors
             num_chunks = self.num_processors
-        gene_ids_batches = cluster_utils.chunk_list(self.gene_ids,
-                                                    num_chunks)
-        for batch_num, gene_ids_batch in enumerate(gene_ids_batches):
+        gene_costs = self.get_gene_costs()
+        gene_groups = self.get_gene_groups()
+        group_costs = [sum([gene_costs[gene_id] for gene_id in group]) \
+                       for group in gene_groups]
+        group_nums = range(len(gene_groups))
+        gene_groups_batches = []
+        for batch_group_nums in \
+            cluster_utils.chunk_list_by_cost(group_nums, group_costs,
+                                             num_chunks):
+            # Keep the genes of a batch in their original order
+            gene_groups_batches.append([gene_groups[group_num] \
+                                        for group_num in sorted(batch_group_nums)])
+        for batch_num, gene_groups_batch in enumerate(gene_groups_batches):
+            gene_ids_batch = [gene_id for group in gene_groups_batch \
+                              for gene_id in group]
             batch_size = len(gene_ids_batch)
             batch_fname = os.path.join(self.batch_genes_dir,
                                        "batch-%d_genes.txt" %(batch_num))
@@ -193,6 +517,9 @@ class GenesDispatcher:
         Run batches either locally on multi-cores
         or using cluster.
         """
+        if (not self.use_cluster) and (self.local_backend == "pool"):
+            self.run_pool()
+            return
         batch_filenames = self.output_batch_files()
         # All MISO commands, each correspond to a batch,
         # and the number of jobs in each batch
@@ -222,6 +549,8 @@ class GenesDispatcher:
             else:
                 # Overhang len only used in single-end mode
                 miso_cmd += " --overhang-len %d" %(self.overhang_len)
+            if self.chrom_sweep:
+                miso_cmd += " --chrom-sweep"
             # Add settings filename if given
             if self.settings_fname != None:
                 miso_cmd += " --settings-filename %s" \
@@ -348,7 +677,9 @@ def compute_all_genes_psi(gff_dir, bam_filename, read_len,
                           job_name="misojob",
                           num_proc=None,
                           prefilter=False,
-                          wait_on_jobs=True):
+                          wait_on_jobs=True,
+                          local_backend="pool",
+                          chrom_sweep=False):
     """
     Compute Psi values for genes using a GFF and a BAM filename.
 
@@ -358,6 +689,11 @@ def compute_all_genes_psi(gff_dir, bam_filename, read_len,
     - prefilter: if set to True, prefilter events by coverage.
       Uses bedtools to determine coverage of each event and remove
       events that do not meet the coverage criteria from the run.
+    - local_backend: how to run locally; 'pool' (a pool of
+      processes computing Psi directly) or 'subprocess' (one
+      run_miso.py process per batch of genes).
+    - chrom_sweep: if set to True, read the reads of overlapping
+      genes from the BAM file once, in a sweep over their region.
     """
     print "Computing Psi values..."
     print "  - GFF index: %s" %(gff_dir)
@@ -421,7 +757,9 @@ def compute_all_genes_psi(gff_dir, bam_filename, read_len,
                                  SGEarray=SGEarray,
                                  gene_ids=all_gene_ids,
                                  num_proc=num_proc,
-                                 wait_on_jobs=wait_on_jobs)
+                                 wait_on_jobs=wait_on_jobs,
+                                 local_backend=local_backend,
+                                 chrom_sweep=chrom_sweep)
     dispatcher.run()
 
 
@@ -493,6 +831,21 @@ def main():
                       help="Number of processors to use. Only applies when running " \
                       "MISO on a single machine with multiple cores; does not apply " \
                       "to runs submitted to cluster with --use-cluster.")
+    parser.add_option("--local-backend", dest="local_backend",
+                      type="choice", choices=LOCAL_BACKENDS, default="pool",
+                      help="How to run MISO on a single machine: 'pool' "
+                      "runs genes on a pool of processes that take the "
+                      "next gene as soon as they finish one, retrying "
+                      "failed genes; 'subprocess' runs one run_miso.py "
+                      "process per batch of genes. Default is pool. "
+                      "Does not apply to runs submitted to cluster.")
+    parser.add_option("--chrom-sweep", dest="chrom_sweep", default=False,
+                      action="store_true",
+                      help="Read the reads of overlapping genes from the "
+                      "BAM file once, sweeping over their region and "
+                      "dispatching each read to the genes it overlaps, "
+                      "rather than fetching the reads of each gene "
+                      "separately. Overlapping genes are run together.")
     parser.add_option("--version", dest="version", default=False,
                       action="store_true",
                       help="Print MISO version.")
@@ -588,7 +941,9 @@ def main():
                               settings_fname=settings_filename,
                               prefilter=options.prefilter,
                               num_proc=options.num_proc,
-                              wait_on_jobs=wait_on_jobs)
+                              wait_on_jobs=wait_on_jobs,
+                              local_backend=options.local_backend,
+                              chrom_sweep=options.chrom_sweep)
 
     if options.view_gene != None:
         indexed_gene_filename = \
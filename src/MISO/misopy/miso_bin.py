@@ -0,0 +1,276 @@
+##
+## Binary representation of MISO samples
+##
+## Stores the samples of an event as a *.miso_bin file: the Psi
+## samples of each isoform and the log scores are kept as binary
+## columns that can be memory-mapped, instead of formatted text
+## that must be parsed. The header line of the *.miso file
+## ('#isoforms=...') is kept as is.
+##
+## File layout:
+##
+##   - magic string (8 bytes)
+##   - length of the JSON header (unsigned 32-bit little-endian)
+##   - JSON header, padded with spaces so the data is 16-byte aligned
+##   - Psi samples, one column of num_samples values per isoform
+##   - log scores (float64), starting at a 16-byte aligned offset
+##
+import os
+import sys
+import json
+import struct
+
+import numpy as np
+
+import misopy.misc_utils as misc_utils
+
+# File extension for binary MISO samples
+MISO_BIN_EXT = ".miso_bin"
+MISO_BIN_MAGIC = "MISOBIN\x01"
+# Data types that Psi samples can be stored as
+MISO_BIN_PSI_DTYPES = ["float32", "float16"]
+# Log scores are large in magnitude, so they are kept as doubles
+# to print back as the same %.2f values
+LOG_SCORE_DTYPE = "<f8"
+# Data type of the log scores of files that do not record it
+OLD_LOG_SCORE_DTYPE = "<f4"
+DATA_ALIGNMENT = 16
+
+
+def align_offset(offset):
+    return offset + ((-offset) % DATA_ALIGNMENT)
+
+
+def write_samples_bin(bin_fname, header, psi_vectors, log_scores,
+                      psi_dtype="float32"):
+    """
+    Write samples to a *.miso_bin file. The header is the
+    '#isoforms=...' header line of the *.miso format.
+    """
+    if psi_dtype not in MISO_BIN_PSI_DTYPES:
+        raise Exception, "Unknown Psi data type %s" %(psi_dtype)
+    psi_vectors = np.asarray(psi_vectors,
+                             dtype=np.dtype(psi_dtype).newbyteorder("<"))
+    log_scores = np.asarray(log_scores, dtype=LOG_SCORE_DTYPE)
+    num_samples = len(log_scores)
+    if num_samples == 0:
+        psi_vectors = psi_vectors.reshape((0, 0))
+    num_isoforms = psi_vectors.shape[1]
+    psi_nbytes = num_samples * num_isoforms * psi_vectors.itemsize
+    header_info = {"header": header.rstrip("\n"),
+                   "num_isoforms": num_isoforms,
+                   "num_samples": num_samples,
+                   "psi_dtype": psi_dtype,
+                   "log_score_dtype": LOG_SCORE_DTYPE,
+                   # Offset of the log scores from the start of the data
+                   "log_scores_offset": align_offset(psi_nbytes)}
+    json_header = json.dumps(header_info)
+    prefix_len = len(MISO_BIN_MAGIC) + 4
+    json_header += " " * (align_offset(prefix_len + len(json_header)) - \
+                          prefix_len - len(json_header))
+    with open(bin_fname, "wb") as bin_file:
+        bin_file.write(MISO_BIN_MAGIC)
+        bin_file.write(struct.pack("<I", len(json_header)))
+        bin_file.write(json_header)
+        # Store each isoform's samples contiguously
+        bin_file.write(np.ascontiguousarray(psi_vectors.T).tostring())
+        bin_file.write("\0" * (header_info["log_scores_offset"] - psi_nbytes))
+        bin_file.write(log_scores.tostring())
+
+
+def read_bin_header(bin_file):
+    """
+    Read the header of an open *.miso_bin file. Return the header
+    information and the offset of the data.
+    """
+    magic = bin_file.read(len(MISO_BIN_MAGIC))
+    if magic != MISO_BIN_MAGIC:
+        raise Exception, "%s is not a MISO binary samples file." \
+              %(bin_file.name)
+    json_len = struct.unpack("<I", bin_file.read(4))[0]
+    header_info = json.loads(bin_file.read(json_len))
+    header_info["header"] = str(header_info["header"])
+    data_offset = len(MISO_BIN_MAGIC) + 4 + json_len
+    return header_info, data_offset
+
+
+def load_samples_bin(bin_fname, mmap=True):
+    """
+    Load samples from a *.miso_bin file. Return the header line,
+    the Psi samples (an array of num_samples by num_isoforms) and
+    the log scores.
+
+    If mmap is True, the arrays are memory-mapped from the file
+    rather than read into memory. They are copy-on-write, so
+    changing them does not change the file.
+    """
+    with open(bin_fname, "rb") as bin_file:
+        header_info, data_offset = read_bin_header(bin_file)
+        num_isoforms = header_info["num_isoforms"]
+        num_samples = header_info["num_samples"]
+        psi_dtype = np.dtype(str(header_info["psi_dtype"])).newbyteorder("<")
+        log_score_dtype = str(header_info.get("log_score_dtype",
+                                              OLD_LOG_SCORE_DTYPE))
+        if num_samples == 0:
+            return header_info["header"], \
+                   np.zeros((0, num_isoforms), dtype=psi_dtype), \
+                   np.zeros(0, dtype=log_score_dtype)
+        log_scores_offset = data_offset + header_info["log_scores_offset"]
+        if mmap:
+            psi_columns = np.memmap(bin_file, dtype=psi_dtype, mode="c",
+                                    offset=data_offset,
+                                    shape=(num_isoforms, num_samples))
+            log_scores = np.memmap(bin_file, dtype=log_score_dtype, mode="c",
+                                   offset=log_scores_offset,
+                                   shape=(num_samples,))
+        else:
+            psi_columns = np.fromfile(bin_file, dtype=psi_dtype,
+                                      count=num_isoforms * num_samples)
+            psi_columns = psi_columns.reshape((num_isoforms, num_samples))
+            bin_file.seek(log_scores_offset)
+            log_scores = np.fromfile(bin_file, dtype=log_score_dtype,
+                                     count=num_samples)
+    # Samples by isoforms, without copying the columns
+    return header_info["header"], psi_columns.T, log_scores
+
+
+def load_miso_file_samples(miso_fname):
+    """
+    Load the header line, Psi samples and log scores of a
+    plain-text *.miso file.
+    """
+    with open(miso_fname) as miso_file:
+        header = miso_file.readline().rstrip("\n")
+        # Skip the sampled_psi/log_score fields line
+        miso_file.readline()
+        psi_vectors = []
+        log_scores = []
+        for line in miso_file:
+            psi_field, log_score_field = line.split("\t")
+            psi_vectors.append([float(v) for v in psi_field.split(",")])
+            log_scores.append(float(log_score_field))
+    return header, psi_vectors, log_scores
+
+
+def miso_file_to_bin(miso_fname, bin_fname=None, psi_dtype="float32"):
+    """
+    Convert a *.miso file into a *.miso_bin file. Return the
+    *.miso_bin filename.
+    """
+    if bin_fname is None:
+        bin_fname = "%s%s" %(strip_ext(miso_fname, ".miso"), MISO_BIN_EXT)
+    header, psi_vectors, log_scores = load_miso_file_samples(miso_fname)
+    write_samples_bin(bin_fname, header, psi_vectors, log_scores,
+                      psi_dtype=psi_dtype)
+    return bin_fname
+
+
+def bin_to_miso_file(bin_fname, miso_fname=None):
+    """
+    Convert a *.miso_bin file into a *.miso file. Return the
+    *.miso filename.
+    """
+    if miso_fname is None:
+        miso_fname = "%s.miso" %(strip_ext(bin_fname, MISO_BIN_EXT))
+    header, psi_vectors, log_scores = load_samples_bin(bin_fname, mmap=False)
+    num_isoforms = psi_vectors.shape[1]
+    sample_format = ",".join(["%.4f"] * num_isoforms) + "\t%.2f"
+    with open(miso_fname, "w") as miso_file:
+        miso_file.write("%s\n" %(header))
+        miso_file.write("sampled_psi\tlog_score\n")
+        for psi_sample, log_score in zip(psi_vectors.tolist(),
+                                         log_scores.tolist()):
+            miso_file.write(sample_format %(tuple(psi_sample) + (log_score,)))
+            miso_file.write("\n")
+    return miso_fname
+
+
+def convert_dir(dirname, to_bin=True, psi_dtype="float32"):
+    """
+    Convert the *.miso files in a MISO output directory (and its
+    subdirectories) into *.miso_bin files, or the other way around
+    if to_bin is False. The converted files are removed.
+    """
+    if to_bin:
+        input_ext = ".miso"
+    else:
+        input_ext = MISO_BIN_EXT
+    num_converted = 0
+    for curr_dir, subdirs, fnames in os.walk(dirname):
+        for fname in fnames:
+            if not fname.endswith(input_ext):
+                continue
+            input_fname = os.path.join(curr_dir, fname)
+            if to_bin:
+                miso_file_to_bin(input_fname, psi_dtype=psi_dtype)
+            else:
+                bin_to_miso_file(input_fname)
+            os.remove(input_fname)
+            num_converted += 1
+    print "Converted %d files in %s" %(num_converted, dirname)
+
+
+def is_miso_bin_fname(fname):
+    """
+    Return True if it's a MISO binary samples filename, like
+    myevent.miso_bin
+    """
+    return str(fname).endswith(MISO_BIN_EXT)
+
+
+def strip_ext(fname, ext):
+    if fname.endswith(ext):
+        return fname[0:-1*len(ext)]
+    return fname
+
+
+def greeting(parser=None):
+    print "MISO (Mixture of Isoforms model)"
+    print "Convert MISO samples between the text (*.miso) and " \
+          "binary (*.miso_bin) formats."
+    print "Use --help argument to view options.\n"
+    print "Example usage:\n"
+    print "miso_bin --to-bin mydir"
+    if parser is not None:
+        parser.print_help()
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--to-bin", dest="to_bin",
+                      nargs=1, default=None,
+                      help="Convert the *.miso files in a MISO output "
+                      "directory (or comma-separated directories) into "
+                      "binary *.miso_bin files.")
+    parser.add_option("--to-text", dest="to_text",
+                      nargs=1, default=None,
+                      help="Convert the *.miso_bin files in a MISO output "
+                      "directory (or comma-separated directories) into "
+                      "text *.miso files.")
+    parser.add_option("--psi-dtype", dest="psi_dtype",
+                      default="float32",
+                      help="Data type to store Psi samples as with --to-bin: "
+                      "float32 (default) or float16.")
+    (options, args) = parser.parse_args()
+
+    if (options.to_bin is None) and (options.to_text is None):
+        greeting()
+        sys.exit(1)
+
+    if options.psi_dtype not in MISO_BIN_PSI_DTYPES:
+        print "Error: Invalid --psi-dtype %s" %(options.psi_dtype)
+        sys.exit(1)
+
+    if options.to_bin is not None:
+        for dirname in options.to_bin.split(","):
+            convert_dir(misc_utils.pathify(dirname), to_bin=True,
+                        psi_dtype=options.psi_dtype)
+
+    if options.to_text is not None:
+        for dirname in options.to_text.split(","):
+            convert_dir(misc_utils.pathify(dirname), to_bin=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,9 @@ import shutil
 import fnmatch
 import glob
 import StringIO
+import urllib
+import zlib
+import multiprocessing
 
 import misopy
 import misopy.misc_utils as misc_utils
@@ -18,11 +21,31 @@ import misopy.miso_utils as miso_utils
 
 # File extension for MISO SQLite databases
 MISO_DB_EXT = ".miso_db"
+# Columns of the table of a MISO database. Event names are the
+# primary key, so that looking up an event uses its index
+MISO_DB_TABLE_COLUMNS = \
+    "(event_name text PRIMARY KEY, psi_vals_and_scores text, header text)"
+# Table of information about a MISO database, e.g. how its
+# samples are compressed
+MISO_DB_INFO_TABLE = "miso_db_info"
+# Ways that the samples of a database can be compressed
+MISO_DB_COMPRESSIONS = ["zlib"]
+# zlib compression level of samples: faster than the default level,
+# at a small cost in size
+ZLIB_LEVEL = 3
+# Number of events inserted together when packing a directory
+PACK_BATCH_SIZE = 1000
+# Page cache of databases opened for reading, in KiB
+READ_CACHE_KIB = 16384
+# Largest number of events to fetch in one query (SQLite allows
+# at most 999 parameters in a query)
+MAX_QUERY_EVENTS = 500
 
 
 class MISODatabase:
     """
-    Representation of a MISO SQLite database.
+    Representation of a MISO SQLite database, opened for reading.
+    The database must not be written to while it is open.
     """
     def __init__(self, db_fname, comp_to_uncomp=None):
         self.comp_to_uncomp = comp_to_uncomp
@@ -43,7 +66,9 @@ class MISODatabase:
             print "Error: Cannot retrieve name of MISO db file %s" \
                   %(self.db_fname)
             return None
-        self.conn = sqlite3.connect(self.db_fname)
+        self.conn = connect_read_only(self.db_fname)
+        # Compression of the samples, if any
+        self.compression = get_db_info(self.conn).get("compression")
         # Determine event name format
         self.is_db_events_compressed = self.is_event_name_compressed()
 
@@ -55,16 +80,20 @@ class MISODatabase:
         """
         c = self.conn.cursor()
         results = \
-          c.execute("SELECT * from %s" %(self.table_name))
+          c.execute("SELECT event_name FROM %s LIMIT 1" %(self.table_name))
         first_result = results.fetchone()
+        if first_result is None:
+            # Empty database
+            return False
         event_name = str(first_result[0])
         is_comp = misc_utils.is_compressed_name(event_name)
         return is_comp
 
 
-    def get_event_data_as_stream(self, event_name):
+    def get_event_name_to_query(self, event_name):
         """
-        Get data for given event. If there's no data, return None.
+        Return the name that the given event is stored as in the
+        database, or None if it cannot be in the database.
         """
         # The name of the event as stored in database (if using
         # compressed event IDs, this would be a misocomp ID)
@@ -95,11 +124,23 @@ class MISODatabase:
             if event_name not in self.comp_to_uncomp:
                 return None
             event_to_query = self.comp_to_uncomp[event_name]
+        return event_to_query
+
+
+    def get_event_data_as_stream(self, event_name):
+        """
+        Get data for given event. If there's no data, return None.
+        """
+        event_to_query = self.get_event_name_to_query(event_name)
+        if event_to_query is None:
+            return None
         c = self.conn.cursor()
+        # Fetching a second row detects duplicate entries in
+        # databases made before event names were primary keys
         results = \
-          c.execute("SELECT * from %s WHERE event_name=\'%s\'" \
-                    %(self.table_name,
-                      event_to_query))
+          c.execute("SELECT psi_vals_and_scores, header FROM %s " \
+                    "WHERE event_name=? LIMIT 2" %(self.table_name),
+                    (event_to_query,))
         rows = results.fetchall()
         if len(rows) == 0:
             # Event not found
@@ -107,14 +148,71 @@ class MISODatabase:
         if len(rows) > 1:
             raise Exception, \
               "More than one entry for event %s" %(event_to_query)
-        event_name, psi_vals_and_scores, header = rows[0]
-        # If we're given a mapping to compressed events,
-        # return the event name as the *uncompressed* event
-        # name
+        psi_vals_and_scores, header = rows[0]
+        return self.make_event_stream(header, psi_vals_and_scores)
+
+
+    def make_event_stream(self, header, psi_vals_and_scores):
+        """
+        Return the data of an event, as stored in the database, as
+        a stream in the *.miso format.
+        """
+        psi_vals_and_scores = decode_samples(psi_vals_and_scores,
+                                             self.compression)
         event_data = "%s\n%s\n" %(header,
                                   psi_vals_and_scores)
-        event_stream = StringIO.StringIO(event_data)
-        return event_stream
+        return StringIO.StringIO(event_data)
+
+
+    def get_events_data_as_streams(self, event_names):
+        """
+        Get data for the given events, fetching many events per
+        query. Return a dictionary from the names of the events
+        that are in the database to their data.
+        """
+        names_to_query = {}
+        for event_name in event_names:
+            event_to_query = self.get_event_name_to_query(event_name)
+            if event_to_query is not None:
+                names_to_query[event_to_query] = event_name
+        events_to_query = names_to_query.keys()
+        events_data = {}
+        c = self.conn.cursor()
+        for n in range(0, len(events_to_query), MAX_QUERY_EVENTS):
+            query_events = events_to_query[n:n + MAX_QUERY_EVENTS]
+            results = \
+              c.execute("SELECT event_name, psi_vals_and_scores, header " \
+                        "FROM %s WHERE event_name IN (%s)" \
+                        %(self.table_name,
+                          ",".join(["?"] * len(query_events))),
+                        query_events)
+            for event_name, psi_vals_and_scores, header in results:
+                event_name = names_to_query[str(event_name)]
+                if event_name in events_data:
+                    raise Exception, \
+                      "More than one entry for event %s" %(event_name)
+                events_data[event_name] = \
+                  self.make_event_stream(header, psi_vals_and_scores)
+        return events_data
+
+
+    def iter_events_data(self):
+        """
+        Iterate over all the events of the database in the order
+        they are stored, yielding (event name, data) pairs. Event
+        names are as stored in the database.
+        """
+        c = self.conn.cursor()
+        results = \
+          c.execute("SELECT event_name, psi_vals_and_scores, header FROM %s" \
+                    %(self.table_name))
+        for event_name, psi_vals_and_scores, header in results:
+            yield str(event_name), \
+                  self.make_event_stream(header, psi_vals_and_scores)
+
+
+    def close(self):
+        self.conn.close()
 
 
     def get_event_data_as_string(self, event_name):
@@ -135,15 +233,140 @@ class MISODatabase:
         """
         Return all event names
         """
-        event_names = []
-        for result in self.get_all_events():
-            event_names.append(result[0])
+        c = self.conn.cursor()
+        results = c.execute("SELECT event_name FROM %s" %(self.table_name))
+        event_names = [result[0] for result in results]
         return event_names
 
 
-def miso_dir_to_db(dir_to_compress, output_filename):
+    def has_event_name_index(self):
+        """
+        Return True if event names are indexed in the database.
+        Databases made before event names were primary keys can be
+        migrated with migrate_miso_db.
+        """
+        return is_event_name_indexed(self.conn, self.table_name)
+
+
+class MISODatabaseWriter:
+    """
+    Writer of MISO samples into a MISO SQLite database, with the
+    same table layout as miso_dir_to_db. Several processes can
+    write to the same database: it is opened in WAL mode, and
+    events are inserted in batched transactions.
+    """
+    def __init__(self, db_fname, batch_size=200, timeout=600):
+        self.db_fname = db_fname
+        self.table_name = "table_%s" %(get_table_name_from_file(db_fname))
+        self.batch_size = batch_size
+        # Wait for other writers rather than failing when the
+        # database is locked
+        self.conn = sqlite3.connect(self.db_fname, timeout=timeout)
+        self.conn.text_factory = str
+        c = self.conn.cursor()
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("CREATE TABLE IF NOT EXISTS %s %s" \
+                  %(self.table_name, MISO_DB_TABLE_COLUMNS))
+        self.conn.commit()
+        # Compress samples like those already in the database
+        self.compression = get_db_info(self.conn).get("compression")
+        # Events waiting to be inserted
+        self.pending_events = {}
+
+
+    def has_event(self, event_name):
+        """
+        Return True if the event is in the database (or waiting
+        to be inserted.)
+        """
+        if event_name in self.pending_events:
+            return True
+        c = self.conn.cursor()
+        c.execute("SELECT 1 FROM %s WHERE event_name=?" %(self.table_name),
+                  (event_name,))
+        return c.fetchone() is not None
+
+
+    def add_event(self, event_name, header, psi_vals_and_scores):
+        """
+        Add an event's samples. The header consists of the two
+        header lines of the event's *.miso file.
+        """
+        self.pending_events[event_name] = (psi_vals_and_scores, header)
+        if len(self.pending_events) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Insert the pending events in one transaction.
+        """
+        if len(self.pending_events) == 0:
+            return
+        rows = [(event_name,
+                 encode_samples(psi_vals_and_scores, self.compression),
+                 header) \
+                for event_name, (psi_vals_and_scores, header) \
+                in self.pending_events.iteritems()]
+        c = self.conn.cursor()
+        c.executemany("INSERT INTO %s VALUES (?, ?, ?)" %(self.table_name),
+                      rows)
+        self.conn.commit()
+        self.pending_events = {}
+
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+# Open database writers of the current process, keyed by
+# database filename
+db_writers = {}
+
+def get_miso_db_writer(db_fname):
+    """
+    Return the current process's writer for the given MISO
+    database, opening it if needed.
+    """
+    if db_fname not in db_writers:
+        db_writers[db_fname] = MISODatabaseWriter(db_fname)
+    return db_writers[db_fname]
+
+
+def close_miso_db_writers():
+    """
+    Write pending events and close all the database writers
+    of the current process.
+    """
+    for db_fname in db_writers.keys():
+        db_writers.pop(db_fname).close()
+
+
+def get_miso_db_location(miso_filename):
+    """
+    Return the MISO database and event name that the samples of
+    the given *.miso file are stored as when writing straight to
+    databases, e.g. outdir/chr1/myevent.miso is stored as
+    myevent in outdir/chr1.miso_db (as miso_pack would pack it.)
+    """
+    chrom_dir = os.path.dirname(os.path.normpath(miso_filename))
+    db_fname = "%s%s" %(chrom_dir, MISO_DB_EXT)
+    event_name = strip_miso_ext(os.path.basename(miso_filename))
+    return db_fname, event_name
+
+
+def miso_dir_to_db(dir_to_compress, output_filename,
+                   compression=None,
+                   batch_size=PACK_BATCH_SIZE):
     """
     Convert MISO directory into MySQL table using sqlite3.
+
+    Events are inserted batch_size at a time in one transaction,
+    into a temporary file that is renamed to output_filename once
+    it's complete. If compression is 'zlib', the samples of each
+    event are stored compressed.
     """
     print "Converting MISO directory into database"
     print "  - MISO dir: %s" %(dir_to_compress)
@@ -151,6 +374,8 @@ def miso_dir_to_db(dir_to_compress, output_filename):
     if not os.path.isdir(dir_to_compress):
         print "Error: %s not a directory, aborting." %(dir_to_compress)
         sys.exit(1)
+    if (compression is not None) and (compression not in MISO_DB_COMPRESSIONS):
+        raise Exception, "Unknown compression %s" %(compression)
     miso_filenames = glob.glob(os.path.join(dir_to_compress, "*.miso"))
     num_files = len(miso_filenames)
     print "  - %d files to compress" %(num_files)
@@ -159,18 +384,31 @@ def miso_dir_to_db(dir_to_compress, output_filename):
         print "Error: Database %s already exists, aborting." \
               %(output_filename)
         return None
-    conn = sqlite3.connect(output_filename)
+    temp_filename = "%s.tmp" %(output_filename)
+    if os.path.isfile(temp_filename):
+        os.remove(temp_filename)
+    conn = sqlite3.connect(temp_filename)
+    conn.text_factory = str
     c = conn.cursor()
+    # The database is only used once it's complete, so it needs
+    # no journal
+    c.execute("PRAGMA journal_mode=OFF")
+    c.execute("PRAGMA synchronous=OFF")
     # Create table for the current directory to compress
     table_name = "table_%s" %(os.path.basename(dir_to_compress))
     sql_create = \
-        "CREATE TABLE %s " %(table_name) + \
-        "(event_name text, psi_vals_and_scores text, header text)"
+        "CREATE TABLE %s %s" %(table_name, MISO_DB_TABLE_COLUMNS)
     c.execute(sql_create)
+    if compression is not None:
+        set_db_info(conn, {"compression": compression})
+    sql_insert = "INSERT INTO %s VALUES (?, ?, ?)" %(table_name)
+    rows = []
     for miso_fname in miso_filenames:
         miso_file_fields = load_miso_file_as_str(miso_fname)
         if miso_file_fields is None:
             print "Error: Cannot compress %s. Aborting." %(miso_fname)
+            conn.close()
+            os.remove(temp_filename)
             return None
         header, psi_vals_and_scores = miso_file_fields
         ######
@@ -178,16 +416,208 @@ def miso_dir_to_db(dir_to_compress, output_filename):
         ###### HANDLE COMPRESSED EVENT IDS HERE
         ######
         event_name = strip_miso_ext(os.path.basename(miso_fname))
-        sql_insert = "INSERT INTO %s VALUES (?, ?, ?)" %(table_name)
-        c.execute(sql_insert, (event_name,
-                               psi_vals_and_scores,
-                               header))
+        rows.append((event_name,
+                     encode_samples(psi_vals_and_scores, compression),
+                     header))
+        if len(rows) >= batch_size:
+            c.executemany(sql_insert, rows)
+            rows = []
+    c.executemany(sql_insert, rows)
     # Commit changes and close the database
     conn.commit()
     conn.close()
+    os.rename(temp_filename, output_filename)
     return output_filename
 
 
+def pack_miso_dir(dir_and_db_fname, compression=None, remove_dir=True):
+    """
+    Pack a *.miso-containing directory into the given MISO database.
+    If remove_dir is True, delete the directory if packing succeeded.
+    Return the database filename, or None if packing failed.
+    """
+    dir_to_compress, db_fname = dir_and_db_fname
+    status = miso_dir_to_db(dir_to_compress, db_fname,
+                            compression=compression)
+    if (status is not None) and remove_dir:
+        shutil.rmtree(dir_to_compress)
+    return status
+
+
+def pack_miso_dirs(dirs_and_db_fnames, compression=None, remove_dirs=True,
+                   num_proc=1):
+    """
+    Pack a list of (directory, database filename) pairs as
+    pack_miso_dir does, on num_proc processes. Return the status
+    of each pair, in order.
+    """
+    params = {"compression": compression,
+              "remove_dir": remove_dirs}
+    if num_proc <= 1:
+        return [pack_miso_dir(dir_and_db_fname, **params) \
+                for dir_and_db_fname in dirs_and_db_fnames]
+    pool = multiprocessing.Pool(processes=num_proc,
+                                initializer=init_pack_worker,
+                                initargs=(params,))
+    try:
+        # Directories are packed one per task, since they can
+        # differ a lot in size
+        statuses = pool.map(pack_worker_dir, dirs_and_db_fnames,
+                            chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return statuses
+
+
+# Parameters of packing worker processes
+pack_params = {}
+
+def init_pack_worker(params):
+    pack_params.update(params)
+
+
+def pack_worker_dir(dir_and_db_fname):
+    return pack_miso_dir(dir_and_db_fname, **pack_params)
+
+
+def encode_samples(psi_vals_and_scores, compression):
+    """
+    Return the samples of an event as stored in a database with
+    the given compression.
+    """
+    if compression is None:
+        return psi_vals_and_scores
+    elif compression == "zlib":
+        return sqlite3.Binary(zlib.compress(psi_vals_and_scores, ZLIB_LEVEL))
+    raise Exception, "Unknown compression %s" %(compression)
+
+
+def decode_samples(psi_vals_and_scores, compression):
+    """
+    Return the samples of an event stored in a database with the
+    given compression.
+    """
+    if compression is None:
+        return psi_vals_and_scores
+    elif compression == "zlib":
+        return zlib.decompress(psi_vals_and_scores)
+    raise Exception, "Unknown compression %s" %(compression)
+
+
+def get_db_info(conn):
+    """
+    Return the information about a MISO database as a dictionary.
+    It's empty for databases that have no information table.
+    """
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+              (MISO_DB_INFO_TABLE,))
+    if c.fetchone() is None:
+        return {}
+    results = c.execute("SELECT key, value FROM %s" %(MISO_DB_INFO_TABLE))
+    return dict([(str(key), str(value)) for key, value in results])
+
+
+def set_db_info(conn, db_info):
+    """
+    Record information about a MISO database.
+    """
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS %s " %(MISO_DB_INFO_TABLE) + \
+              "(key text PRIMARY KEY, value text)")
+    c.executemany("INSERT OR REPLACE INTO %s VALUES (?, ?)" \
+                  %(MISO_DB_INFO_TABLE),
+                  db_info.items())
+
+
+def connect_read_only(db_fname, cache_kib=READ_CACHE_KIB):
+    """
+    Open a connection for reading a MISO database. It's opened in
+    read-only, immutable mode (no locking or change detection) where
+    the sqlite3 module supports URI filenames, and is otherwise
+    opened normally and made read-only.
+    """
+    db_uri = "file:%s?mode=ro&immutable=1" \
+             %(urllib.quote(os.path.abspath(db_fname)))
+    try:
+        conn = sqlite3.connect(db_uri, uri=True)
+    except (TypeError, sqlite3.OperationalError):
+        # URI filenames are not supported (e.g. Python 2) or
+        # the SQLite library does not know immutable mode
+        conn = sqlite3.connect(db_fname)
+        conn.execute("PRAGMA query_only=ON")
+    conn.text_factory = str
+    # Negative cache sizes are in KiB
+    conn.execute("PRAGMA cache_size=-%d" %(cache_kib))
+    return conn
+
+
+def is_event_name_indexed(conn, table_name):
+    """
+    Return True if the event names of the given table have a
+    unique index, e.g. because they are its primary key.
+    """
+    c = conn.cursor()
+    index_list = c.execute("PRAGMA index_list(%s)" %(table_name)).fetchall()
+    for index_row in index_list:
+        # Rows are (seq, name, unique, ...)
+        index_name, is_unique = index_row[1], index_row[2]
+        if not is_unique:
+            continue
+        index_info = \
+          c.execute("PRAGMA index_info(%s)" %(index_name)).fetchall()
+        if [str(info_row[2]) for info_row in index_info] == ["event_name"]:
+            return True
+    return False
+
+
+def migrate_miso_db(db_fname):
+    """
+    Migrate a MISO database made before event names were primary
+    keys, so that events are looked up by index rather than by
+    scanning the table. Return True if the database was migrated,
+    False if it was already indexed.
+    """
+    table_name = "table_%s" %(get_table_name_from_file(db_fname))
+    conn = sqlite3.connect(db_fname)
+    try:
+        if is_event_name_indexed(conn, table_name):
+            return False
+        new_table_name = "%s_migrated" %(table_name)
+        # Manage the transaction explicitly, since the sqlite3 module
+        # otherwise commits before each CREATE/DROP/ALTER statement
+        conn.isolation_level = None
+        c = conn.cursor()
+        # Copy the events into a table with the new layout and
+        # replace the old table in one transaction
+        c.execute("BEGIN")
+        try:
+            c.execute("CREATE TABLE %s %s" %(new_table_name,
+                                             MISO_DB_TABLE_COLUMNS))
+            c.execute("INSERT INTO %s SELECT event_name, psi_vals_and_scores, " \
+                      "header FROM %s" %(new_table_name, table_name))
+            c.execute("DROP TABLE %s" %(table_name))
+            c.execute("ALTER TABLE %s RENAME TO %s" %(new_table_name,
+                                                       table_name))
+        except sqlite3.IntegrityError:
+            c.execute("ROLLBACK")
+            raise Exception, "%s has more than one entry for an event, " \
+                             "cannot migrate it." %(db_fname)
+        except:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+        # Reclaim the space of the old table
+        c.execute("VACUUM")
+    finally:
+        conn.close()
+    return True
+
+
 ##
 ## Misc. helper functions
 ##
@@ -219,13 +649,11 @@ def load_miso_file_as_str(miso_filename):
         print "Error: Cannot find %s" %(miso_filename)
         return None
     header = ""
-    psi_vals_and_scores = ""
     with open(miso_filename) as miso_file:
         # Read the header, consisting of two lines
         for n in range(2):
             header += miso_file.readline()
-        for line in miso_file:
-            psi_vals_and_scores += line
+        psi_vals_and_scores = miso_file.read()
     return header, psi_vals_and_scores
 
 
@@ -7,7 +7,6 @@ import csv
 import time
 import sys
 import subprocess
-import shutil
 from collections import defaultdict
 
 import pysam
@@ -32,8 +31,10 @@ class MISOPacker:
     MISO output and converts any *.miso-containing directories
     into MISO database files (*.miso_db).
     """
-    def __init__(self, dirs_to_pack):
+    def __init__(self, dirs_to_pack, compression=None, num_proc=1):
         self.dirs_to_pack = dirs_to_pack
+        self.compression = compression
+        self.num_proc = num_proc
 
 
     def pack_dirs(self, miso_dirnames):
@@ -45,9 +46,11 @@ class MISOPacker:
 
         This traverses the directory structure and converts raw *.miso text
         containing directory into *.miso_db files that are much more compact
-        and are less of a burden for the filesystem.
+        and are less of a burden for the filesystem. Directories are
+        packed on num_proc processes.
         """
         t1 = time.time()
+        dirs_and_db_fnames = []
         for miso_dirname in miso_dirnames:
             print "Processing: %s" %(miso_dirname)
             if not os.path.isdir(miso_dirname):
@@ -70,10 +73,16 @@ class MISOPacker:
                     # If packed file exists, move on
                     if os.path.isfile(db_fname):
                         continue
-                    status = miso_db.miso_dir_to_db(dir_to_compress, db_fname)
-                    # If packing was successful, delete the input directory
-                    # containing the *.miso file
-                    shutil.rmtree(dir_to_compress)
+                    dirs_and_db_fnames.append((dir_to_compress, db_fname))
+        # If packing was successful, the input directory containing
+        # the *.miso files is deleted
+        statuses = miso_db.pack_miso_dirs(dirs_and_db_fnames,
+                                          compression=self.compression,
+                                          num_proc=self.num_proc)
+        for (dir_to_compress, db_fname), status in zip(dirs_and_db_fnames,
+                                                       statuses):
+            if status is None:
+                print "Error: Failed to pack %s" %(dir_to_compress)
         t2 = time.time()
         print "Packing took %.2f minutes" %((t2 - t1)/60.)
 
@@ -88,17 +97,44 @@ def greeting(parser=None):
         parser.print_help()
 
 
-def pack_miso_output(dirs_to_pack_as_str):
+def pack_miso_output(dirs_to_pack_as_str, compression=None, num_proc=1):
     """
     Pack MISO output into an SQL database.
     """
     dirs_to_pack = dirs_to_pack_as_str.split(",")
     # Make into absolute paths
     dirs_to_pack = map(misc_utils.pathify, dirs_to_pack)
-    miso_packer = MISOPacker(dirs_to_pack)
+    miso_packer = MISOPacker(dirs_to_pack,
+                             compression=compression,
+                             num_proc=num_proc)
     miso_packer.pack_dirs(dirs_to_pack)
 
 
+def migrate_miso_dbs(dirs_to_migrate_as_str):
+    """
+    Migrate the MISO databases in the given directories (and their
+    subdirectories) so that their events are indexed by name.
+    """
+    dirs_to_migrate = map(misc_utils.pathify, dirs_to_migrate_as_str.split(","))
+    num_migrated = 0
+    num_dbs = 0
+    for migrate_dirname in dirs_to_migrate:
+        print "Processing: %s" %(migrate_dirname)
+        if not os.path.isdir(migrate_dirname):
+            print "Error: %s not a directory." %(migrate_dirname)
+            sys.exit(1)
+        for curr_dirname, subdirs, curr_fnames in os.walk(migrate_dirname):
+            for curr_fname in curr_fnames:
+                if not miso_db.is_miso_db_fname(curr_fname):
+                    continue
+                num_dbs += 1
+                db_fname = os.path.join(curr_dirname, curr_fname)
+                if miso_db.migrate_miso_db(db_fname):
+                    print "  - Migrated %s" %(db_fname)
+                    num_migrated += 1
+    print "Migrated %d of %d MISO databases." %(num_migrated, num_dbs)
+
+
 def view_miso_db(db_fname):
     db_fname = misc_utils.pathify(db_fname)
     if not os.path.isfile(db_fname):
@@ -120,17 +156,41 @@ def main():
                       help="Pack a MISO output containing dir(s). Takes as input " \
                       "a directory or a comma-separated set of directories " \
                       "that contain MISO output.")
+    parser.add_option("--compress-samples", dest="compress_samples",
+                      action="store_true", default=False,
+                      help="With --pack, store the samples of each event " \
+                      "zlib-compressed in the database.")
+    parser.add_option("-p", "--num-proc", dest="num_proc",
+                      type="int", default=1,
+                      help="Number of processes to pack directories on " \
+                      "with --pack. Default is 1.")
     parser.add_option("--view", dest="view",
                       nargs=1, default=None,
                       help="View a MISO database (.miso_db file).")
+    parser.add_option("--migrate", dest="migrate",
+                      nargs=1, default=None,
+                      help="Migrate the MISO databases (.miso_db files) in a " \
+                      "directory or a comma-separated set of directories, made " \
+                      "by older versions of MISO, so that their events are " \
+                      "indexed by name. Lookups of events in databases that " \
+                      "are not migrated scan the whole database.")
     (options, args) = parser.parse_args()
 
-    if (options.pack is None) and (options.view is None):
+    if (options.pack is None) and (options.view is None) and \
+       (options.migrate is None):
         greeting()
         sys.exit(1)
 
     if options.pack is not None:
-        pack_miso_output(options.pack)
+        compression = None
+        if options.compress_samples:
+            compression = "zlib"
+        pack_miso_output(options.pack,
+                         compression=compression,
+                         num_proc=options.num_proc)
+
+    if options.migrate is not None:
+        migrate_miso_dbs(options.migrate)
 
     if options.view is not None:
         view_miso_db(options.view)
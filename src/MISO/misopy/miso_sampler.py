@@ -9,16 +9,26 @@
 import scipy
 import misopy
 from misopy.reads_utils import count_aligned_reads, \
-                               count_isoform_assignments
+                               count_isoform_assignments, \
+                               compute_read_classes
 from misopy.read_simulator import simulate_reads, print_reads_summary, \
                                   read_counts_to_read_list, \
                                   get_reads_summary
 import misopy.hypothesis_test as ht
+import misopy.sam_utils as sam_utils
+import misopy.miso_db as miso_db
+import misopy.miso_bin as miso_bin
 from misopy.Gene import Gene, Exon
 from misopy.py2c_gene import *
 
-# C MISO interface
-import pysplicing
+import misopy.numpy_sampler as numpy_sampler
+
+# C MISO interface. It is optional: without it, the NumPy
+# version of the sampler is used
+try:
+    import pysplicing
+except ImportError:
+    pysplicing = None
 
 from scipy import *
 from numpy import *
@@ -36,6 +46,39 @@ import logging.handlers
 
 loggers = {}
 
+# Single-end sampler algorithms of pysplicing. 'reassign' reassigns
+# each read to an isoform on every iteration. 'classes' samples the
+# counts of read classes (reads with the same isoform compatibilities)
+# instead, which is faster but does not weigh isoforms by their
+# length, so its Psi values differ from 'reassign' for isoforms of
+# different lengths. Paired-end reads are always reassigned, since
+# their likelihood depends on the insert length and not only on the
+# read class. The NumPy sampler always samples read classes, with
+# the same model as 'reassign'.
+SAMPLER_ALGORITHMS = {"reassign": "MISO_ALGO_REASSIGN",
+                      "classes": "MISO_ALGO_CLASSES"}
+
+# Sampler implementations: the C sampler of pysplicing, or the
+# NumPy sampler. 'auto' uses pysplicing if it is available.
+SAMPLER_BACKENDS = ["auto", "pysplicing", "numpy"]
+
+
+def get_sampler_backend(backend, early_stop=False):
+    """
+    Resolve the given sampler backend to 'pysplicing' or 'numpy'.
+    """
+    if backend not in SAMPLER_BACKENDS:
+        raise Exception, "Unknown sampler backend %s" %(backend)
+    if backend == "auto":
+        # Only the NumPy sampler can stop early
+        if early_stop or pysplicing is None:
+            return "numpy"
+        return "pysplicing"
+    if backend == "pysplicing" and pysplicing is None:
+        raise Exception, "The pysplicing sampler backend was requested " \
+              "but pysplicing is not available."
+    return backend
+
 def get_logger(logger_name, log_outdir,
                level=logging.WARNING,
                include_stdout=True):
@@ -169,12 +212,19 @@ def get_single_end_sampler_params(num_isoforms,
 class MISOSampler:
     def __init__(self, params,
                  paired_end=False,
-                 log_dir=None):
+                 log_dir=None,
+                 output_format="miso"):
         """
         Make a sampler with the given parameters.
+
+        output_format is 'miso' to output each event's samples to
+        its *.miso file, 'miso_bin' to output them to a binary
+        *.miso_bin file instead, or 'miso_db' to store them in the
+        *.miso_db database of the event's chromosome.
         """
         self.params = params
         self.paired_end = paired_end
+        self.output_format = output_format
         # set default fragment length distribution parameters
         if self.paired_end:
             if ((not 'mean_frag_len' in self.params) or \
@@ -202,18 +252,25 @@ class MISOSampler:
                     burn_in=1000,
                     lag=2,
                     prior_params=None,
-                    # By default, use sampler with read classes (collapsed)
-                    # to get speed boost for single-end reads
-                    # (To revert to old reassigning sampler, use
-                    # pysplicing.MISO_ALGO_REASSIGN)
-                    algorithm=pysplicing.MISO_ALGO_CLASSES,
-                    start_cond=pysplicing.MISO_START_AUTO,
-                    stop_cond=pysplicing.MISO_STOP_FIXEDNO,
+                    # Single-end sampler algorithm: 'reassign' or
+                    # 'classes' (see SAMPLER_ALGORITHMS)
+                    algorithm="reassign",
+                    # Sampler implementation: 'pysplicing', 'numpy'
+                    # or 'auto' (see SAMPLER_BACKENDS)
+                    backend="auto",
+                    # Stop early once the R-hat of the samples is at
+                    # most max_rhat and their effective sample size
+                    # is at least min_ess (NumPy sampler only)
+                    max_rhat=None,
+                    min_ess=None,
+                    start_cond=None,
+                    stop_cond=None,
                     verbose=True):
         """
         Fast version of MISO MCMC sampler.
 
-        Calls C version and returns results.
+        Calls C version (or the NumPy version, depending on the
+        backend) and returns results.
         """
         num_isoforms = len(gene.isoforms)
         self.num_isoforms = num_isoforms
@@ -221,10 +278,23 @@ class MISOSampler:
         if prior_params == None:
             prior_params = (1.0,) * num_isoforms
 
-        read_positions = reads[0]
-        read_cigars = reads[1]
-
-        self.num_reads = len(read_positions)
+        if algorithm not in SAMPLER_ALGORITHMS:
+            raise Exception, "Unknown sampler algorithm %s" %(algorithm)
+        early_stop = (max_rhat is not None) and (min_ess is not None)
+        backend = get_sampler_backend(backend, early_stop=early_stop)
+        if early_stop and backend != "numpy":
+            print "Early stopping requires the numpy sampler backend, " \
+                  "running all %d iterations." %(num_iters)
+
+        # Reads are either collapsed into weighted counts (as the
+        # NumPy sampler takes them) or not (as the C sampler does)
+        reads_per_unit = 1
+        if self.paired_end:
+            reads_per_unit = 2
+        if len(reads) == 3:
+            self.num_reads = int(reads[2].sum())
+        else:
+            self.num_reads = len(reads[0]) / reads_per_unit
 
         if self.num_reads == 0:
             print "No reads for gene: %s" %(gene.label)
@@ -232,7 +302,7 @@ class MISOSampler:
 
         output_file = output_file + ".miso"
         # If output filename exists, don't run sampler
-        if os.path.isfile(os.path.normpath(output_file)):
+        if self.miso_output_exists(output_file):
             print "Output filename %s exists, not running MISO." \
                 %(output_file)
             return None
@@ -275,86 +345,137 @@ class MISOSampler:
             self.miso_logger.warning(one_iso_msg)
             return
 
-        # Convert Python Gene object to C
-        c_gene = py2c_gene(gene)
-
-        ##
-        ## Run C MISO
-        ##
-        read_positions = tuple([r+1 for r in read_positions])
-        if self.paired_end:
-            # Number of standard deviations in insert length
-            # distribution to consider when assigning reads
-            # to isoforms
-            num_sds = 4L
-
-            # Run paired-end
-            miso_results = pysplicing.MISOPaired(c_gene, 0L,
-                                                 read_positions,
-                                                 read_cigars,
-                                                 long(self.read_len),
-                                                 float(self.mean_frag_len),
-                                                 float(self.frag_variance),
-                                                 float(num_sds),
-                                                 long(num_iters),
-                                                 long(burn_in),
-                                                 long(lag),
-                                                 prior_params,
-                                                 long(self.overhang_len),
-                                                 long(num_chains),
-                                                 start_cond,
-                                                 stop_cond)
+        if backend == "numpy":
+            collapsed_reads = reads
+            if len(reads) != 3:
+                collapsed_reads = sam_utils.collapse_reads(reads[0], reads[1],
+                                                           reads_per_unit)
+            # Read classes of single-end reads, i.e. the distinct
+            # isoform compatibility vectors and their read counts.
+            # The C sampler checks compatibility itself.
+            se_read_classes = None
+            if not self.paired_end:
+                se_read_classes = \
+                    compute_read_classes(gene, collapsed_reads,
+                                         self.params['read_len'],
+                                         self.params['overhang_len'])
+                read_classes, class_counts = se_read_classes
+                if not read_classes.any():
+                    print "All reads incompatible with annotation, skipping..."
+                    return
+            miso_results = \
+                self.run_numpy_sampler(num_iters, collapsed_reads, gene,
+                                       se_read_classes, prior_params,
+                                       params['sigma_proposal'],
+                                       num_chains, burn_in, lag,
+                                       max_rhat=max_rhat,
+                                       min_ess=min_ess)
+            if miso_results is None:
+                print "All reads incompatible with annotation, skipping..."
+                return
+            psi_vectors, kept_log_scores, reads_data, assignments, \
+                accepted_proposals, rejected_proposals, \
+                num_iters_run, diagnostics = miso_results
+            diagnostics_msg = "Ran %d of %d iterations (R-hat: %.3f, " \
+                              "effective sample size: %.0f)" \
+                              %(num_iters_run, num_iters,
+                                diagnostics[0], diagnostics[1])
+            if num_iters_run < num_iters:
+                diagnostics_msg += "; converged early, saved %d iterations" \
+                                   %(num_iters - num_iters_run)
+            print diagnostics_msg
+            self.miso_logger.info(diagnostics_msg)
+            num_iters = num_iters_run
         else:
-            # Run single-end
-            miso_results = pysplicing.MISO(c_gene,
-                                           0L,
-                                           read_positions,
-                                           read_cigars,
-                                           long(self.read_len),
-                                           long(num_iters),
-                                           long(burn_in),
-                                           long(lag),
-                                           prior_params,
-                                           long(self.overhang_len),
-                                           long(num_chains),
-                                           start_cond,
-                                           stop_cond,
-                                           pysplicing.MISO_ALGO_REASSIGN)
-#                                           algorithm)
-
-        # Psi samples
-        psi_vectors = transpose(array(miso_results[0]))
-
-        # Log scores of accepted samples
-        kept_log_scores = transpose(array(miso_results[1]))
-
-        # Read classes
-        read_classes = miso_results[2]
-
-        # Read class statistics
-        read_class_data = miso_results[3]
-
-        # Assignments of reads to isoforms
-        assignments = miso_results[4]
-
-        # Statistics and parameters about sampler run
-        run_stats = miso_results[5]
-
-        # Assignments of reads to classes.
-        # read_classes[n] represents the read class that has
-        # read_assignments[n]-many reads.
-        reads_data = (read_classes, read_class_data)
-
-        assignments = array(assignments)
-
-        # Skip events where all reads are incompatible with the annotation;
-        # do not output a file for those.
-        if all(assignments == -1):
-            print "All reads incompatible with annotation, skipping..."
-            return
-
-        accepted_proposals = run_stats[4]
-        rejected_proposals = run_stats[5]
+            # Convert Python Gene object to C
+            c_gene = py2c_gene(gene)
+            if start_cond is None:
+                start_cond = pysplicing.MISO_START_AUTO
+            if stop_cond is None:
+                stop_cond = pysplicing.MISO_STOP_FIXEDNO
+
+            ##
+            ## Run C MISO
+            ##
+            # The C sampler takes each read separately
+            read_positions, read_cigars = reads
+            if len(reads) == 3:
+                read_positions, read_cigars = \
+                    sam_utils.expand_collapsed_reads(reads)
+            read_positions = tuple([r+1 for r in read_positions])
+            if self.paired_end:
+                # Number of standard deviations in insert length
+                # distribution to consider when assigning reads
+                # to isoforms
+                num_sds = 4L
+
+                # Run paired-end
+                miso_results = pysplicing.MISOPaired(c_gene, 0L,
+                                                     read_positions,
+                                                     read_cigars,
+                                                     long(self.read_len),
+                                                     float(self.mean_frag_len),
+                                                     float(self.frag_variance),
+                                                     float(num_sds),
+                                                     long(num_iters),
+                                                     long(burn_in),
+                                                     long(lag),
+                                                     prior_params,
+                                                     long(self.overhang_len),
+                                                     long(num_chains),
+                                                     start_cond,
+                                                     stop_cond)
+            else:
+                # Run single-end
+                miso_results = pysplicing.MISO(c_gene,
+                                               0L,
+                                               read_positions,
+                                               read_cigars,
+                                               long(self.read_len),
+                                               long(num_iters),
+                                               long(burn_in),
+                                               long(lag),
+                                               prior_params,
+                                               long(self.overhang_len),
+                                               long(num_chains),
+                                               start_cond,
+                                               stop_cond,
+                                               getattr(pysplicing,
+                                                       SAMPLER_ALGORITHMS[algorithm]))
+
+            # Psi samples
+            psi_vectors = transpose(array(miso_results[0]))
+
+            # Log scores of accepted samples
+            kept_log_scores = transpose(array(miso_results[1]))
+
+            # Read classes
+            read_classes = miso_results[2]
+
+            # Read class statistics
+            read_class_data = miso_results[3]
+
+            # Assignments of reads to isoforms
+            assignments = miso_results[4]
+
+            # Statistics and parameters about sampler run
+            run_stats = miso_results[5]
+
+            # Assignments of reads to classes.
+            # read_classes[n] represents the read class that has
+            # read_assignments[n]-many reads.
+            reads_data = (read_classes, read_class_data)
+
+            assignments = array(assignments)
+
+            # Skip events where all reads are incompatible with the annotation;
+            # do not output a file for those.
+            if all(assignments == -1):
+                print "All reads incompatible with annotation, skipping..."
+                return
+
+            accepted_proposals = run_stats[4]
+            rejected_proposals = run_stats[5]
 
         percent_acceptance = (float(accepted_proposals)/(accepted_proposals + \
                                                          rejected_proposals)) * 100
@@ -373,13 +494,199 @@ class MISOSampler:
             print "Event took %.2f seconds" %(t2 - t1)
 
 
+    def get_numpy_sampler_inputs(self, reads, gene, se_read_classes=None):
+        """
+        Return the inputs of the NumPy sampler for collapsed reads:
+        the read classes (weighted by fragment length probabilities
+        for paired-end reads), their counts, the read classes and
+        counts as reported by the C sampler and the effective
+        isoform lengths.
+        """
+        if self.paired_end:
+            frag_lens, frag_probs = \
+                numpy_sampler.compute_frag_len_probs(self.mean_frag_len,
+                                                     self.frag_variance)
+            class_weights, class_counts, reads_data = \
+                numpy_sampler.compute_paired_read_classes(gene, reads,
+                                                          self.params['read_len'],
+                                                          self.params['overhang_len'],
+                                                          frag_lens,
+                                                          frag_probs)
+            eff_lens = \
+                numpy_sampler.compute_paired_end_lens(gene,
+                                                      self.params['read_len'],
+                                                      self.params['overhang_len'],
+                                                      frag_lens,
+                                                      frag_probs)
+        else:
+            if se_read_classes is None:
+                se_read_classes = \
+                    compute_read_classes(gene, reads,
+                                         self.params['read_len'],
+                                         self.params['overhang_len'])
+            class_weights, class_counts = se_read_classes
+            reads_data = se_read_classes
+            eff_lens = \
+                numpy_sampler.compute_single_end_lens(gene,
+                                                      self.params['read_len'],
+                                                      self.params['overhang_len'])
+        return class_weights, class_counts, reads_data, eff_lens
+
+
+    def run_numpy_sampler(self, num_iters, reads, gene, se_read_classes,
+                          prior_params, sigma_proposal,
+                          num_chains, burn_in, lag,
+                          max_rhat=None,
+                          min_ess=None):
+        """
+        Run the NumPy version of the sampler on collapsed reads.
+
+        Returns the Psi samples, their log scores, the read classes
+        and their counts (as reported by the C sampler), the
+        assignments of reads to isoforms, the number of accepted
+        and rejected proposals, the number of iterations run and
+        the R-hat and effective sample size of the samples, or None
+        if no read is compatible with the gene's isoforms.
+        """
+        class_weights, class_counts, reads_data, eff_lens = \
+            self.get_numpy_sampler_inputs(reads, gene, se_read_classes)
+        if not class_weights.any():
+            return None
+        psi_vectors, kept_log_scores, assigned_counts, \
+            accepted_proposals, rejected_proposals, \
+            num_iters_run, diagnostics = \
+            numpy_sampler.sample_psi(class_weights, class_counts, eff_lens,
+                                     num_iters, burn_in, lag,
+                                     num_chains=num_chains,
+                                     prior_params=prior_params,
+                                     sigma_proposal=sigma_proposal,
+                                     max_rhat=max_rhat,
+                                     min_ess=min_ess)
+        assignments = repeat(arange(len(gene.isoforms)), assigned_counts)
+        return psi_vectors, kept_log_scores, reads_data, assignments, \
+               accepted_proposals, rejected_proposals, \
+               num_iters_run, diagnostics
+
+
+    def run_sampler_batch(self, num_iters, events,
+                          num_chains=6,
+                          burn_in=1000,
+                          lag=2,
+                          prior_params=None,
+                          max_rhat=None,
+                          min_ess=None,
+                          verbose=True):
+        """
+        Run the NumPy sampler on a batch of events with the same
+        number of isoforms, sampling all of them at once.
+
+        Takes a list of (reads, gene, output_file) events, with
+        reads collapsed as made by sam_utils.sam_parse_reads, and
+        outputs a .miso file for each event.
+        """
+        t1 = time.time()
+        num_isoforms = len(self.params['sigma_proposal']) + 1
+        if prior_params == None:
+            prior_params = (1.0,) * num_isoforms
+        if self.params['uniform_proposal']:
+            proposal_type = "unif"
+        else:
+            proposal_type = "drift"
+
+        batch_events = []
+        batch_inputs = []
+        for reads, gene, output_file in events:
+            output_file = output_file + ".miso"
+            if len(gene.isoforms) != num_isoforms:
+                raise Exception, "Gene %s does not have %d isoforms." \
+                      %(gene.label, num_isoforms)
+            if self.miso_output_exists(output_file):
+                print "Output filename %s exists, not running MISO." \
+                    %(output_file)
+                continue
+            if reads[2].sum() == 0:
+                print "No reads for gene: %s" %(gene.label)
+                continue
+            class_weights, class_counts, reads_data, eff_lens = \
+                self.get_numpy_sampler_inputs(reads, gene)
+            if not class_weights.any():
+                print "All reads incompatible with annotation, skipping %s..." \
+                      %(gene.label)
+                continue
+            batch_events.append((gene, output_file, reads_data))
+            batch_inputs.append((class_weights, class_counts, eff_lens))
+        if len(batch_events) == 0:
+            return
+
+        print "Sampling %d events with %d isoforms in one batch..." \
+              %(len(batch_events), num_isoforms)
+        # Events are padded to the largest number of read classes in
+        # their batch, so sample events with similar numbers of
+        # classes together
+        events_by_size = defaultdict(list)
+        for event_num, event_inputs in enumerate(batch_inputs):
+            num_classes = len(event_inputs[0])
+            events_by_size[int(math.ceil(math.log(max(num_classes, 1), 2)))].append(event_num)
+        batch_results = [None] * len(batch_events)
+        for event_nums in events_by_size.itervalues():
+            size_results = \
+                numpy_sampler.sample_psi_batch([batch_inputs[n][0] for n in event_nums],
+                                               [batch_inputs[n][1] for n in event_nums],
+                                               [batch_inputs[n][2] for n in event_nums],
+                                               num_iters, burn_in, lag,
+                                               num_chains=num_chains,
+                                               prior_params=prior_params,
+                                               sigma_proposal=self.params['sigma_proposal'],
+                                               max_rhat=max_rhat,
+                                               min_ess=min_ess)
+            for event_num, results in zip(event_nums, size_results):
+                batch_results[event_num] = results
+        total_iters_run = 0
+        for (gene, output_file, reads_data), results in zip(batch_events,
+                                                            batch_results):
+            psi_vectors, kept_log_scores, assigned_counts, \
+                accepted_proposals, rejected_proposals, \
+                num_iters_run, diagnostics = results
+            total_iters_run += num_iters_run
+            percent_acceptance = (float(accepted_proposals) / \
+                                  (accepted_proposals + rejected_proposals)) * 100
+            assignments = repeat(arange(num_isoforms), assigned_counts)
+            self.output_miso_results(output_file, gene, reads_data,
+                                     assignments, psi_vectors,
+                                     kept_log_scores, num_iters_run,
+                                     burn_in, lag, percent_acceptance,
+                                     proposal_type)
+        batch_msg = "Sampled %d events in batch" %(len(batch_events))
+        if total_iters_run < num_iters * len(batch_events):
+            batch_msg += "; converged early, saved %d iterations" \
+                         %(num_iters * len(batch_events) - total_iters_run)
+        print batch_msg
+        self.miso_logger.info(batch_msg)
+        if verbose:
+            t2 = time.time()
+            print "Batch took %.2f seconds" %(t2 - t1)
+
+
+    def miso_output_exists(self, output_file):
+        """
+        Return True if the samples of the given *.miso file were
+        already output.
+        """
+        if self.output_format == "miso_db":
+            db_fname, event_name = miso_db.get_miso_db_location(output_file)
+            return miso_db.get_miso_db_writer(db_fname).has_event(event_name)
+        elif self.output_format == "miso_bin":
+            output_file = get_miso_bin_fname(output_file)
+        return os.path.isfile(os.path.normpath(output_file))
+
+
     def output_miso_results(self, output_file, gene, reads_data, assignments,
                             psi_vectors, kept_log_scores, num_iters, burn_in,
                             lag, percent_acceptance, proposal_type):
         """
-        Output results of MISO to a file.
+        Output results of MISO to a file, or to the chromosome's
+        database if the output format is 'miso_db'.
         """
-        output = open(output_file, 'w')
 
         # Get a string representation of the isoforms - use '_'
         # in the delimiter regardless
@@ -452,20 +759,46 @@ class MISOSampler:
                    strand,
                    mRNA_start_coords,
                    mRNA_end_coords)
-        output.write(header)
 
         # Output samples and their associated log scores, as well as read counts
         results_fields = ["sampled_psi", "log_score"]
         results_header = "%s\n" %("\t".join(results_fields))
-        output.write(results_header)
-        for psi_sample, curr_log_score in zip(psi_vectors, kept_log_scores):
-            psi_sample_str = ",".join(["%.4f" %(psi) for psi in psi_sample])
-            output_line = "%s\t%.2f\n" %(psi_sample_str, curr_log_score)
-            output.write(output_line)
-        output.close()
+        if self.output_format == "miso_bin":
+            miso_bin.write_samples_bin(get_miso_bin_fname(output_file),
+                                       header, psi_vectors, kept_log_scores)
+            print "Completed outputting."
+            return
+        # Format all samples at once
+        sample_format = ",".join(["%.4f"] * num_isoforms) + "\t%.2f"
+        sample_lines = [sample_format %(tuple(psi_sample) + (curr_log_score,)) \
+                        for psi_sample, curr_log_score \
+                        in zip(array(psi_vectors).tolist(),
+                               array(kept_log_scores).tolist())]
+        samples_str = ""
+        if len(sample_lines) > 0:
+            samples_str = "\n".join(sample_lines) + "\n"
+        if self.output_format == "miso_db":
+            db_fname, event_name = miso_db.get_miso_db_location(output_file)
+            miso_db.get_miso_db_writer(db_fname).add_event(event_name,
+                                                           header + results_header,
+                                                           samples_str)
+        else:
+            output = open(output_file, 'w')
+            output.write(header)
+            output.write(results_header)
+            output.write(samples_str)
+            output.close()
         print "Completed outputting."
 #        return [percent_acceptance, array(psi_vectors), array(kept_log_scores)]
 
+def get_miso_bin_fname(miso_fname):
+    """
+    Return the *.miso_bin filename to output the samples of
+    a *.miso file to.
+    """
+    return "%s%s" %(miso_db.strip_miso_ext(miso_fname), miso_bin.MISO_BIN_EXT)
+
+
 def run_sampler_on_event(gene, ni, ne, nb, read_len, overhang_len, num_iters,
                          output_dir, confidence_level=.95):
     """
@@ -44,12 +44,19 @@ class MISOCompressor:
         self.comp_ext = ".misozip"
 
 
-    def compress(self, output_filename, miso_dirnames):
+    def compress(self, output_filename, miso_dirnames,
+                 compression=None,
+                 num_proc=1):
         """
         Takes a set of MISO input directories and compresses them
         into 'output_filename'. This involves making SQL databases
         for all the MISO directories and then additionally compressing the
         results as a zip file.
+
+        The databases are made on num_proc processes. If compression
+        is 'zlib', the samples are compressed in the databases, and
+        the databases are stored in the zip file without compressing
+        them again.
         """
         if os.path.isfile(output_filename):
             print "Error: %s already exists. Please delete to overwrite." \
@@ -59,6 +66,7 @@ class MISOCompressor:
             print "Error: Intermediate compressed directory %s " \
                   "exists. Please delete to overwrite." %(output_dir)
             sys.exit(1)
+        dirs_and_db_fnames = []
         for miso_dirname in miso_dirnames:
             print "Processing: %s" %(miso_dirname)
             if not os.path.isdir(miso_dirname):
@@ -79,11 +87,34 @@ class MISOCompressor:
                 # Remove the place holder directory
                 os.rmdir(comp_path)
                 comp_path = "%s%s" %(comp_path, miso_db.MISO_DB_EXT)
-                miso_db.miso_dir_to_db(dir_to_compress, comp_path)
+                dirs_and_db_fnames.append((dir_to_compress, comp_path))
+        # Make the databases, leaving the original directories
+        statuses = miso_db.pack_miso_dirs(dirs_and_db_fnames,
+                                          compression=compression,
+                                          remove_dirs=False,
+                                          num_proc=num_proc)
+        failed_dirs = [dir_to_compress \
+                       for (dir_to_compress, db_fname), status \
+                       in zip(dirs_and_db_fnames, statuses) \
+                       if status is None]
+        if len(failed_dirs) > 0:
+            for dir_to_compress in failed_dirs:
+                print "Error: Failed to pack %s" %(dir_to_compress)
+            print "Aborting compression, deleting intermediate " \
+                  "directory: %s" %(output_dir)
+            shutil.rmtree(output_dir)
+            sys.exit(1)
         # Zip directory using conventional zip
-        print "Zipping compressed directory with standard zip..."
         t1 = time.time()
-        zipper(output_dir, output_filename)
+        if compression is None:
+            print "Zipping compressed directory with standard zip..."
+            zipper(output_dir, output_filename)
+        else:
+            # Samples are already compressed, so only bundle the
+            # databases into the zip file
+            print "Storing compressed directory in zip file..."
+            zipper(output_dir, output_filename,
+                   zip_compression=zipfile.ZIP_STORED)
         print "Deleting intermediate directory: %s" %(output_dir)
         shutil.rmtree(output_dir)
         t2 = time.time()
@@ -132,7 +163,9 @@ class MISOCompressor:
 
 
 def compress_miso(output_filename, input_dirs,
-                  comp_ext=".misozip"):
+                  comp_ext=".misozip",
+                  compression=None,
+                  num_proc=1):
     """
     Compress a directory containing MISO files.
 
@@ -154,7 +187,9 @@ def compress_miso(output_filename, input_dirs,
         sys.exit(1)
     t1 = time.time()
     miso_comp = MISOCompressor()
-    miso_comp.compress(output_filename, input_dirs)
+    miso_comp.compress(output_filename, input_dirs,
+                       compression=compression,
+                       num_proc=num_proc)
     t2 = time.time()
     print "Compression took %.2f minutes." %((t2 - t1)/60.)
 
@@ -174,7 +209,7 @@ def uncompress_miso(compressed_filename, output_dir):
     print "Uncompression took %.2f minutes." %((t2 - t1)/60.)
 
 
-def zipper(dir, zip_file):
+def zipper(dir, zip_file, zip_compression=zipfile.ZIP_DEFLATED):
     """
     Zip a directory 'dir' recursively, saving result in
     'zip_file'.
@@ -183,7 +218,7 @@ def zipper(dir, zip_file):
     """
     # Enable Zip64 to allow creation of large Zip files
     zip = zipfile.ZipFile(zip_file, 'w',
-                          compression=zipfile.ZIP_DEFLATED,
+                          compression=zip_compression,
                           allowZip64=True)
     root_len = len(os.path.abspath(dir))
     for root, dirs, files in os.walk(dir):
@@ -191,7 +226,7 @@ def zipper(dir, zip_file):
         for f in files:
             fullpath = os.path.join(root, f)
             archive_name = os.path.join(archive_root, f)
-            zip.write(fullpath, archive_name, zipfile.ZIP_DEFLATED)
+            zip.write(fullpath, archive_name, zip_compression)
     zip.close()
     return zip_file
 
@@ -233,6 +268,15 @@ def main():
                       "uncompressed, and (2) the directory to place the "
                       "uncompressed representation into. "
                       "Example: --uncompress output.misozip outputdir")
+    parser.add_option("--compress-samples", dest="compress_samples",
+                      action="store_true", default=False,
+                      help="With --compress, store the samples of each event "
+                      "zlib-compressed in the MISO databases, rather than "
+                      "compressing the databases with zip.")
+    parser.add_option("-p", "--num-proc", dest="num_proc",
+                      type="int", default=1,
+                      help="Number of processes to make MISO databases on "
+                      "with --compress. Default is 1.")
     (options, args) = parser.parse_args()
 
     if (options.compress is None) and (options.uncompress is None):
@@ -248,7 +292,12 @@ def main():
         output_filename = utils.pathify(options.compress[0])
         input_dirs = [utils.pathify(d) \
                       for d in options.compress[1].split(",")]
-        compress_miso(output_filename, input_dirs)
+        compression = None
+        if options.compress_samples:
+            compression = "zlib"
+        compress_miso(output_filename, input_dirs,
+                      compression=compression,
+                      num_proc=options.num_proc)
 
     if options.uncompress is not None:
         compressed_filename = utils.pathify(options.uncompress[0])
@@ -0,0 +1,510 @@
+##
+## MISO sampler in pure NumPy
+##
+## Samples Psi from the same model as the C sampler of pysplicing,
+## for use when pysplicing is not available. Reads are grouped into
+## read classes, i.e. reads with the same (weighted) compatibility
+## with each isoform, so the cost of each iteration depends on the
+## number of classes rather than on the number of reads.
+##
+## Under the MISO model, a read r is sampled from isoform i with
+## probability proportional to Psi_i * E_i, where E_i is the number
+## of positions (weighted by fragment length for paired-end reads)
+## a read can be sampled from in isoform i, and then from one of
+## these positions uniformly. Summing out the isoform assignments:
+##
+##   P(r | Psi) = sum_i Psi_i * w_ri / sum_j Psi_j * E_j
+##
+## where w_ri is 1 if the read is compatible with isoform i (for
+## paired-end reads, the probability of its fragment length in
+## isoform i) and 0 otherwise.
+##
+import numpy as np
+
+import misopy.sam_utils as sam_utils
+
+# Number of standard deviations in insert length distribution
+# to consider when assigning paired-end reads to isoforms
+NUM_SDS = 4
+
+
+def get_isoform_junctions(isoform):
+    """
+    Return the 1-based isoform coordinates of the last base of
+    each of the isoform's exons, except the last one.
+    """
+    part_ends = np.cumsum([part.len for part in isoform.parts])
+    return part_ends[:-1]
+
+
+def compute_overhang_ok(isoform, read_len, overhang_len):
+    """
+    Return a boolean array saying, for each read start position
+    in the isoform (1-based, from 1 to isoform length - read length
+    + 1), whether a read starting there meets the overhang
+    constraint on every exon it covers.
+    """
+    num_positions = isoform.len - read_len + 1
+    if num_positions <= 0:
+        return np.zeros(0, dtype=bool)
+    read_starts = np.arange(1, num_positions + 1)
+    read_ends = read_starts + read_len - 1
+    overhang_ok = np.ones(num_positions, dtype=bool)
+    # End of the previous exon segment covered by each read
+    prev_ends = read_starts - 1
+    for junction in get_isoform_junctions(isoform):
+        crosses = (junction > prev_ends) & (junction < read_ends)
+        overhang_ok &= (~crosses) | (junction - prev_ends >= overhang_len)
+        prev_ends = np.where(crosses, junction, prev_ends)
+    overhang_ok &= (read_ends - prev_ends >= overhang_len)
+    return overhang_ok
+
+
+def compute_frag_len_probs(mean_frag_len, frag_variance,
+                           num_sds=NUM_SDS):
+    """
+    Return the fragment lengths within num_sds standard deviations
+    of the mean and their (normalized) probabilities under a
+    discretized normal distribution.
+    """
+    frag_sd = np.sqrt(frag_variance)
+    min_frag_len = max(int(np.ceil(mean_frag_len - num_sds * frag_sd)), 1)
+    max_frag_len = int(np.floor(mean_frag_len + num_sds * frag_sd))
+    frag_lens = np.arange(min_frag_len, max_frag_len + 1)
+    frag_probs = np.exp(-(frag_lens - mean_frag_len)**2 /
+                        (2. * frag_variance))
+    frag_probs /= frag_probs.sum()
+    return frag_lens, frag_probs
+
+
+def compute_single_end_lens(gene, read_len, overhang_len):
+    """
+    Return the number of positions a single-end read can be
+    sampled from in each isoform of the gene.
+    """
+    return np.array([compute_overhang_ok(isoform, read_len,
+                                         overhang_len).sum() \
+                     for isoform in gene.isoforms], dtype=float)
+
+
+def compute_paired_end_lens(gene, read_len, overhang_len,
+                            frag_lens, frag_probs):
+    """
+    Return the number of positions a read pair can be sampled
+    from in each isoform of the gene, weighted by the probability
+    of each fragment length.
+    """
+    eff_lens = []
+    for isoform in gene.isoforms:
+        overhang_ok = compute_overhang_ok(isoform, read_len,
+                                          overhang_len)
+        eff_len = 0.
+        for frag_len, frag_prob in zip(frag_lens, frag_probs):
+            # Positions where both mates fit in the isoform
+            num_positions = isoform.len - frag_len + 1
+            if num_positions <= 0 or frag_len < read_len:
+                continue
+            right_offset = frag_len - read_len
+            num_ok = (overhang_ok[0:num_positions] & \
+                      overhang_ok[right_offset:right_offset + num_positions]).sum()
+            eff_len += frag_prob * num_ok
+        eff_lens.append(eff_len)
+    return np.array(eff_lens, dtype=float)
+
+
+def align_read(gene, read_start, sam_cigar, read_len, overhang_len):
+    """
+    Align a read to the isoforms of the gene. Takes the 1-based
+    genomic start of the read and its pysam CIGAR.
+
+    Return a list with the 0-based isoform coordinates of the start
+    and end of the read in each isoform, or None for isoforms that
+    the read is not compatible with.
+    """
+    read_end = sam_utils.cigar_to_end_coord(read_start, sam_cigar)
+    isoform_coords = []
+    for isoform in gene.isoforms:
+        isocigar = isoform.get_local_cigar(read_start, read_len)
+        if (isocigar and isocigar == sam_cigar) and \
+           isoform.cigar_overhang_met(isocigar, overhang_len):
+            isoform_coords.append((isoform.part_coord_to_isoform(read_start),
+                                   isoform.part_coord_to_isoform(read_end)))
+        else:
+            isoform_coords.append(None)
+    return isoform_coords
+
+
+def compute_paired_read_classes(gene, reads, read_len, overhang_len,
+                                frag_lens, frag_probs):
+    """
+    Group read pairs into classes with the same fragment length
+    probability in each isoform. Reads are given as made by
+    sam_utils.sam_parse_reads with paired_end, collapsed or not.
+
+    Returns a tuple of:
+    - the read classes, as a float array with one row per class and
+      one column per isoform, holding the probability of the pair's
+      fragment length in each isoform (0 if incompatible)
+    - the number of read pairs in each class
+    - the compatibility classes of the reads (1 where the class's
+      probability is non-zero) and their counts, as reported in
+      the counts field of .miso files
+    """
+    if len(reads) != 3:
+        reads = sam_utils.collapse_reads(reads[0], reads[1],
+                                         reads_per_unit=2)
+    positions, cigars, counts = reads
+    num_isoforms = len(gene.isoforms)
+    frag_len_probs = dict(zip(frag_lens.tolist(), frag_probs.tolist()))
+    sam_cigars = {}
+    classes = {}
+    for unit_positions, unit_cigars, count in zip(positions.tolist(),
+                                                  cigars,
+                                                  counts.tolist()):
+        mate_coords = []
+        for read_pos, cigar_str in zip(unit_positions, unit_cigars):
+            sam_cigar = sam_cigars.get(cigar_str)
+            if sam_cigar is None:
+                sam_cigar = sam_utils.str_to_sam_cigar(cigar_str)
+                sam_cigars[cigar_str] = sam_cigar
+            # Reads are 0-based, isoforms are 1-based
+            mate_coords.append(align_read(gene, read_pos + 1, sam_cigar,
+                                          read_len, overhang_len))
+        read_class = []
+        for left_coords, right_coords in zip(*mate_coords):
+            if left_coords is None or right_coords is None:
+                read_class.append(0.)
+                continue
+            frag_len = max(left_coords[1], right_coords[1]) - \
+                       min(left_coords[0], right_coords[0]) + 1
+            read_class.append(frag_len_probs.get(frag_len, 0.))
+        read_class = tuple(read_class)
+        classes[read_class] = classes.get(read_class, 0) + count
+    read_classes = np.array(sorted(classes.keys()),
+                            dtype=float).reshape((len(classes), num_isoforms))
+    class_counts = np.array([classes[tuple(c)] for c in read_classes.tolist()],
+                            dtype=int)
+    # Classes of compatibility, as reported by the C sampler
+    compat_counts = {}
+    for read_class, count in zip(read_classes, class_counts):
+        compat_class = tuple((read_class > 0).astype(int))
+        compat_counts[compat_class] = compat_counts.get(compat_class, 0) + count
+    compat_classes = sorted(compat_counts.keys())
+    compat_class_counts = [compat_counts[c] for c in compat_classes]
+    return read_classes, class_counts, \
+           (np.array(compat_classes, dtype=int),
+            np.array(compat_class_counts, dtype=int))
+
+
+def psi_to_log_score(psi, class_weights, class_counts, eff_lens,
+                     prior_params):
+    """
+    Return the log posterior score, up to a constant and under a
+    Dirichlet prior, of Psi vectors of a batch of events.
+
+    Takes Psi as an array of shape (events, chains, isoforms), the
+    read classes of the events as an array of shape (events,
+    classes, isoforms), their counts as an array of shape (events,
+    classes) and the effective isoform lengths as an array of shape
+    (events, isoforms). Returns an array of shape (events, chains).
+    """
+    with np.errstate(divide='ignore'):
+        log_lik = (np.log(np.einsum('eck,emk->ecm', psi, class_weights)) * \
+                   class_counts[:, np.newaxis, :]).sum(axis=2) - \
+                  class_counts.sum(axis=1)[:, np.newaxis] * \
+                  np.log(np.einsum('eck,ek->ec', psi, eff_lens))
+        log_prior = np.log(psi).dot(prior_params - 1.)
+    return log_lik + log_prior
+
+
+def alpha_to_psi(alpha):
+    """
+    Map logistic-normal parameters (with one entry less than the
+    number of isoforms along the last axis) to Psi vectors.
+    """
+    alpha = np.concatenate([alpha, np.zeros(alpha.shape[:-1] + (1,))],
+                           axis=-1)
+    alpha -= alpha.max(axis=-1)[..., np.newaxis]
+    psi = np.exp(alpha)
+    return psi / psi.sum(axis=-1)[..., np.newaxis]
+
+
+def sample_assignments(psi, class_weights, class_counts,
+                       random_state=np.random):
+    """
+    Gibbs step: assign the reads of each class to isoforms given
+    Psi. Returns the number of reads assigned to each isoform;
+    reads not compatible with any isoform are not assigned.
+    """
+    assigned_counts = np.zeros(len(psi), dtype=int)
+    for read_class, count in zip(class_weights, class_counts):
+        probs = psi * read_class
+        if probs.sum() == 0:
+            continue
+        assigned_counts += random_state.multinomial(int(count),
+                                                    probs / probs.sum())
+    return assigned_counts
+
+
+def compute_rhat(samples):
+    """
+    Return the split R-hat (potential scale reduction factor) of
+    samples given as an array with one row per chain. Each chain is
+    split in two halves, so that chains that drift are not
+    mistaken for converged ones.
+    """
+    num_samples = samples.shape[1] / 2
+    if num_samples < 2:
+        return np.inf
+    halves = np.vstack([samples[:, 0:num_samples],
+                        samples[:, -num_samples:]])
+    within_var = halves.var(axis=1, ddof=1).mean()
+    between_var = num_samples * halves.mean(axis=1).var(ddof=1)
+    if within_var == 0:
+        return 1.
+    var_plus = ((num_samples - 1.) / num_samples) * within_var + \
+               between_var / num_samples
+    return np.sqrt(var_plus / within_var)
+
+
+def compute_ess(samples):
+    """
+    Return the effective sample size of samples given as an array
+    with one row per chain, from their autocorrelations, summed
+    over pairs of lags while positive (Geyer's initial positive
+    sequence.)
+    """
+    num_chains, num_samples = samples.shape
+    if num_samples < 4:
+        return 0.
+    # Autocovariance of each chain, using the FFT
+    centered = samples - samples.mean(axis=1)[:, np.newaxis]
+    fft_len = 2 ** int(np.ceil(np.log2(2 * num_samples)))
+    freqs = np.fft.rfft(centered, n=fft_len, axis=1)
+    autocov = np.fft.irfft(freqs * np.conjugate(freqs),
+                           axis=1)[:, 0:num_samples] / num_samples
+    within_var = autocov[:, 0].mean() * num_samples / (num_samples - 1.)
+    var_plus = within_var * (num_samples - 1.) / num_samples
+    if num_chains > 1:
+        var_plus += samples.mean(axis=1).var(ddof=1)
+    if var_plus == 0:
+        return float(num_chains * num_samples)
+    rho = 1. - (within_var - autocov.mean(axis=0)) / var_plus
+    rho[0] = 1.
+    num_pairs = num_samples / 2
+    pair_sums = rho[0:2 * num_pairs:2] + rho[1:2 * num_pairs:2]
+    negative = np.nonzero(pair_sums <= 0)[0]
+    if len(negative) > 0:
+        pair_sums = pair_sums[0:negative[0]]
+    tau = -1. + 2. * pair_sums.sum()
+    # Bound the estimate for anticorrelated chains
+    tau = max(tau, 1. / np.log10(num_chains * num_samples))
+    return num_chains * num_samples / tau
+
+
+def compute_diagnostics(psi_samples):
+    """
+    Return the largest R-hat and the smallest effective sample size
+    over isoforms, for Psi samples given as an array of shape
+    (chains, samples, isoforms).
+    """
+    rhats = []
+    ess = []
+    # The last isoform's Psi is determined by the others
+    for iso_num in range(max(psi_samples.shape[2] - 1, 1)):
+        rhats.append(compute_rhat(psi_samples[:, :, iso_num]))
+        ess.append(compute_ess(psi_samples[:, :, iso_num]))
+    return max(rhats), min(ess)
+
+
+def stack_events(events_class_weights, events_class_counts):
+    """
+    Stack the read classes and class counts of a batch of events
+    into arrays, dropping classes of reads that are incompatible
+    with all isoforms and padding events with fewer classes with
+    empty classes.
+    """
+    num_events = len(events_class_weights)
+    num_isoforms = np.asarray(events_class_weights[0]).shape[1]
+    compatible = [np.asarray(w, dtype=float).any(axis=1) \
+                  for w in events_class_weights]
+    max_classes = max([c.sum() for c in compatible] + [1])
+    # Empty classes are compatible with all isoforms so that their
+    # (zero-weighted) log likelihood is defined
+    class_weights = np.ones((num_events, max_classes, num_isoforms))
+    class_counts = np.zeros((num_events, max_classes))
+    for event_num in range(num_events):
+        weights = np.asarray(events_class_weights[event_num],
+                             dtype=float)[compatible[event_num]]
+        counts = np.asarray(events_class_counts[event_num],
+                            dtype=float)[compatible[event_num]]
+        class_weights[event_num, 0:len(weights)] = weights
+        class_counts[event_num, 0:len(counts)] = counts
+    return class_weights, class_counts
+
+
+def sample_psi(class_weights, class_counts, eff_lens,
+               num_iters, burn_in, lag,
+               num_chains=6,
+               prior_params=None,
+               sigma_proposal=None,
+               max_rhat=None,
+               min_ess=None,
+               check_every=50,
+               random_state=None):
+    """
+    Sample Psi with Metropolis-Hastings, running the chains in
+    lockstep as one vectorized computation.
+
+    Proposals are drawn from a logistic-normal drift (a Gaussian
+    step on the logit of Psi) and accepted based on the likelihood
+    of the read class counts, which sums out the assignments of
+    reads to isoforms. The assignments are then drawn by a Gibbs
+    step given the final Psi.
+
+    If max_rhat and min_ess are given, sampling stops early once
+    the R-hat of the kept samples is at most max_rhat and their
+    effective sample size is at least min_ess, checking every
+    check_every kept samples.
+
+    Returns a tuple of:
+    - Psi samples kept after burn-in every lag iterations, as an
+      array with one row per sample (chains one after the other)
+    - the log scores of the samples
+    - the number of reads assigned to each isoform
+    - the number of accepted and of rejected proposals
+    - the number of iterations run
+    - the R-hat and effective sample size of the samples
+    """
+    return sample_psi_batch([class_weights], [class_counts], [eff_lens],
+                            num_iters, burn_in, lag,
+                            num_chains=num_chains,
+                            prior_params=prior_params,
+                            sigma_proposal=sigma_proposal,
+                            max_rhat=max_rhat,
+                            min_ess=min_ess,
+                            check_every=check_every,
+                            random_state=random_state)[0]
+
+
+def sample_psi_batch(events_class_weights, events_class_counts,
+                     events_eff_lens,
+                     num_iters, burn_in, lag,
+                     num_chains=6,
+                     prior_params=None,
+                     sigma_proposal=None,
+                     max_rhat=None,
+                     min_ess=None,
+                     check_every=50,
+                     random_state=None):
+    """
+    Sample Psi for a batch of events with the same number of
+    isoforms, vectorized across events and chains (see sample_psi.)
+    Events that meet the early stopping criteria are taken out of
+    the batch, while the others keep sampling.
+
+    Takes lists with the read classes, class counts and effective
+    isoform lengths of each event. Returns a list with the results
+    of each event, as returned by sample_psi.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    class_weights, class_counts = stack_events(events_class_weights,
+                                               events_class_counts)
+    eff_lens = np.array(events_eff_lens, dtype=float)
+    num_events, max_classes, num_isoforms = class_weights.shape
+    if prior_params is None:
+        prior_params = np.ones(num_isoforms)
+    prior_params = np.asarray(prior_params, dtype=float)
+    if sigma_proposal is None:
+        sigma_proposal = np.eye(num_isoforms - 1) * 0.05
+    proposal_chol = np.linalg.cholesky(sigma_proposal)
+    early_stop = (max_rhat is not None) and (min_ess is not None)
+
+    def alpha_log_score(psi, events):
+        # Log score in logistic-normal space includes the Jacobian
+        # of the map from alpha to Psi
+        return psi_to_log_score(psi, class_weights[events],
+                                class_counts[events], eff_lens[events],
+                                prior_params) + np.log(psi).sum(axis=2)
+
+    # Events still being sampled
+    active = np.arange(num_events)
+    # Start chains at dispersed initial values
+    alpha = random_state.normal(0, 1, (num_events, num_chains,
+                                       num_isoforms - 1))
+    psi = alpha_to_psi(alpha)
+    curr_score = alpha_log_score(psi, active)
+
+    kept_iters = range(burn_in, num_iters, lag)
+    psi_samples = np.empty((num_events, len(kept_iters), num_chains,
+                            num_isoforms))
+    log_scores = np.empty((num_events, len(kept_iters), num_chains))
+    num_accepted = np.zeros(num_events, dtype=int)
+    num_kept = np.zeros(num_events, dtype=int)
+    num_iters_run = np.zeros(num_events, dtype=int)
+    final_psi = np.empty((num_events, num_isoforms))
+    diagnostics = [None] * num_events
+    curr_iter = 0
+    kept_num = 0
+    while curr_iter < num_iters and len(active) > 0:
+        steps = random_state.normal(0, 1, alpha.shape)
+        proposed_alpha = alpha + steps.dot(proposal_chol.T)
+        proposed_psi = alpha_to_psi(proposed_alpha)
+        proposed_score = alpha_log_score(proposed_psi, active)
+        with np.errstate(invalid='ignore'):
+            accept = np.log(random_state.uniform(size=curr_score.shape)) < \
+                     (proposed_score - curr_score)
+        alpha[accept] = proposed_alpha[accept]
+        psi[accept] = proposed_psi[accept]
+        curr_score[accept] = proposed_score[accept]
+        num_accepted[active] += accept.sum(axis=1)
+        curr_iter += 1
+        num_iters_run[active] = curr_iter
+        if kept_num < len(kept_iters) and \
+           curr_iter - 1 == kept_iters[kept_num]:
+            psi_samples[active, kept_num] = psi
+            log_scores[active, kept_num] = \
+                psi_to_log_score(psi, class_weights[active],
+                                 class_counts[active], eff_lens[active],
+                                 prior_params)
+            kept_num += 1
+            num_kept[active] = kept_num
+            if early_stop and (kept_num % check_every == 0):
+                converged = np.zeros(len(active), dtype=bool)
+                for active_num, event_num in enumerate(active):
+                    rhat, ess = \
+                        compute_diagnostics(psi_samples[event_num, 0:kept_num].transpose((1, 0, 2)))
+                    if (rhat <= max_rhat) and (ess >= min_ess):
+                        converged[active_num] = True
+                        diagnostics[event_num] = (rhat, ess)
+                final_psi[active[converged]] = psi[converged, 0]
+                # Take converged events out of the batch
+                active = active[~converged]
+                alpha = alpha[~converged]
+                psi = psi[~converged]
+                curr_score = curr_score[~converged]
+    final_psi[active] = psi[:, 0]
+
+    results = []
+    for event_num in range(num_events):
+        event_samples = psi_samples[event_num, 0:num_kept[event_num]]
+        event_scores = log_scores[event_num, 0:num_kept[event_num]]
+        if diagnostics[event_num] is None:
+            diagnostics[event_num] = \
+                compute_diagnostics(event_samples.transpose((1, 0, 2)))
+        assigned_counts = sample_assignments(final_psi[event_num],
+                                             class_weights[event_num],
+                                             class_counts[event_num],
+                                             random_state=random_state)
+        num_rejected = num_iters_run[event_num] * num_chains - \
+                       num_accepted[event_num]
+        # Order samples by chain
+        results.append((event_samples.transpose((1, 0, 2)).reshape((-1, num_isoforms)),
+                        event_scores.T.reshape(-1),
+                        assigned_counts,
+                        num_accepted[event_num],
+                        num_rejected,
+                        num_iters_run[event_num],
+                        diagnostics[event_num]))
+    return results
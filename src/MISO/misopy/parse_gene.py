@@ -1,7 +1,13 @@
 import os
+import copy
 
 import misopy
 import misopy.gff_utils as gff_utils
+import misopy.misc_utils as misc_utils
+
+# Recently parsed genes, keyed by indexed filename, its
+# modification time and the event name
+parsed_genes = misc_utils.LRUCache(max_size=64)
 
 def parseGene(pickle_filename, event):
     """
@@ -9,39 +15,50 @@ def parseGene(pickle_filename, event):
     """
     if not os.path.isfile(pickle_filename):
         raise Exception, "Error: no filename %s" %(pickle_filename)
-    gff_genes = gff_utils.load_indexed_gff_file(pickle_filename)
+    cache_key = (os.path.abspath(pickle_filename),
+                 os.path.getmtime(pickle_filename),
+                 event)
+    parsed_gene = parsed_genes.get(cache_key)
+    if parsed_gene is None:
+        parsed_gene = parse_indexed_gene(pickle_filename, event)
+        parsed_genes.put(cache_key, parsed_gene)
+    tx_start, tx_end, exon_starts, exon_ends, gene_obj, \
+        mRNAs, strand, chrom = parsed_gene
+    # Return copies so that callers cannot modify the cached gene
+    return tx_start, tx_end, list(exon_starts), list(exon_ends), \
+           copy.deepcopy(gene_obj), \
+           [[list(exon) for exon in mRNA] for mRNA in mRNAs], strand, chrom
+
 
-    if gff_genes == None:
-        raise Exception, "Error: could not load genes from %s" \
-              %(pickle_filename)
+def parse_indexed_gene(pickle_filename, event):
+    """
+    Load only the given event from the indexed file and parse it.
+    """
+    gene_info = gff_utils.load_indexed_gene(pickle_filename, event)
+
+    if gene_info == None:
+        raise Exception, "Error: could not load gene %s from %s" \
+              %(event, pickle_filename)
 
     exon_starts = []
     exon_ends = []
     mRNAs = []
-    chrom = None
-    for gene_id, gene_info in gff_genes.iteritems():
-        if event == gene_id:
-            gene_obj = gene_info['gene_object']
-            gene_hierarchy = gene_info['hierarchy']
-            tx_start, tx_end = gff_utils.get_inclusive_txn_bounds(\
-                gene_hierarchy[gene_id])
-            chrom = gene_obj.chrom
-
-            for mRNA_id, mRNA_info in gene_hierarchy[gene_id]['mRNAs'].iteritems():
-                mRNA = []
-                for exon_id, exon_info in gene_hierarchy[gene_id]['mRNAs']\
-                    [mRNA_id]['exons'].\
-                    iteritems():
-
-                    exon_rec = gene_hierarchy[gene_id]['mRNAs']\
-                        [mRNA_id]['exons'][exon_id]['record']
-                    strand = exon_rec.strand
-                    exon_starts.append(exon_rec.start)
-                    exon_ends.append(exon_rec.end)
-                    mRNA.append(sorted([exon_rec.start, exon_rec.end]))
-
-                mRNAs.append(mRNA)
-            break
+    gene_obj = gene_info['gene_object']
+    gene_hierarchy = gene_info['hierarchy']
+    tx_start, tx_end = gff_utils.get_inclusive_txn_bounds(\
+        gene_hierarchy[event])
+    chrom = gene_obj.chrom
+
+    for mRNA_id, mRNA_info in gene_hierarchy[event]['mRNAs'].iteritems():
+        mRNA = []
+        for exon_id, exon_info in mRNA_info['exons'].iteritems():
+            exon_rec = exon_info['record']
+            strand = exon_rec.strand
+            exon_starts.append(exon_rec.start)
+            exon_ends.append(exon_rec.end)
+            mRNA.append(sorted([exon_rec.start, exon_rec.end]))
+
+        mRNAs.append(mRNA)
 
     mRNAs.sort(key=len)
     return tx_start, tx_end, exon_starts, exon_ends, gene_obj, \
@@ -145,19 +145,28 @@ def parse_tagBam_intervals(bam_read,
     return gff_intervals
 
 
-def compute_inserts_from_paired_mates(paired_reads):
+def compute_inserts_from_paired_mates(paired_reads,
+                                      return_num_pairs=False):
     """
     Get insert lengths from paired-up paired ends reads
     aligned to a set of constitutive exon intervals.
 
+    Takes a mapping from read IDs to read pairs or an iterator
+    of (read ID, read pair), as made by sam_utils.iter_paired_reads.
+
     Return mapping from intervals to distances of read pairs
-    that land in them.
+    that land in them (and, if return_num_pairs is True, the
+    number of read pairs.)
     """
+    if isinstance(paired_reads, dict):
+        paired_reads = paired_reads.iteritems()
     # Mapping from interval to
     interval_to_paired_dists = defaultdict(list)
     num_skipped = 0
     num_kept = 0
-    for read_id, read_pair in paired_reads.iteritems():
+    num_pairs = 0
+    for read_id, read_pair in paired_reads:
+        num_pairs += 1
         to_skip = False
         # Get the intervals that each read pair lands in
         # Consider here only the mate pairs that map to
@@ -218,6 +227,8 @@ def compute_inserts_from_paired_mates(paired_reads):
     print "Used %d paired mates, threw out %d" \
           %(num_kept, num_skipped)
 
+    if return_num_pairs:
+        return interval_to_paired_dists, num_pairs
     return interval_to_paired_dists
 
 
@@ -281,12 +292,16 @@ def compute_insert_len(bams_to_process,
 
         # Load mapped BAM filename
         mapped_bam = pysam.Samfile(mapped_bam_filename, "rb")
-        ###
-        ### TODO: Rewrite this so that you only pair reads within an interval
-        ###
-        paired_reads = sam_utils.pair_sam_reads(mapped_bam,
-                                                filter_reads=filter_reads)
-        num_paired_reads = len(paired_reads)
+        # Pair the reads as they are streamed, so that only reads
+        # waiting for their mates are kept in memory
+        pair_stats = {}
+        paired_reads = sam_utils.iter_paired_reads(mapped_bam,
+                                                   filter_reads=filter_reads,
+                                                   pair_stats=pair_stats)
+        interval_to_paired_dists, num_paired_reads = \
+            compute_inserts_from_paired_mates(paired_reads,
+                                              return_num_pairs=True)
+        sam_utils.print_pair_stats(pair_stats)
 
         if num_paired_reads == 0:
             print "WARNING: no paired mates in %s. Skipping...\n"\
@@ -295,7 +310,6 @@ def compute_insert_len(bams_to_process,
                   %(bam_filename)
             continue
         print "Using %d paired mates" %(num_paired_reads)
-        interval_to_paired_dists = compute_inserts_from_paired_mates(paired_reads)
         summarize_insert_len_dist(interval_to_paired_dists, output_filename,
                                   sd_max=sd_max)
         t2 = time.time()
@@ -1,11 +1,18 @@
 import misopy
-import pysplicing
+
+# C MISO interface is optional; see the numpy_sampler module
+try:
+    import pysplicing
+except ImportError:
+    pysplicing = None
 
 def py2c_gene(py_gene):
     """
     Convert a Python Gene object to a C gene object for use
     with C MISO.
     """
+    if pysplicing is None:
+        raise Exception, "pysplicing is not available."
     # Description of exon lens
     CMISO_exon_lens = tuple([(part.start, part.end) \
                              for part in py_gene.parts])
@@ -5,6 +5,8 @@
 from collections import defaultdict
 from numpy import *
 
+import misopy.sam_utils as sam_utils
+
 def count_aligned_reads(reads, paired_end=False):
     """
     Count the number of occurrences of each aligned read.
@@ -45,3 +47,50 @@ def count_isoform_assignments(assignments):
               for iso_num in range(num_isoforms + 1)]
 
     return counts
+
+
+def compute_read_classes(gene, reads, read_len, overhang_len):
+    """
+    Group single-end reads into read classes: reads with the same
+    vector of isoform compatibilities. Reads are given as made by
+    sam_utils.sam_parse_reads, either collapsed into weighted
+    counts or not.
+
+    Since a read's likelihood under each isoform depends only
+    on its class, the sampler can work on class counts rather
+    than on individual reads.
+
+    Returns a pair of:
+    - read classes, as an array with one row per class and one
+      column per isoform (sorted, like count_aligned_reads)
+    - the number of reads in each class, as an array
+    """
+    if len(reads) != 3:
+        reads = sam_utils.collapse_reads(reads[0], reads[1])
+    positions, cigars, counts = reads
+    num_isoforms = len(gene.isoforms)
+    sam_cigars = {}
+    counts_dict = defaultdict(int)
+    for unit_positions, unit_cigars, count in zip(positions.tolist(),
+                                                  cigars,
+                                                  counts.tolist()):
+        # Reads are 0-based, isoforms are 1-based
+        start = unit_positions[0] + 1
+        cigar_str = unit_cigars[0]
+        sam_cigar = sam_cigars.get(cigar_str)
+        if sam_cigar is None:
+            sam_cigar = sam_utils.str_to_sam_cigar(cigar_str)
+            sam_cigars[cigar_str] = sam_cigar
+        read_class = []
+        for isoform in gene.isoforms:
+            isocigar = isoform.get_local_cigar(start, read_len)
+            if (isocigar and isocigar == sam_cigar) and \
+               isoform.cigar_overhang_met(isocigar, overhang_len):
+                read_class.append(1)
+            else:
+                read_class.append(0)
+        counts_dict[tuple(read_class)] += count
+    keys = sorted(counts_dict.keys())
+    read_classes = array(keys, dtype=int).reshape((len(keys), num_isoforms))
+    class_counts = array([counts_dict[k] for k in keys], dtype=int)
+    return read_classes, class_counts
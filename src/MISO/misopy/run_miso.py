@@ -7,6 +7,7 @@ import os
 import sys
 import time
 import glob
+from collections import defaultdict
 
 import misopy
 from misopy.settings import Settings
@@ -18,6 +19,8 @@ import misopy.sam_utils as sam_utils
 import misopy.miso_sampler as miso
 import misopy.Gene as gene_utils
 import misopy.gff_utils as gff_utils
+import misopy.gff_db as gff_db
+import misopy.miso_db as miso_db
 import misopy.misc_utils as misc_utils
 
 from misopy.parse_csv import *
@@ -35,7 +38,9 @@ def compute_gene_psi(gene_ids, gff_index_filename, bam_filename,
                      output_dir, read_len, overhang_len,
                      paired_end=None,
                      event_type=None,
-                     verbose=True):
+                     verbose=True,
+                     chrom_sweep=False,
+                     close_db_writers=True):
     """
     Run Psi at the Gene-level (for multi-isoform inference.)
 
@@ -47,18 +52,51 @@ def compute_gene_psi(gene_ids, gff_index_filename, bam_filename,
     - Output directory
     - Optional: Run in paired-end mode. Gives mean and standard deviation
       of fragment length distribution.
+    - Optional: Fetch the reads of all the genes in one sweep over
+      their chromosomes (see compute_genes_psi.)
+    - Optional: Leave the samples of the last events pending in the
+      process's database writers (see compute_genes_psi.)
+    """
+    print "  - GFF filename: %s" %(gff_index_filename)
+    genes = [(gene_id, gff_index_filename) for gene_id in gene_ids]
+    compute_genes_psi(genes, bam_filename, output_dir,
+                      read_len, overhang_len,
+                      paired_end=paired_end,
+                      event_type=event_type,
+                      verbose=verbose,
+                      chrom_sweep=chrom_sweep,
+                      close_db_writers=close_db_writers)
+
+
+def compute_genes_psi(genes, bam_filename,
+                      output_dir, read_len, overhang_len,
+                      paired_end=None,
+                      event_type=None,
+                      verbose=True,
+                      chrom_sweep=False,
+                      close_db_writers=True):
+    """
+    Run Psi at the Gene-level for a set of genes, given as
+    (gene ID, indexed GFF filename) pairs.
+
+    If chrom_sweep is True, the reads of all the genes are fetched
+    in one sweep over each chromosome, reading each region of
+    overlapping genes once and dispatching its reads to the genes
+    (rather than fetching the reads of each gene separately.)
+
+    When writing samples to databases, the process's database
+    writers are closed at the end unless close_db_writers is False,
+    in which case they are kept open (with their last events
+    pending) for later calls, and the caller must close them with
+    miso_db.close_miso_db_writers.
     """
     misc_utils.make_dir(output_dir)
 
-    if not os.path.exists(gff_index_filename):
-        print "Error: No GFF %s" %(gff_index_filename)
-        return
-
-    num_genes = len(gene_ids)
+    num_genes = len(genes)
 
     print "Computing Psi for %d genes..." %(num_genes)
-    print "  - " + ", ".join(gene_ids)
-    print "  - GFF filename: %s" %(gff_index_filename)
+    print "  - " + ", ".join([gene_id for gene_id, gff_index_filename \
+                              in genes])
     print "  - BAM: %s" %(bam_filename)
     print "  - Outputting to: %s" %(output_dir)
 
@@ -66,24 +104,6 @@ def compute_gene_psi(gene_ids, gff_index_filename, bam_filename,
         print "  - Paired-end mode: ", paired_end
 
     settings = Settings.get()
-    settings_params = Settings.get_sampler_params()
-    burn_in = settings_params["burn_in"]
-    lag = settings_params["lag"]
-    num_iters = settings_params["num_iters"]
-    num_chains = settings_params["num_chains"]
-
-    min_event_reads = Settings.get_min_event_reads()
-    strand_rule = Settings.get_strand_param()
-
-    mean_frag_len = None
-    frag_variance = None
-
-    if paired_end:
-        mean_frag_len = int(paired_end[0])
-        frag_variance = power(int(paired_end[1]), 2)
-
-    # Load the genes from the GFF
-    gff_genes = gff_utils.load_indexed_gff_file(gff_index_filename)
 
     # If given a template for the SAM file, use it
     template = None
@@ -91,115 +111,300 @@ def compute_gene_psi(gene_ids, gff_index_filename, bam_filename,
     if settings and "sam_template" in settings:
         template = settings["sam_template"]
 
-    if "filter_reads" not in settings:
-        filter_reads = True
-    else:
-        filter_reads = settings["filter_reads"]
-
     # Load the BAM file upfront
     bamfile = sam_utils.load_bam_reads(bam_filename,
                                        template=template)
-    # Check if we're in compressed mode
-    compressed_mode = misc_utils.is_compressed_index(gff_index_filename)
 
-    for gene_id, gene_info in gff_genes.iteritems():
-        lookup_id = gene_id
-        # Skip genes that we were not asked to run on
-        if lookup_id not in gene_ids:
+    # Load the genes from their indexed GFF files, along with
+    # the region of each gene to fetch reads from
+    genes_to_run = {}
+    gene_regions = []
+    gene_ids_by_index = defaultdict(list)
+    for gene_id, gff_index_filename in genes:
+        gene_ids_by_index[gff_index_filename].append(gene_id)
+    for gff_index_filename, gene_ids in gene_ids_by_index.iteritems():
+        if not os.path.exists(gff_index_filename):
+            print "Error: No GFF %s" %(gff_index_filename)
             continue
-        gene_obj = gene_info['gene_object']
-        gene_hierarchy = gene_info['hierarchy']
+        gff_genes = gff_utils.load_indexed_gff_file(gff_index_filename,
+                                                    gene_ids=gene_ids)
+        requested_gene_ids = set(gene_ids)
+        for gene_id, gene_info in gff_genes.iteritems():
+            # Skip genes that we were not asked to run on
+            if gene_id not in requested_gene_ids:
+                continue
+            gene_obj = gene_info['gene_object']
 
-        # Sanity check: if the isoforms are all shorter than the read,
-        # skip the event
-        if all(map(lambda l: l < read_len, gene_obj.iso_lens)):
-            print "All isoforms of %s shorter than %d, so skipping" \
-                  %(gene_id, read_len)
-            continue
+            # Sanity check: if the isoforms are all shorter than the read,
+            # skip the event
+            if all(map(lambda l: l < read_len, gene_obj.iso_lens)):
+                print "All isoforms of %s shorter than %d, so skipping" \
+                      %(gene_id, read_len)
+                continue
 
-        # Find the most inclusive transcription start and end sites
-        # for each gene
-        tx_start, tx_end = \
-            gff_utils.get_inclusive_txn_bounds(gene_info['hierarchy'][gene_id])
-
-        # Fetch reads aligning to the gene boundaries
-        gene_reads = \
-            sam_utils.fetch_bam_reads_in_gene(bamfile,
-                                              gene_obj.chrom,
-                                              tx_start,
-                                              tx_end,
-                                              gene_obj)
-        # Parse reads: checking strandedness and pairing
-        # reads in case of paired-end data
-        reads, num_raw_reads = \
-            sam_utils.sam_parse_reads(gene_reads,
-                                      paired_end=paired_end,
-                                      strand_rule=strand_rule,
-                                      target_strand=gene_obj.strand,
-                                      given_read_len=read_len)
-        # Skip gene if none of the reads align to gene boundaries
-        if filter_reads:
-            if num_raw_reads < min_event_reads:
-                print "Only %d reads in gene, skipping (needed >= %d reads)" \
-                      %(num_raw_reads,
-                        min_event_reads)
+            # Find the most inclusive transcription start and end sites
+            # for each gene
+            tx_start, tx_end = \
+                gff_utils.get_inclusive_txn_bounds(gene_info['hierarchy'][gene_id])
+            genes_to_run[gene_id] = (gene_info, gff_index_filename)
+            gene_regions.append((gene_id, gene_obj.chrom, tx_start, tx_end))
+
+    if chrom_sweep:
+        # Fetch reads aligning to the gene boundaries, sweeping
+        # over each chromosome once
+        genes_reads = sam_utils.sweep_bam_reads_in_genes(bamfile,
+                                                         gene_regions)
+    else:
+        # Fetch reads aligning to the gene boundaries, one
+        # gene at a time
+        genes_reads = \
+            ((gene_id, sam_utils.fetch_bam_reads_in_gene(bamfile,
+                                                         chrom,
+                                                         tx_start,
+                                                         tx_end))
+             for gene_id, chrom, tx_start, tx_end in gene_regions)
+
+    # Two-isoform events can be sampled in batches
+    settings_params = Settings.get_sampler_params()
+    batch_events = settings_params["batch_events"]
+    max_rhat, min_ess = get_early_stop_params(settings_params)
+    early_stop = (max_rhat is not None) and (min_ess is not None)
+    if batch_events and \
+       (miso.get_sampler_backend(Settings.get_sampler_backend(),
+                                 early_stop=early_stop) != "numpy"):
+        # Only batch when the NumPy sampler was chosen, rather
+        # than switching samplers behind the user's back
+        print "Batching events requires the numpy sampler backend " \
+              "(sampler_backend = numpy), not batching."
+        batch_events = False
+    events_batch = []
+
+    for gene_id, gene_reads in genes_reads:
+        gene_info, gff_index_filename = genes_to_run[gene_id]
+        gene_obj = gene_info['gene_object']
+        if batch_events and len(gene_obj.isoforms) == 2:
+            reads = parse_gene_reads(gene_obj, gene_reads, read_len,
+                                     paired_end=paired_end)
+            if reads is None:
                 continue
-            else:
-                print "%d raw reads in event" %(num_raw_reads)
-
-        num_isoforms = len(gene_obj.isoforms)
-        hyperparameters = ones(num_isoforms)
-
-        ##
-        ## Run the sampler
-        ##
-        # Create the sampler with the right parameters depending on whether
-        # this is a paired-end or single-end data set.
-        if paired_end:
-            # Sampler parameters for paired-end mode
-            sampler_params = \
-                miso.get_paired_end_sampler_params(num_isoforms,
-                                                   mean_frag_len,
-                                                   frag_variance,
-                                                   read_len,
-                                                   overhang_len=overhang_len)
-            sampler = miso.MISOSampler(sampler_params,
-                                       paired_end=True,
-                                       log_dir=output_dir)
+            output_filename = \
+                get_gene_output_filename(gene_id, gene_info,
+                                         gff_index_filename, output_dir,
+                                         event_type=event_type)
+            events_batch.append((reads, gene_obj, output_filename))
+            if len(events_batch) >= settings_params["batch_size"]:
+                run_sampler_batch(events_batch, output_dir,
+                                  read_len, overhang_len,
+                                  paired_end=paired_end)
+                events_batch = []
+            continue
+        run_gene_sampler(gene_id, gene_info, gene_reads,
+                         gff_index_filename, output_dir,
+                         read_len, overhang_len,
+                         paired_end=paired_end,
+                         event_type=event_type)
+    run_sampler_batch(events_batch, output_dir,
+                      read_len, overhang_len,
+                      paired_end=paired_end)
+    if close_db_writers:
+        # Write the samples of the last events to their databases
+        miso_db.close_miso_db_writers()
+
+
+def run_gene_sampler(gene_id, gene_info, gene_reads,
+                     gff_index_filename, output_dir,
+                     read_len, overhang_len,
+                     paired_end=None,
+                     event_type=None):
+    """
+    Parse the reads of a gene and run the MISO sampler on them,
+    outputting the gene's .miso file.
+    """
+    settings_params = Settings.get_sampler_params()
+    burn_in = settings_params["burn_in"]
+    lag = settings_params["lag"]
+    num_iters = settings_params["num_iters"]
+    num_chains = settings_params["num_chains"]
+    max_rhat, min_ess = get_early_stop_params(settings_params)
+    sampler_algorithm = Settings.get_sampler_algorithm()
+    sampler_backend = Settings.get_sampler_backend()
+
+    gene_obj = gene_info['gene_object']
+    # Only the NumPy sampler takes reads collapsed into weighted counts
+    early_stop = (max_rhat is not None) and (min_ess is not None)
+    collapse = (miso.get_sampler_backend(sampler_backend,
+                                         early_stop=early_stop) == "numpy")
+    reads = parse_gene_reads(gene_obj, gene_reads, read_len,
+                             paired_end=paired_end,
+                             collapse=collapse)
+    if reads is None:
+        return
 
+    num_isoforms = len(gene_obj.isoforms)
+    hyperparameters = ones(num_isoforms)
+
+    ##
+    ## Run the sampler
+    ##
+    sampler, sampler_params = make_sampler(num_isoforms, read_len,
+                                           overhang_len, output_dir,
+                                           paired_end=paired_end)
+    output_filename = get_gene_output_filename(gene_id, gene_info,
+                                               gff_index_filename,
+                                               output_dir,
+                                               event_type=event_type)
+    sampler.run_sampler(num_iters, reads, gene_obj, hyperparameters,
+                        sampler_params, output_filename,
+                        num_chains=num_chains,
+                        burn_in=burn_in,
+                        lag=lag,
+                        algorithm=sampler_algorithm,
+                        backend=sampler_backend,
+                        max_rhat=max_rhat,
+                        min_ess=min_ess)
+
+
+def run_sampler_batch(events, output_dir, read_len, overhang_len,
+                      paired_end=None):
+    """
+    Sample a batch of events with the same number of isoforms at
+    once with the NumPy sampler, outputting a .miso file for each
+    event. Takes a list of (reads, gene, output filename), with
+    reads as returned by parse_gene_reads.
+    """
+    if len(events) == 0:
+        return
+    settings_params = Settings.get_sampler_params()
+    max_rhat, min_ess = get_early_stop_params(settings_params)
+    num_isoforms = len(events[0][1].isoforms)
+    sampler, sampler_params = make_sampler(num_isoforms, read_len,
+                                           overhang_len, output_dir,
+                                           paired_end=paired_end)
+    sampler.run_sampler_batch(settings_params["num_iters"], events,
+                              num_chains=settings_params["num_chains"],
+                              burn_in=settings_params["burn_in"],
+                              lag=settings_params["lag"],
+                              max_rhat=max_rhat,
+                              min_ess=min_ess)
+
+
+def get_early_stop_params(settings_params):
+    """
+    Return the maximum R-hat and minimum effective sample size
+    to stop sampling at, or Nones if early stopping is off.
+    """
+    if settings_params["early_stop"]:
+        return settings_params["max_rhat"], settings_params["min_ess"]
+    return None, None
+
+
+def parse_gene_reads(gene_obj, gene_reads, read_len, paired_end=None,
+                     collapse=True):
+    """
+    Parse the reads of a gene, checking strandedness and pairing
+    reads in case of paired-end data. Returns the reads (collapsed
+    into weighted counts if collapse is True), or None if the gene
+    has too few reads.
+    """
+    settings = Settings.get()
+    min_event_reads = Settings.get_min_event_reads()
+    strand_rule = Settings.get_strand_param()
+
+    if "filter_reads" not in settings:
+        filter_reads = True
+    else:
+        filter_reads = settings["filter_reads"]
+
+    reads, num_raw_reads = \
+        sam_utils.sam_parse_reads(gene_reads,
+                                  paired_end=paired_end,
+                                  strand_rule=strand_rule,
+                                  target_strand=gene_obj.strand,
+                                  given_read_len=read_len,
+                                  collapse=collapse)
+    # Skip gene if none of the reads align to gene boundaries
+    if filter_reads:
+        if num_raw_reads < min_event_reads:
+            print "Only %d reads in gene, skipping (needed >= %d reads)" \
+                  %(num_raw_reads,
+                    min_event_reads)
+            return None
         else:
-            # Sampler parameters for single-end mode
-            sampler_params = miso.get_single_end_sampler_params(num_isoforms,
-                                                                read_len,
-                                                                overhang_len)
-            sampler = miso.MISOSampler(sampler_params,
-                                       paired_end=False,
-                                       log_dir=output_dir)
-
-        # Make directory for chromosome -- if given an event type, put
-        # the gene in the event type directory
-        if event_type != None:
-            chrom_dir = os.path.join(output_dir, event_type, gene_obj.chrom)
-        else:
-            chrom_dir = os.path.join(output_dir, gene_obj.chrom)
+            print "%d raw reads in event" %(num_raw_reads)
+    return reads
 
-        try:
-            os.makedirs(chrom_dir)
-        except OSError:
-            pass
 
-        # Pick .miso output filename based on the pickle filename
-        miso_basename = os.path.basename(gff_index_filename)
-        if not miso_basename.endswith(".pickle"):
-            print "Error: Invalid index file %s" %(gff_index_filename)
-            sys.exit(1)
+def make_sampler(num_isoforms, read_len, overhang_len, output_dir,
+                 paired_end=None):
+    """
+    Create the sampler with the right parameters depending on whether
+    this is a paired-end or single-end data set. Returns the sampler
+    and its parameters.
+    """
+    output_format = Settings.get_output_format()
+    if paired_end:
+        mean_frag_len = int(paired_end[0])
+        frag_variance = power(int(paired_end[1]), 2)
+        # Sampler parameters for paired-end mode
+        sampler_params = \
+            miso.get_paired_end_sampler_params(num_isoforms,
+                                               mean_frag_len,
+                                               frag_variance,
+                                               read_len,
+                                               overhang_len=overhang_len)
+        sampler = miso.MISOSampler(sampler_params,
+                                   paired_end=True,
+                                   log_dir=output_dir,
+                                   output_format=output_format)
+
+    else:
+        # Sampler parameters for single-end mode
+        sampler_params = miso.get_single_end_sampler_params(num_isoforms,
+                                                            read_len,
+                                                            overhang_len)
+        sampler = miso.MISOSampler(sampler_params,
+                                   paired_end=False,
+                                   log_dir=output_dir,
+                                   output_format=output_format)
+    return sampler, sampler_params
+
+
+def get_gene_output_filename(gene_id, gene_info, gff_index_filename,
+                             output_dir, event_type=None):
+    """
+    Return the .miso output filename of a gene (without extension),
+    making its chromosome directory.
+    """
+    gene_obj = gene_info['gene_object']
+    # Make directory for chromosome -- if given an event type, put
+    # the gene in the event type directory
+    if event_type != None:
+        chrom_dir = os.path.join(output_dir, event_type, gene_obj.chrom)
+    else:
+        chrom_dir = os.path.join(output_dir, gene_obj.chrom)
+
+    # When outputting to databases, only the directory of the
+    # chromosome's database is needed
+    if Settings.get_output_format() == "miso_db":
+        dir_to_make = os.path.dirname(chrom_dir)
+    else:
+        dir_to_make = chrom_dir
+    try:
+        os.makedirs(dir_to_make)
+    except OSError:
+        pass
+
+    # Pick .miso output filename based on the pickle filename,
+    # or on the (compressed) gene ID for indexed GFF databases
+    miso_basename = os.path.basename(gff_index_filename)
+    if gff_db.is_gff_db_fname(miso_basename):
+        miso_basename = gene_info.get('compressed_id', gene_id)
+    elif miso_basename.endswith(".pickle"):
         miso_basename = miso_basename.replace(".pickle", "")
-        output_filename = os.path.join(chrom_dir, "%s" %(miso_basename))
-        sampler.run_sampler(num_iters, reads, gene_obj, hyperparameters,
-                            sampler_params, output_filename,
-                            num_chains=num_chains,
-                            burn_in=burn_in,
-                            lag=lag)
+    else:
+        print "Error: Invalid index file %s" %(gff_index_filename)
+        sys.exit(1)
+    return os.path.join(chrom_dir, "%s" %(miso_basename))
 
 
 def run_compute_genes_from_file(options):
@@ -241,18 +446,33 @@ def run_compute_genes_from_file(options):
         print "Error: BAM filename %s does not exist." %(bam_filename)
         sys.exit(1)
     # Load the events and their indexed GFF paths
-    num_genes = 0
+    genes = []
     with open(genes_filename) as genes_in:
         for line in genes_in:
             gene_id, gff_filename = line.strip().split("\t")
             if not os.path.isfile(gff_filename):
                 print "Error: %s does not exist." %(gff_filename)
                 sys.exit(1)
+            genes.append((gene_id, gff_filename))
+            if options.chrom_sweep:
+                continue
             compute_gene_psi([gene_id], gff_filename, bam_filename,
                              output_dir, options.read_len, overhang_len,
                              paired_end=paired_end,
-                             event_type=options.event_type)
-            num_genes += 1
+                             event_type=options.event_type,
+                             close_db_writers=False)
+    if options.chrom_sweep:
+        # Run on all genes at once, sweeping over the reads of
+        # each chromosome
+        compute_genes_psi(genes, bam_filename, output_dir,
+                          options.read_len, overhang_len,
+                          paired_end=paired_end,
+                          event_type=options.event_type,
+                          chrom_sweep=True,
+                          close_db_writers=False)
+    # Write the samples of the last events to their databases
+    miso_db.close_miso_db_writers()
+    num_genes = len(genes)
     print "Processed %d genes" %(num_genes)
 
 
@@ -291,7 +511,8 @@ def run_compute_gene_psi(options):
     compute_gene_psi(gene_ids, gff_filename, bam_filename, output_dir,
                      options.read_len, overhang_len,
                      paired_end=paired_end,
-                     event_type=options.event_type)
+                     event_type=options.event_type,
+                     chrom_sweep=options.chrom_sweep)
 
 
 def greeting(parser=None):
@@ -380,11 +601,18 @@ def main():
     parser.add_option("--event-type", dest="event_type", default=None,
                       help="Event type of two-isoform "
                       "events (e.g. 'SE', 'RI', 'A3SS', ...)")
+    parser.add_option("--chrom-sweep", dest="chrom_sweep", default=False,
+                      action="store_true",
+                      help="Fetch the reads of all the genes in one sweep "
+                      "over each chromosome, reading the reads of "
+                      "overlapping genes from the BAM file only once. "
+                      "Applies to --compute-gene-psi and "
+                      "--compute-genes-from-file.")
     parser.add_option("--use-compressed", dest="use_compressed",
                       nargs=1, default=None,
                       help="Use compressed event IDs. Takes as input a "
-                      "genes_to_filenames.shelve file produced by the "
-                      "index_gff script.")
+                      "compressed_ids_to_genes.txt (or .shelve) file "
+                      "produced by the index_gff script.")
     ##
     ## Gene utilities
     ##
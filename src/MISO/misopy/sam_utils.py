@@ -9,10 +9,12 @@ from misopy.Gene import load_genes_from_gff
 
 import os
 import time
+import heapq
 import pysam
 import binascii
 import ctypes
 
+import numpy as np
 from numpy import array
 from scipy import *
 
@@ -151,6 +153,38 @@ def load_bam_reads(bam_filename,
     return bamfile
 
 
+def get_bam_chrom(bamfile, chrom):
+    """
+    Return the name of the chromosome in the BAM file, which
+    may lack the 'chr' prefix of the GFF chromosome.
+    """
+    if chrom in bamfile.references:
+        return chrom
+    chrom_parts = chrom.split("chr")
+    if len(chrom_parts) <= 1:
+        return chrom_parts[0]
+    return chrom_parts[1]
+
+
+def count_bam_reads_in_gene(bamfile, chrom, start, end,
+                            max_reads=None):
+    """
+    Return the number of BAM reads overlapping the gene's
+    region, or 0 if the region cannot be fetched. If max_reads
+    is given, stop counting at max_reads reads.
+    """
+    chrom = get_bam_chrom(bamfile, chrom)
+    num_reads = 0
+    try:
+        for read in bamfile.fetch(chrom, start, end):
+            num_reads += 1
+            if num_reads == max_reads:
+                break
+    except (ValueError, AssertionError):
+        return 0
+    return num_reads
+
+
 def fetch_bam_reads_in_gene(bamfile, chrom, start, end,
                             gene=None):
     """
@@ -158,14 +192,7 @@ def fetch_bam_reads_in_gene(bamfile, chrom, start, end,
     """
     gene_reads = []
 
-    if chrom in bamfile.references:
-        pass
-    else:
-        chrom_parts = chrom.split("chr")
-        if len(chrom_parts) <= 1:
-            chrom = chrom_parts[0]
-        else:
-            chrom = chrom_parts[1]
+    chrom = get_bam_chrom(bamfile, chrom)
 
     try:
         gene_reads = bamfile.fetch(chrom, start, end)
@@ -181,6 +208,108 @@ def fetch_bam_reads_in_gene(bamfile, chrom, start, end,
     return gene_reads
 
 
+def get_read_end(read):
+    """
+    Return the (0-based, exclusive) end coordinate of the read on
+    the reference, as used by the BAM index to find the reads
+    overlapping a region.
+    """
+    read_end = read.aend
+    if read.is_unmapped or (read_end is None) or (read_end <= read.pos):
+        read_end = read.pos + 1
+    return read_end
+
+
+def merge_gene_regions(genes):
+    """
+    Merge the regions of genes on a chromosome into clusters of
+    overlapping genes. Takes a list of (gene ID, start, end) sorted
+    by start and returns a list of (start, end, genes) clusters.
+    """
+    clusters = []
+    for gene in genes:
+        gene_id, start, end = gene
+        if len(clusters) > 0 and start < clusters[-1][1]:
+            cluster = clusters[-1]
+            cluster[1] = max(cluster[1], end)
+            cluster[2].append(gene)
+        else:
+            clusters.append([start, end, [gene]])
+    return [tuple(cluster) for cluster in clusters]
+
+
+def dispatch_reads_to_genes(reads, genes):
+    """
+    Dispatch reads sorted by position to the genes they overlap.
+    Takes a list of (gene ID, start, end) sorted by start and
+    yields (gene ID, reads) pairs, each as soon as no later read
+    can overlap the gene.
+    """
+    # Genes that reads may still overlap, as
+    # [gene ID, start, end, reads] lists
+    active_genes = []
+    next_gene = 0
+    for read in reads:
+        read_start = read.pos
+        read_end = get_read_end(read)
+        # Reads are sorted by start, so genes ending before this
+        # read are done
+        if len(active_genes) > 0 and \
+           min([gene[2] for gene in active_genes]) <= read_start:
+            still_active = []
+            for gene in active_genes:
+                if gene[2] <= read_start:
+                    yield gene[0], gene[3]
+                else:
+                    still_active.append(gene)
+            active_genes = still_active
+        while next_gene < len(genes) and genes[next_gene][1] < read_end:
+            gene_id, start, end = genes[next_gene]
+            active_genes.append([gene_id, start, end, []])
+            next_gene += 1
+        for gene in active_genes:
+            if (gene[1] < read_end) and (read_start < gene[2]):
+                gene[3].append(read)
+    for gene in active_genes:
+        yield gene[0], gene[3]
+    for gene_id, start, end in genes[next_gene:]:
+        yield gene_id, []
+
+
+def sweep_bam_reads_in_genes(bamfile, genes):
+    """
+    Fetch the BAM reads of many genes, reading each region of
+    overlapping genes from the BAM file only once.
+
+    Takes a list of (gene ID, chrom, start, end) with the same
+    coordinates as fetch_bam_reads_in_gene and yields (gene ID,
+    reads) pairs, where the reads are those (and in the same
+    order as) fetch_bam_reads_in_gene would return for the gene.
+    Genes are yielded chromosome by chromosome, not in the order
+    they were given.
+    """
+    genes_by_chrom = defaultdict(list)
+    chroms = []
+    for gene_id, chrom, start, end in genes:
+        if chrom not in genes_by_chrom:
+            chroms.append(chrom)
+        genes_by_chrom[chrom].append((gene_id, start, end))
+    for chrom in chroms:
+        chrom_genes = sorted(genes_by_chrom[chrom],
+                             key=lambda gene: gene[1])
+        bam_chrom = get_bam_chrom(bamfile, chrom)
+        for start, end, cluster_genes in merge_gene_regions(chrom_genes):
+            try:
+                reads = bamfile.fetch(bam_chrom, start, end)
+            except (ValueError, AssertionError):
+                print "Cannot fetch reads in region: %s:%d-%d" \
+                      %(bam_chrom, start, end)
+                reads = []
+            for gene_id, gene_reads in dispatch_reads_to_genes(reads,
+                                                               cluster_genes):
+                yield gene_id, gene_reads
+
+
 def flag_to_strand(flag):
     """
     Takes integer flag as argument.
@@ -207,17 +336,49 @@ def strip_mate_id(read_name):
     return read_name
 
 
-def pair_sam_reads(samfile,
-                   filter_reads=True,
-                   return_unpaired=False,
-                   strand_rule=None):
+def iter_paired_reads(samfile,
+                      filter_reads=True,
+                      strand_rule=None,
+                      unpaired_reads=None,
+                      pair_stats=None):
     """
-    Pair reads from a SAM file together.
+    Pair reads from a position-sorted SAM/BAM stream, yielding
+    (read name, [left mate, right mate]) as soon as both mates
+    are seen.
+
+    A read is paired with a waiting read of the same name only if
+    each one's mate chromosome and position point at the other, so
+    multimapped reads are not paired across loci. Secondary and
+    supplementary alignments are skipped.
+
+    Reads waiting for their mate are dropped as unpaired once the
+    stream passes the mate's position (as given by the read's mate
+    chromosome and position), so only reads whose fragments span
+    the current position are kept in memory.
+
+    - unpaired_reads: if given a dictionary, reads that could not
+      be paired are added to it, keyed by name.
+    - pair_stats: if given a dictionary, the number of read pairs
+      ('pairs'), pairs with mates on the same strand ('same_strand')
+      and reads with no mate ('unpaired') are recorded in it.
     """
-    paired_reads = defaultdict(list)
-    unpaired_reads = {}
+    if pair_stats is None:
+        pair_stats = {}
+    for stat in ["pairs", "same_strand", "unpaired"]:
+        pair_stats.setdefault(stat, 0)
+    # Reads waiting for their mate, by name and the mate's
+    # expected (chromosome, position)
+    pending_reads = {}
+    # Heap of (mate chromosome, mate position, order, key, read)
+    # for the waiting reads
+    pending_mates = []
+    num_pending = 0
 
     for read in samfile:
+        # Only primary alignments are paired
+        if read.is_secondary or read.is_supplementary:
+            continue
+
         curr_name = read.qname
 
         # Strip canonical mate IDs
@@ -227,37 +388,59 @@ def pair_sam_reads(samfile,
             # Skip reads that failed QC or are unmapped
             if read.is_qcfail or read.is_unmapped or \
                read.mate_is_unmapped or (not read.is_paired):
-                unpaired_reads[curr_name] = read
+                if unpaired_reads is not None:
+                    unpaired_reads[curr_name] = read
+                continue
+
+        # Drop waiting reads whose mate position has been passed
+        curr_coord = (read.tid, read.pos)
+        while len(pending_mates) > 0 and \
+              pending_mates[0][0:2] < curr_coord:
+            pending_key, pending_read = heapq.heappop(pending_mates)[-2:]
+            if pending_reads.get(pending_key) is pending_read:
+                del pending_reads[pending_key]
+                pair_stats["unpaired"] += 1
+                if unpaired_reads is not None:
+                    unpaired_reads[pending_key[0]] = pending_read
+
+        # The waiting mate, if any, expects this read's position
+        # and lies where this read expects its mate
+        mate = pending_reads.get((curr_name, read.tid, read.pos))
+        if (mate is None) or (mate.tid != read.mrnm) or \
+           (mate.pos != read.mpos):
+            curr_key = (curr_name, read.mrnm, read.mpos)
+            if curr_key in pending_reads:
+                # Another alignment of the name already waits for
+                # a mate here
+                pair_stats["unpaired"] += 1
+                if unpaired_reads is not None:
+                    unpaired_reads[curr_name] = read
                 continue
-        paired_reads[curr_name].append(read)
+            pending_reads[curr_key] = read
+            if (read.mrnm >= 0) and (read.mpos >= 0):
+                heapq.heappush(pending_mates,
+                               (read.mrnm, read.mpos, num_pending,
+                                curr_key, read))
+                num_pending += 1
+            continue
+        del pending_reads[(curr_name, read.tid, read.pos)]
+
+        read_pair = [mate, read]
         # Ensure that the reads that were paired are
         # in the right order - i.e., that read1 is
         # first and read2 follows.
-        if len(paired_reads[curr_name]) == 2:
-            if strand_rule == "fr-firststrand":
-                # Thanks to Renee Sears:
-                # For fr-firststrand the /1 read should only be left of the
-                # right if it is on the '+' strand whereas the /2 read
-                # should be to the left if it is on the '+' strand
-                if paired_reads[curr_name][0].is_read1 and \
-                   paired_reads[curr_name][0].is_reverse:
-                    paired_reads[curr_name] = paired_reads[curr_name][::-1]
-                if paired_reads[curr_name][0].is_read2 and \
-                    paired_reads[curr_name][0].is_reverse:
-                    paired_reads[curr_name] = paired_reads[curr_name][::-1]
-
-    to_delete = []
-    num_unpaired = 0
-    num_total = 0
-
-    for read_name, read in paired_reads.iteritems():
-        if len(read) != 2:
-            unpaired_reads[read_name] = read
-            num_unpaired += 1
-            # Delete unpaired reads
-            to_delete.append(read_name)
-            continue
-        left_read, right_read = read[0], read[1]
+        if strand_rule == "fr-firststrand":
+            # Thanks to Renee Sears:
+            # For fr-firststrand the /1 read should only be left of the
+            # right if it is on the '+' strand whereas the /2 read
+            # should be to the left if it is on the '+' strand
+            if read_pair[0].is_read1 and \
+               read_pair[0].is_reverse:
+                read_pair = read_pair[::-1]
+            if read_pair[0].is_read2 and \
+                read_pair[0].is_reverse:
+                read_pair = read_pair[::-1]
+        left_read, right_read = read_pair
 
         # Check that read mates are on opposite strands
         left_strand = flag_to_strand(left_read.flag)
@@ -265,23 +448,54 @@ def pair_sam_reads(samfile,
 
         if left_strand == right_strand:
             # Skip read pairs that are on the same strand
-            to_delete.append(read_name)
+            pair_stats["same_strand"] += 1
             continue
 
         if left_read.pos > right_read.pos:
             print "WARNING: %s left mate starts later than right "\
                   "mate" %(left_read.qname)
-        num_total += 1
+        pair_stats["pairs"] += 1
+        yield curr_name, read_pair
+
+    # Reads whose mates were never seen
+    for pending_key, read in pending_reads.iteritems():
+        pair_stats["unpaired"] += 1
+        if unpaired_reads is not None:
+            unpaired_reads[pending_key[0]] = read
 
-    # Delete reads that are on the same strand
-    for del_key in to_delete:
-        del paired_reads[del_key]
 
+def print_pair_stats(pair_stats):
+    """
+    Print the statistics recorded by iter_paired_reads.
+    """
     print "Filtered out %d read pairs that were on same strand." \
-        %(len(to_delete))
+        %(pair_stats["same_strand"])
     print "Filtered out %d reads that had no paired mate." \
-        %(num_unpaired)
-    print "  - Total read pairs: %d" %(num_total)
+        %(pair_stats["unpaired"])
+    print "  - Total read pairs: %d" %(pair_stats["pairs"])
+
+
+def pair_sam_reads(samfile,
+                   filter_reads=True,
+                   return_unpaired=False,
+                   strand_rule=None):
+    """
+    Pair reads from a SAM file together.
+
+    The reads must be sorted by position; see iter_paired_reads.
+    """
+    paired_reads = {}
+    unpaired_reads = {}
+    pair_stats = {}
+
+    for read_name, read_pair in iter_paired_reads(samfile,
+                                                  filter_reads=filter_reads,
+                                                  strand_rule=strand_rule,
+                                                  unpaired_reads=unpaired_reads,
+                                                  pair_stats=pair_stats):
+        paired_reads[read_name] = read_pair
+
+    print_pair_stats(pair_stats)
 
     if not return_unpaired:
         return paired_reads
@@ -292,6 +506,12 @@ def pair_sam_reads(samfile,
 # Global variable containing CIGAR types for conversion
 CIGAR_TYPES = ('M', 'I', 'D', 'N', 'S', 'H', 'P')
 
+# CIGAR strings already converted, keyed by pysam CIGAR. Reads
+# with the same CIGAR share a single string.
+cigar_strs = {}
+# Maximum number of CIGAR strings to keep
+MAX_CIGAR_STRS = 100000
+
 def sam_cigar_to_str(sam_cigar):
     """
     Convert pysam CIGAR list to string format.
@@ -305,11 +525,103 @@ def sam_cigar_to_str(sam_cigar):
     cigar_str = ""
     if sam_cigar is None:
         return cigar_str
+    cigar_key = tuple(sam_cigar)
+    cigar_str = cigar_strs.get(cigar_key)
+    if cigar_str is not None:
+        return cigar_str
+    cigar_str = ""
     for c in sam_cigar:
         cigar_str += "%d%s" %(c[1], CIGAR_TYPES[c[0]])
+    if len(cigar_strs) >= MAX_CIGAR_STRS:
+        cigar_strs.clear()
+    cigar_strs[cigar_key] = cigar_str
     return cigar_str
 
 
+def str_to_sam_cigar(cigar_str):
+    """
+    Convert a CIGAR string back to a pysam CIGAR list
+    of (type, length) tuples.
+    """
+    sam_cigar = []
+    seq_len = 0
+    for c in cigar_str:
+        if c.isdigit():
+            seq_len = seq_len * 10 + int(c)
+        else:
+            sam_cigar.append((CIGAR_TYPES.index(c), seq_len))
+            seq_len = 0
+    return sam_cigar
+
+
+def collapse_reads(read_positions, read_cigars, reads_per_unit=1):
+    """
+    Collapse identical reads into weighted counts. Takes the read
+    positions and CIGAR strings as made by sam_parse_reads, where
+    each unit (a read, or with reads_per_unit=2, a read pair)
+    spans reads_per_unit consecutive entries.
+
+    Return a tuple of:
+    - positions of the distinct units, as an array with one row
+      per unit
+    - CIGAR strings of the distinct units, one tuple per unit
+    - the number of times each distinct unit occurs, as an array
+    """
+    num_units = len(read_positions) / reads_per_unit
+    if num_units == 0:
+        return np.zeros((0, reads_per_unit), dtype=np.int64), (), \
+               np.zeros(0, dtype=np.int64)
+    # Number the distinct CIGAR strings
+    cigar_codes = {}
+    cigar_list = []
+    codes = []
+    for cigar_str in read_cigars:
+        code = cigar_codes.get(cigar_str)
+        if code is None:
+            code = len(cigar_list)
+            cigar_codes[cigar_str] = code
+            cigar_list.append(cigar_str)
+        codes.append(code)
+    positions = np.array(read_positions,
+                         dtype=np.int64).reshape((num_units, reads_per_unit))
+    codes = np.array(codes, dtype=np.int64).reshape((num_units,
+                                                     reads_per_unit))
+    # Find distinct units of (positions, CIGAR codes)
+    if reads_per_unit == 1:
+        # Single reads can be keyed by a single integer
+        keys = positions[:, 0] * len(cigar_list) + codes[:, 0]
+        keys, first_units, counts = np.unique(keys,
+                                              return_index=True,
+                                              return_counts=True)
+        positions = positions[first_units]
+        codes = codes[first_units]
+    else:
+        units, counts = np.unique(np.hstack([positions, codes]),
+                                  axis=0, return_counts=True)
+        positions = units[:, 0:reads_per_unit]
+        codes = units[:, reads_per_unit:]
+    cigars = tuple([tuple([cigar_list[code] for code in unit_codes]) \
+                    for unit_codes in codes.tolist()])
+    return positions, cigars, counts.astype(np.int64)
+
+
+def expand_collapsed_reads(reads):
+    """
+    Expand reads collapsed by collapse_reads back into a tuple
+    of read positions and a tuple of CIGAR strings, with one entry
+    per read (as made by sam_parse_reads without collapsing.)
+    """
+    positions, cigars, counts = reads
+    read_positions = []
+    read_cigars = []
+    for unit_positions, unit_cigars, count in zip(positions.tolist(),
+                                                  cigars,
+                                                  counts.tolist()):
+        read_positions.extend(unit_positions * count)
+        read_cigars.extend(unit_cigars * count)
+    return tuple(read_positions), tuple(read_cigars)
+
+
 def read_matches_strand(read,
                         target_strand,
                         strand_rule,
@@ -354,7 +666,8 @@ def sam_parse_reads(samfile,
                     paired_end=False,
                     strand_rule=None,
                     target_strand=None,
-                    given_read_len=None):
+                    given_read_len=None,
+                    collapse=False):
     """
     Parse the SAM reads. If paired-end, pair up the mates
     together.
@@ -372,6 +685,9 @@ def sam_parse_reads(samfile,
     If passed to this function, it will filter out all reads
     that do not have this length (e.g. in mixed read length
     BAM file.)
+    - collapse: if True, collapse identical reads (or read pairs)
+    into weighted counts and return the reads as made by
+    collapse_reads.
     """
     read_positions = []
     read_cigars = []
@@ -392,13 +708,15 @@ def sam_parse_reads(samfile,
     # violations, if strand-specific
     num_strand_discarded = 0
     if paired_end:
-        # Pair up the reads
-        paired_reads = pair_sam_reads(samfile,
-                                      strand_rule=strand_rule)
+        # Pair up the reads as they are streamed
+        pair_stats = {}
+        paired_reads = iter_paired_reads(samfile,
+                                         strand_rule=strand_rule,
+                                         pair_stats=pair_stats)
         # Process reads into format required by fastmiso
         # MISO C engine requires pairs to follow each other in order.
         # Unpaired reads are not supported.
-        for read_id, read_info in paired_reads.iteritems():
+        for read_id, read_info in paired_reads:
             if check_strand:
                 # Check strand
                 if not read_matches_strand(read_info,
@@ -409,7 +727,9 @@ def sam_parse_reads(samfile,
                     num_strand_discarded += 1
                     continue
             read1, read2 = read_info
-            if (read1.cigar is None) or (read2.cigar is None):
+            sam_cigar1 = read1.cigar
+            sam_cigar2 = read2.cigar
+            if (sam_cigar1 is None) or (sam_cigar2 is None):
                 continue
             # Filter on given read length here for PAIRED-END
             # If either mate is not of the given read length,
@@ -421,13 +741,15 @@ def sam_parse_reads(samfile,
             # Read positions and cigar strings are collected
             read_positions.append(int(read1.pos))
             read_positions.append(int(read2.pos))
-            read_cigars.append(sam_cigar_to_str(read1.cigar))
-            read_cigars.append(sam_cigar_to_str(read2.cigar))
+            read_cigars.append(sam_cigar_to_str(sam_cigar1))
+            read_cigars.append(sam_cigar_to_str(sam_cigar2))
             num_reads += 1
+        print_pair_stats(pair_stats)
     else:
         # Single-end
         for read in samfile:
-            if read.cigar is None:
+            sam_cigar = read.cigar
+            if sam_cigar is None:
                 continue
             # Filter on given read length here for SINGLE-END
             if given_read_len is not None:
@@ -443,15 +765,22 @@ def sam_parse_reads(samfile,
                     num_strand_discarded += 1
                     continue
             read_positions.append(int(read.pos))
-            read_cigars.append(sam_cigar_to_str(read.cigar))
+            read_cigars.append(sam_cigar_to_str(sam_cigar))
             num_reads += 1
 
     if check_strand:
         print "No. reads discarded due to strand violation: %d" \
             %(num_strand_discarded)
 
-    reads = (tuple(read_positions),
-             tuple(read_cigars))
+    if collapse:
+        reads_per_unit = 1
+        if paired_end:
+            reads_per_unit = 2
+        reads = collapse_reads(read_positions, read_cigars,
+                               reads_per_unit=reads_per_unit)
+    else:
+        reads = (tuple(read_positions),
+                 tuple(read_cigars))
 
     return reads, num_reads
 
@@ -10,8 +10,10 @@ from collections import defaultdict
 import os
 import sys
 import glob
+import multiprocessing
 import misopy
 import misopy.miso_db as miso_db
+import misopy.miso_bin as miso_bin
 
 from misopy.parse_csv import *
 from misopy.credible_intervals import *
@@ -22,7 +24,8 @@ class MISOSamples:
     """
     Representation of MISO samples directory.
     The samples filename is either a plain-text *.miso
-    file, e.g. event_name.miso, or a .miso_db file.
+    file, e.g. event_name.miso, a binary *.miso_bin file,
+    or a .miso_db file.
     """
     def __init__(self, samples_dir, use_compressed=None):
         self.samples_dir = samples_dir
@@ -50,6 +53,9 @@ class MISOSamples:
         #   myevent -> myevent.miso
         #   myotherevent_on_chr12 -> chr12.miso_db
         self.event_names_to_fnames = {}
+        # Open *.miso_db files, kept for the lifetime of the object
+        self.dbs = {}
+        self.dbs_pid = os.getpid()
         # Get all the event names in the current samples directory
         self.all_event_names = self.get_all_event_names()
         self.num_events = len(self.all_event_names)
@@ -61,8 +67,10 @@ class MISOSamples:
         """
         all_event_names = []
         for curr_fname in self.all_filenames:
-            if curr_fname.endswith(".miso"):
-                # It's a regular .miso plain text file
+            if curr_fname.endswith(".miso") or \
+               miso_bin.is_miso_bin_fname(curr_fname):
+                # It's a regular .miso plain text file or a binary
+                # .miso_bin file
                 event_name = \
                   get_event_name(curr_fname,
                                  use_compressed_map=self.compressed_ids_to_genes)
@@ -72,54 +80,202 @@ class MISOSamples:
             elif miso_db.is_miso_db_fname(curr_fname):
                 # It's a MISO database file, so load all the event
                 # names in that file
-                curr_db = \
-                  miso_db.MISODatabase(curr_fname,
-                                       comp_to_uncomp=self.compressed_ids_to_genes)
+                curr_db = self.get_db(curr_fname)
                 # Record event name and its mapping to the chromosome's
                 # .miso_db file
                 for curr_event_name in curr_db.get_all_event_names():
-                    curr_event_name = str(curr_event_name)
-                    event_name_to_use = curr_event_name
-                    # If we're given a mapping of compressed IDs, use the
-                    # mapping to get the uncompressed event name
-                    if self.compressed_ids_to_genes is not None:
-                        # The internal database representation of compressed
-                        # index databases are compressed IDs, so if the
-                        # ID is uncompressed it must be converted to a
-                        # compressed one.
-                        if not misc_utils.is_compressed_name(curr_event_name):
-                            event_name_to_use = \
-                              str(curr_db.uncomp_to_comp[curr_event_name])
+                    event_name_to_use = \
+                      self.get_db_event_name(curr_db, curr_event_name)
                     all_event_names.append(event_name_to_use)
                     self.event_names_to_fnames[event_name_to_use] = curr_fname
         return all_event_names
 
 
+    def get_db_event_name(self, curr_db, curr_event_name):
+        """
+        Return the name to use for an event as stored in the given
+        *.miso_db file.
+        """
+        curr_event_name = str(curr_event_name)
+        event_name_to_use = curr_event_name
+        # If we're given a mapping of compressed IDs, use the
+        # mapping to get the uncompressed event name
+        if self.compressed_ids_to_genes is not None:
+            # The internal database representation of compressed
+            # index databases are compressed IDs, so if the
+            # ID is uncompressed it must be converted to a
+            # compressed one.
+            if not misc_utils.is_compressed_name(curr_event_name):
+                event_name_to_use = \
+                  str(curr_db.uncomp_to_comp[curr_event_name])
+        return event_name_to_use
+
+
+    def get_dbs(self):
+        """
+        Return the open *.miso_db files, by filename. Connections
+        are not shared with forked processes: a process gets its
+        own connections.
+        """
+        if self.dbs_pid != os.getpid():
+            self.dbs = {}
+            self.dbs_pid = os.getpid()
+        return self.dbs
+
+
+    def get_db(self, db_fname):
+        return get_miso_db(db_fname,
+                           compressed_ids_to_genes=self.compressed_ids_to_genes,
+                           dbs=self.get_dbs())
+
+
+    def close_dbs(self):
+        for curr_db in self.get_dbs().values():
+            curr_db.close()
+        self.dbs = {}
+
+
+    def iter_event_samples(self):
+        """
+        Iterate over the samples of all events, yielding (event
+        name, samples) pairs. Events are read in the order they are
+        stored: file by file, and the events of a *.miso_db file in
+        one pass over the database.
+        """
+        for curr_fname in self.all_filenames:
+            if miso_db.is_miso_db_fname(curr_fname):
+                curr_db = self.get_db(curr_fname)
+                for curr_event_name, event_data in curr_db.iter_events_data():
+                    event_name = \
+                      self.get_db_event_name(curr_db, curr_event_name)
+                    samples = load_samples(event_data)
+                    if samples is None:
+                        print "WARNING: Could not parse event %s samples" \
+                              %(event_name)
+                        continue
+                    yield event_name, samples
+            elif curr_fname.endswith(".miso") or \
+               miso_bin.is_miso_bin_fname(curr_fname):
+                event_name = \
+                  get_event_name(curr_fname,
+                                 use_compressed_map=self.compressed_ids_to_genes)
+                samples = self.get_event_samples(event_name)
+                if samples is None:
+                    continue
+                yield event_name, samples
+
+
     def get_event_samples(self, event_name):
         """
         Get the samples information for the given event by name.
         """
-        samples = None
         if event_name not in self.event_names_to_fnames:
             return None
         event_fname = self.event_names_to_fnames[event_name]
-        if event_fname.endswith(".miso"):
-            # Get event from plain text .miso file
-            f = open(event_fname, "r")
-            samples = load_samples(f)
-            f.close()
-        elif miso_db.is_miso_db_fname(event_fname):
-            # Get event from miso_db file
-            curr_db = \
-              miso_db.MISODatabase(event_fname,
-                                   comp_to_uncomp=self.compressed_ids_to_genes)
-            event_data = curr_db.get_event_data_as_stream(event_name)
-            samples = load_samples(event_data)
+        samples = load_event_samples(event_name, event_fname,
+                                     compressed_ids_to_genes=self.compressed_ids_to_genes,
+                                     dbs=self.get_dbs())
         if samples is None:
             print "WARNING: Could not parse event %s samples" %(event_name)
         return samples
 
 
+    def get_events_samples(self, event_names):
+        """
+        Get the samples information for the given events, fetching
+        the events of a *.miso_db file together. Return a dictionary
+        from the names of the events that were found to their samples.
+        """
+        events = [(event_name, self.event_names_to_fnames[event_name]) \
+                  for event_name in event_names \
+                  if event_name in self.event_names_to_fnames]
+        events_samples = \
+          load_events_samples(events,
+                              compressed_ids_to_genes=self.compressed_ids_to_genes,
+                              dbs=self.get_dbs())
+        samples_by_event = {}
+        for (event_name, event_fname), samples in zip(events, events_samples):
+            if samples is None:
+                print "WARNING: Could not parse event %s samples" %(event_name)
+                continue
+            samples_by_event[event_name] = samples
+        return samples_by_event
+
+
+def get_miso_db(db_fname, compressed_ids_to_genes=None, dbs=None):
+    """
+    Return the MISODatabase of the given *.miso_db file. If given
+    dbs, a dictionary of open databases by filename, the database
+    is reused from it or added to it.
+    """
+    if dbs is None:
+        return miso_db.MISODatabase(db_fname,
+                                    comp_to_uncomp=compressed_ids_to_genes)
+    if db_fname not in dbs:
+        dbs[db_fname] = \
+          miso_db.MISODatabase(db_fname,
+                               comp_to_uncomp=compressed_ids_to_genes)
+    return dbs[db_fname]
+
+
+def load_event_samples(event_name, event_fname,
+                       compressed_ids_to_genes=None,
+                       dbs=None):
+    """
+    Load the samples of the given event from its *.miso, *.miso_bin
+    or *.miso_db file. *.miso_db files are opened as get_miso_db
+    does with the given dbs.
+    """
+    samples = None
+    if event_fname.endswith(".miso"):
+        # Get event from plain text .miso file
+        f = open(event_fname, "r")
+        samples = load_samples(f)
+        f.close()
+    elif miso_bin.is_miso_bin_fname(event_fname):
+        # Get event from binary .miso_bin file
+        samples = load_samples_bin(event_fname)
+    elif miso_db.is_miso_db_fname(event_fname):
+        # Get event from miso_db file
+        curr_db = get_miso_db(event_fname,
+                              compressed_ids_to_genes=compressed_ids_to_genes,
+                              dbs=dbs)
+        event_data = curr_db.get_event_data_as_stream(event_name)
+        samples = load_samples(event_data)
+    return samples
+
+
+def load_events_samples(events, compressed_ids_to_genes=None, dbs=None):
+    """
+    Load the samples of a list of (event name, filename) pairs, as
+    load_event_samples does. The events of a *.miso_db file are
+    fetched from it together. Return the samples of each event
+    (None if they could not be loaded.)
+    """
+    events_samples = [None] * len(events)
+    db_events = defaultdict(list)
+    for event_num, (event_name, event_fname) in enumerate(events):
+        if miso_db.is_miso_db_fname(event_fname):
+            db_events[event_fname].append(event_num)
+        else:
+            events_samples[event_num] = \
+              load_event_samples(event_name, event_fname,
+                                 compressed_ids_to_genes=compressed_ids_to_genes)
+    for db_fname, event_nums in db_events.iteritems():
+        curr_db = get_miso_db(db_fname,
+                              compressed_ids_to_genes=compressed_ids_to_genes,
+                              dbs=dbs)
+        events_data = \
+          curr_db.get_events_data_as_streams([events[event_num][0] \
+                                              for event_num in event_nums])
+        for event_num in event_nums:
+            event_name = events[event_num][0]
+            if event_name in events_data:
+                events_samples[event_num] = \
+                  load_samples(events_data[event_name])
+    return events_samples
+
+
 def maxi(l):
     m = max(l)
     for i, v in enumerate(l):
@@ -129,31 +285,93 @@ def maxi(l):
 
 def load_samples(samples_in):
     """
-    Load a file with samples. Takes in a string of data.
+    Load a file with samples. Takes in a stream or a filename.
     Return the samples, header from the file, the sampled MAP estimate,
     and the sampled MAP's log score.
     """
     try:
-        data, h = csv2array(samples_in, skiprows=1, raw_header=True)
-        sampled_map_indx = maxi(data['sampled_psi'])
-        sampled_map = \
-            [float(v) for v in data['sampled_psi'][sampled_map_indx].split(',')]
-        sampled_map_log_score = data['log_score'][sampled_map_indx]
-        #    print "  - Sampled MAP: %s" %(sampled_map)
-        #    print "  - Sampled MAP log score: %.4f" %(sampled_map_log_score)
-        samples = []
-        for vals in data['sampled_psi']:
-            psi_vals = [float(v) for v in vals.split(',')]
-            samples.append(psi_vals)
-        samples = array(samples)
-
-        # Extract counts from the file's header
-        counts_info = get_counts_from_header(h[0])
-
-        return (samples, h, data['log_score'], sampled_map,
-                sampled_map_log_score, counts_info)
+        header, samples, log_scores = parse_samples(samples_in)
     except ValueError:
         return None
+    if len(samples) == 0:
+        return None
+    sampled_map_indx = get_sampled_map_index(samples)
+    sampled_map = [float(v) for v in samples[sampled_map_indx]]
+    sampled_map_log_score = log_scores[sampled_map_indx]
+    #    print "  - Sampled MAP: %s" %(sampled_map)
+    #    print "  - Sampled MAP log score: %.4f" %(sampled_map_log_score)
+
+    # Extract counts from the file's header
+    counts_info = get_counts_from_header(header)
+
+    return (samples, [header], log_scores, sampled_map,
+            sampled_map_log_score, counts_info)
+
+
+def parse_samples(samples_in):
+    """
+    Parse the samples of a *.miso file, given as a stream or a
+    filename. Return the header line, the Psi samples (an array of
+    num_samples by num_isoforms) and their log scores.
+
+    The samples are parsed in bulk: the body of the file consists of
+    lines of comma-separated Psi values followed by a tab and the log
+    score, so it is read as one whitespace-separated list of numbers.
+    """
+    if isinstance(samples_in, basestring):
+        with open(samples_in) as samples_file:
+            return parse_samples(samples_file)
+    header = samples_in.readline().strip()
+    # Skip the sampled_psi/log_score fields line
+    samples_in.readline()
+    body = samples_in.read()
+    first_line = body.lstrip().split("\n", 1)[0]
+    if first_line == "":
+        return header, zeros((0, 0)), zeros(0)
+    num_isoforms = first_line.count(",") + 1
+    num_lines = len(body.strip().split("\n"))
+    # Parsing stops at the first token that is not a number, so
+    # check that every value of every line was read
+    values = fromstring(body.replace(",", " "), sep=" ")
+    if len(values) != num_lines * (num_isoforms + 1):
+        raise ValueError, "Malformed samples."
+    values = values.reshape((-1, num_isoforms + 1))
+    return header, values[:, :num_isoforms], values[:, num_isoforms]
+
+
+def load_samples_bin(bin_fname):
+    """
+    Load a binary *.miso_bin file with samples. Return the same
+    fields as load_samples.
+
+    The samples are read into memory rather than memory-mapped:
+    summary and comparison tasks hold the samples of many events
+    at once, and each map would keep a file descriptor open.
+    """
+    try:
+        header, samples, log_scores = \
+            miso_bin.load_samples_bin(bin_fname, mmap=False)
+    except (IOError, ValueError):
+        return None
+    if len(samples) == 0:
+        return None
+    sampled_map_indx = get_sampled_map_index(samples)
+    sampled_map = [float(v) for v in samples[sampled_map_indx]]
+    sampled_map_log_score = log_scores[sampled_map_indx]
+    counts_info = get_counts_from_header(header)
+    return (samples, [header], log_scores, sampled_map,
+            sampled_map_log_score, counts_info)
+
+
+def get_sampled_map_index(samples):
+    """
+    Return the index of the first of the largest samples, comparing
+    samples isoform by isoform (as load_samples compares the samples
+    of *.miso files.)
+    """
+    order = lexsort(samples.T[::-1])
+    largest = samples[order[-1]]
+    return int(nonzero((samples == largest).all(axis=1))[0][0])
 
 
 def parse_sampler_params_from_header(header):
@@ -236,10 +454,13 @@ def get_event_name(miso_filename,
     Now supports compressed event names.
     """
     basename = os.path.basename(miso_filename)
-    if not basename.endswith(".miso"):
+    if miso_bin.is_miso_bin_fname(basename):
+        event_name = basename[0:-1*len(miso_bin.MISO_BIN_EXT)]
+    elif basename.endswith(".miso"):
+        event_name = basename.split(".miso")[0]
+    else:
         # Not a MISO filename
         return None
-    event_name = basename.split(".miso")[0]
     if use_compressed_map is not None:
         if event_name not in use_compressed_map:
             print "MISO FILENAME IS: %s" %(miso_filename)
@@ -260,73 +481,180 @@ def get_event_name(miso_filename,
 #     return event_name
 
 
+# Summary file fields
+SUMMARY_HEADER_FIELDS = ["event_name", "miso_posterior_mean", "ci_low", "ci_high",
+                         "isoforms", "counts", "assigned_counts",
+                         # Fields related to gene/event
+                         "chrom",
+                         "strand",
+                         "mRNA_starts",
+                         "mRNA_ends"]
+
+# Maximum number of events summarized in one task
+SUMMARY_TASK_SIZE = 1000
+
+# Mapping of compressed IDs to event names of the summary
+# worker processes
+summary_compressed_ids_to_genes = None
+summary_samples_obj = None
+
+
 def summarize_sampler_results(samples_dir, summary_filename,
-                              use_compressed=None):
+                              use_compressed=None,
+                              num_proc=1):
     """
     Given a set of samples from MISO, output a summary file.
+
+    Events are summarized in tasks of events from the same
+    chromosome directory or *.miso_db file, on num_proc processes.
+    Events are output sorted by chromosome file and event name,
+    regardless of the number of processes.
     """
     summary_file = open(summary_filename, 'w')
-    header_fields = ["event_name", "miso_posterior_mean", "ci_low", "ci_high",
-                     "isoforms", "counts", "assigned_counts",
-                     # Fields related to gene/event
-                     "chrom",
-                     "strand",
-                     "mRNA_starts",
-                     "mRNA_ends"]
-    summary_header = "%s\n" %("\t".join(header_fields))
+    summary_header = "%s\n" %("\t".join(SUMMARY_HEADER_FIELDS))
     summary_file.write(summary_header)
     print "Loading events from: %s" %(samples_dir)
     print "Writing summary to: %s" %(summary_filename)
     samples_obj = MISOSamples(samples_dir,
                               use_compressed=use_compressed)
     num_events = 0
+    tasks = get_summary_tasks(samples_obj)
+    if num_proc > 1:
+        print "  - Summarizing %d events on %d processes" \
+              %(samples_obj.num_events, num_proc)
+        pool = multiprocessing.Pool(processes=num_proc,
+                                    initializer=init_summary_worker,
+                                    initargs=(samples_obj,))
+        try:
+            # Results come back in the order of the tasks
+            for output_lines in pool.imap(summarize_events, tasks):
+                summary_file.writelines(output_lines)
+                num_events += len(output_lines)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        init_summary_worker(samples_obj)
+        for task in tasks:
+            output_lines = summarize_events(task)
+            summary_file.writelines(output_lines)
+            num_events += len(output_lines)
+    samples_obj.close_dbs()
+    print "  - Summarized a total of %d events." %(num_events)
+    summary_file.close()
+
+
+def get_summary_tasks(samples_obj, task_size=SUMMARY_TASK_SIZE):
+    """
+    Split the events of a samples directory into summary tasks:
+    lists of at most task_size (event name, filename) pairs, whose
+    events are in the same chromosome directory or *.miso_db file.
+    """
+    events_by_group = defaultdict(list)
+    for event_name, event_fname in samples_obj.event_names_to_fnames.iteritems():
+        if miso_db.is_miso_db_fname(event_fname):
+            group = event_fname
+        else:
+            group = os.path.dirname(event_fname)
+        events_by_group[group].append((event_name, event_fname))
+    tasks = []
+    for group in sorted(events_by_group.keys()):
+        group_events = sorted(events_by_group[group])
+        for n in range(0, len(group_events), task_size):
+            tasks.append(group_events[n:n + task_size])
+    return tasks
+
+
+def init_summary_worker(samples_obj):
+    global summary_compressed_ids_to_genes, summary_samples_obj
+    summary_compressed_ids_to_genes = samples_obj.compressed_ids_to_genes
+    summary_samples_obj = samples_obj
 
-    for event_name in samples_obj.all_event_names:
-        samples_results = samples_obj.get_event_samples(event_name)
+
+def summarize_events(events):
+    """
+    Summarize a list of (event name, filename) pairs. Return the
+    summary file lines of the events.
+
+    The credible intervals of events with the same number of samples
+    and isoforms are computed together.
+    """
+    events_results = []
+    events_samples = \
+      load_events_samples(events,
+                          compressed_ids_to_genes=summary_compressed_ids_to_genes,
+                          dbs=summary_samples_obj.get_dbs())
+    for (event_name, event_fname), samples_results in zip(events,
+                                                          events_samples):
         if samples_results is None:
             print "WARNING: Skipping %s" %(event_name)
             # Skip files that could not be parsed
             continue
-        # If we're not given a mapping to compressed IDs, check
-        # that the event IDs do not look compressed
-        if misc_utils.is_compressed_name(event_name) and \
-           (use_compressed is None):
-            print "WARNING: %s looks like a compressed id, but no mapping file " \
-                  "from compressed IDs to event IDs was given! Try: --use-compressed" \
-                  %(event_name)
-        # Load header/parameters information
-        samples = samples_results[0]
-        header = samples_results[1]
-        header = header[0]
-        params = parse_sampler_params_from_header(header)
-        # Get counts information from header
-        counts_info = samples_results[5]
-        shape_len = len(shape(samples))
-        if shape_len < 2:
+        if len(shape(samples_results[0])) < 2:
             print "WARNING: Skipping %s -- mishaped file" %(event_name)
             continue
-        num_samples, num_isoforms = shape(samples)
-        output_fields = format_credible_intervals(event_name, samples)
-
-        # Add isoforms information to output fields
-        isoforms_field = get_isoforms_from_header(header)
-        output_fields.append(isoforms_field)
-
-        # Add counts information to output fields
-        output_fields.append(counts_info['counts'])
-        output_fields.append(counts_info['assigned_counts'])
-
-        gene_info = get_gene_info_from_params(params)
-        output_fields.append(gene_info["chrom"])
-        output_fields.append(gene_info["strand"])
-        output_fields.append(gene_info["mRNA_starts"])
-        output_fields.append(gene_info["mRNA_ends"])
-
-        output_line = "%s\n" %("\t".join(output_fields))
-        summary_file.write(output_line)
-        num_events += 1
-    print "  - Summarized a total of %d events." %(num_events)
-    summary_file.close()
+        events_results.append((event_name, samples_results))
+    events_by_shape = defaultdict(list)
+    for event_num, (event_name, samples_results) in enumerate(events_results):
+        events_by_shape[shape(samples_results[0])].append(event_num)
+    events_intervals = [None] * len(events_results)
+    for event_nums in events_by_shape.itervalues():
+        batch_intervals = \
+          compute_batch_credible_intervals([events_results[n][1][0] \
+                                            for n in event_nums])
+        for n, event_num in enumerate(event_nums):
+            events_intervals[event_num] = [bounds[n] for bounds in batch_intervals]
+    output_lines = []
+    for (event_name, samples_results), intervals in zip(events_results,
+                                                        events_intervals):
+        output_lines.append(summarize_event(event_name, samples_results,
+                                            intervals=intervals))
+    return output_lines
+
+
+def summarize_event(event_name, samples_results, intervals=None):
+    """
+    Return the summary file line of an event, given its samples
+    as loaded by load_samples. Takes the event's posterior means,
+    lower and upper credible interval bounds if they were already
+    computed.
+    """
+    # If we're not given a mapping to compressed IDs, check
+    # that the event IDs do not look compressed
+    if misc_utils.is_compressed_name(event_name) and \
+       (summary_compressed_ids_to_genes is None):
+        print "WARNING: %s looks like a compressed id, but no mapping file " \
+              "from compressed IDs to event IDs was given! Try: --use-compressed" \
+              %(event_name)
+    # Load header/parameters information
+    samples = samples_results[0]
+    header = samples_results[1]
+    header = header[0]
+    params = parse_sampler_params_from_header(header)
+    # Get counts information from header
+    counts_info = samples_results[5]
+    if intervals is None:
+        intervals = compute_batch_credible_intervals(samples)
+    output_fields = format_intervals(event_name, *intervals)
+
+    # Add isoforms information to output fields
+    isoforms_field = get_isoforms_from_header(header)
+    output_fields.append(isoforms_field)
+
+    # Add counts information to output fields
+    output_fields.append(counts_info['counts'])
+    output_fields.append(counts_info['assigned_counts'])
+
+    gene_info = get_gene_info_from_params(params)
+    output_fields.append(gene_info["chrom"])
+    output_fields.append(gene_info["strand"])
+    output_fields.append(gene_info["mRNA_starts"])
+    output_fields.append(gene_info["mRNA_ends"])
+
+    return "%s\n" %("\t".join(output_fields))
 
 
 def is_miso_chrom_dir(dirname):
@@ -342,7 +670,8 @@ def is_miso_chrom_dir(dirname):
         basename == "X" or basename == "Y":
         return True
     # If naming is unclear, check that it contains *.miso files
-    fnames = glob.glob(os.path.join(dirname, "*.miso"))
+    fnames = glob.glob(os.path.join(dirname, "*.miso")) + \
+             glob.glob(os.path.join(dirname, "*%s" %(miso_bin.MISO_BIN_EXT)))
     if len(fnames) >= 1:
         return True
     return False
@@ -396,10 +725,11 @@ def get_samples_dir_filenames(samples_dir):
     filenames = filter(lambda f: not os.path.basename(f).startswith("."),
                        filenames)
 
-    # Resulting files should be either *.miso files
+    # Resulting files should be either *.miso (or *.miso_bin) files
     # or *.miso_db files, but not both
     miso_filenames = \
-      filter(lambda f: os.path.basename(f).endswith(".miso"),
+      filter(lambda f: os.path.basename(f).endswith(".miso") or \
+                       miso_bin.is_miso_bin_fname(f),
              filenames)
     miso_db_filenames = \
       filter(miso_db.is_miso_db_fname,
@@ -25,6 +25,7 @@ import shelve
 
 import misopy
 import misopy.gff_utils as gff_utils
+import misopy.gff_db as gff_db
 import misopy.pe_utils as pe_utils
 from misopy.parse_csv import csv2dictlist_raw
 
@@ -131,17 +132,27 @@ def plot_event(event_name, pickle_dir, settings_filename,
         print "Error: event pickle directory %s not found." %(pickle_dir)
         sys.exit(1)
 
-    # Retrieve the full pickle filename
-    genes_filename = os.path.join(pickle_dir,
-                                  "genes_to_filenames.shelve")
-
-    # Check that file basename exists
-    if len(glob.glob("%s*" %(genes_filename))) == 0:
-        raise Exception, "Cannot find file %s. Are you sure the events " \
-                         "were indexed with the latest version of index_gff.py?" \
-                         %(genes_filename)
-
-    event_to_filenames = shelve.open(genes_filename)
+    # Events indexed into a single database file are all
+    # looked up in that file
+    genes_db_filename = gff_db.get_gff_db_fname(pickle_dir)
+    if genes_db_filename is not None:
+        genes_db = gff_db.GFFIndexDatabase(genes_db_filename)
+        event_to_filenames = {}
+        if genes_db.get_gene(event_name) is not None:
+            event_to_filenames[event_name] = genes_db_filename
+        genes_db.close()
+    else:
+        # Retrieve the full pickle filename
+        genes_filename = os.path.join(pickle_dir,
+                                      "genes_to_filenames.shelve")
+
+        # Check that file basename exists
+        if len(glob.glob("%s*" %(genes_filename))) == 0:
+            raise Exception, "Cannot find file %s. Are you sure the events " \
+                             "were indexed with the latest version of index_gff.py?" \
+                             %(genes_filename)
+
+        event_to_filenames = shelve.open(genes_filename)
     if event_name not in event_to_filenames:
         raise Exception, "Event %s not found in pickled directory %s. " \
               "Are you sure this is the right directory for the event?" \
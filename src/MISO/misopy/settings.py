@@ -64,10 +64,20 @@ class Settings(object):
         Return sampler parameters.
         """
         param_names = ['burn_in', 'lag', 'num_iters']
-        opt_param_names = ['num_chains']
-
-        # Default number of chains is 6
-        sampler_params = {'num_chains': 6}
+        opt_param_names = ['num_chains', 'early_stop', 'max_rhat', 'min_ess',
+                           'batch_events', 'batch_size']
+
+        # Default number of chains is 6. With early_stop, sampling
+        # stops once the R-hat of the samples is at most max_rhat and
+        # their effective sample size is at least min_ess. With
+        # batch_events, two-isoform events are sampled batch_size
+        # events at a time, if the NumPy sampler backend is used
+        sampler_params = {'num_chains': 6,
+                          'early_stop': False,
+                          'max_rhat': 1.05,
+                          'min_ess': 500,
+                          'batch_events': False,
+                          'batch_size': 500}
 
         for name in param_names:
             if name not in cls.global_settings:
@@ -144,6 +154,61 @@ class Settings(object):
         return strandedness
 
 
+    @classmethod
+    def get_sampler_algorithm(cls,
+                              default_algorithm="reassign"):
+        """
+        Get the single-end sampler algorithm: 'reassign' (reassign
+        each read to an isoform) or 'classes' (sample read class
+        counts). Default is 'reassign'.
+        """
+        algorithm = default_algorithm
+        if "sampler_algorithm" in cls.global_settings:
+            algorithm = cls.global_settings["sampler_algorithm"]
+            if algorithm not in ("reassign", "classes"):
+                print "Error: Invalid sampler_algorithm parameter %s" \
+                    %(algorithm)
+                sys.exit(1)
+        return algorithm
+
+
+    @classmethod
+    def get_sampler_backend(cls,
+                            default_backend="auto"):
+        """
+        Get the sampler implementation: 'pysplicing' (C sampler),
+        'numpy' or 'auto' (pysplicing if it is available, otherwise
+        numpy). Default is 'auto'.
+        """
+        backend = default_backend
+        if "sampler_backend" in cls.global_settings:
+            backend = cls.global_settings["sampler_backend"]
+            if backend not in ("auto", "pysplicing", "numpy"):
+                print "Error: Invalid sampler_backend parameter %s" \
+                    %(backend)
+                sys.exit(1)
+        return backend
+
+
+    @classmethod
+    def get_output_format(cls,
+                          default_output_format="miso"):
+        """
+        Get the format to output samples in: 'miso' (a *.miso
+        text file per event), 'miso_bin' (a binary *.miso_bin file
+        per event) or 'miso_db' (a *.miso_db database per chromosome,
+        as made by miso_pack.) Default is 'miso'.
+        """
+        output_format = default_output_format
+        if "output_format" in cls.global_settings:
+            output_format = cls.global_settings["output_format"]
+            if output_format not in ("miso", "miso_bin", "miso_db"):
+                print "Error: Invalid output_format parameter %s" \
+                    %(output_format)
+                sys.exit(1)
+        return output_format
+
+
     @classmethod
     def get_num_processors(cls,
                            default_num_processors=4):
@@ -50,8 +50,12 @@ def main():
     parser.add_option("--use-compressed", dest="use_compressed",
                       nargs=1, default=None,
                       help="Use compressed event IDs. Takes as input a "
-                      "genes_to_filenames.shelve file produced by the "
-                      "index_gff script.")
+                      "compressed_ids_to_genes.txt (or .shelve) file "
+                      "produced by the index_gff script.")
+    parser.add_option("-p", "--num-proc", dest="num_proc",
+                      nargs=1, type="int", default=1,
+                      help="Number of processes to summarize events on. "
+                      "Events are split into tasks by chromosome. Default is 1.")
     (options, args) = parser.parse_args()
 
     greeting()
@@ -90,7 +94,8 @@ def main():
                                         '%s.miso_summary' %(samples_label))
         samples_utils.summarize_sampler_results(samples_dir,
                                             summary_filename,
-                                            use_compressed=use_compressed)
+                                            use_compressed=use_compressed,
+                                            num_proc=options.num_proc)
 
 
 
@@ -1,10 +1,41 @@
 #!/usr/bin/env python
 import os
 import sys
+import shutil
+import shelve
+import resource
+import sqlite3
 import unittest
 
+import numpy as np
 import pysam
+import multiprocessing
+import miso
 import sam_utils
+import reads_utils
+import numpy_sampler
+import miso_sampler
+import miso_bin
+import miso_db
+import misc_utils
+import samples_utils
+import hypothesis_test as ht
+import read_simulator
+from Gene import se_event_to_gene
+
+TEST_DB_HEADER = \
+    "#isoforms=['A','B']\tcounts=(1,0):10\tassigned_counts=0:10\n" \
+    "sampled_psi\tlog_score"
+
+def write_db_event(db_fname_and_event_num):
+    """
+    Write the samples of a test event to a MISO database from a
+    worker of the local pool.
+    """
+    db_fname, n = db_fname_and_event_num
+    db_writer = miso.miso_db.get_miso_db_writer(db_fname)
+    db_writer.add_event("event%d" %(n), TEST_DB_HEADER,
+                        "%.4f,%.4f\t-10.00\n" %(n / 10., 1 - n / 10.))
 
 class TestMISO(unittest.TestCase):
     """
@@ -128,6 +159,776 @@ class TestMISO(unittest.TestCase):
                                              paired_end=pe) == True), \
             "(+, -) must match -target under fr-firststrand."
 
+    def test_a3_paired_reads(self):
+        """
+        Test pairing of multimapped read pairs by mate position.
+        """
+        def make_read(flag, pos, mpos):
+            read = pysam.AlignedRead()
+            read.qname = "multi_read"
+            read.flag = flag
+            read.rname = 0
+            read.pos = pos
+            read.mrnm = 0
+            read.mpos = mpos
+            return read
+        # The same pair aligned to two loci, with a secondary
+        # alignment in between, in position order
+        reads = [make_read(99, 100, 300),
+                 make_read(99, 200, 500),
+                 make_read(99 + 256, 250, 100),
+                 make_read(147, 300, 100),
+                 make_read(147, 500, 200)]
+        pair_stats = {}
+        read_pairs = [read_pair for read_name, read_pair in \
+                      sam_utils.iter_paired_reads(reads,
+                                                  pair_stats=pair_stats)]
+        pair_positions = [(left.pos, right.pos) for left, right in read_pairs]
+        assert (pair_positions == [(100, 300), (200, 500)]), \
+            "Multimapped reads paired incorrectly: %s" %(str(pair_positions))
+        assert (pair_stats["unpaired"] == 0), \
+            "Secondary alignment counted as unpaired."
+
+    def test_a4_sweep_reads(self):
+        """
+        Test that sweeping over a chromosome gives each gene the
+        same reads as fetching the reads of each gene.
+        """
+        print "Testing sweeping over BAM reads..."
+        output_dir = os.path.join(self.tests_output_dir, "sweep-output")
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        bam_fname = os.path.join(output_dir, "sweep.bam")
+        header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+                  "SQ": [{"SN": "chr1", "LN": 10000},
+                         {"SN": "chr2", "LN": 10000}]}
+        random_state = np.random.RandomState(0)
+        # Unspliced and spliced reads, some of them spanning gene
+        # boundaries or skipping over whole genes
+        read_starts = sorted(random_state.randint(0, 2500, 400))
+        bam_out = pysam.AlignmentFile(bam_fname, "wb", header=header)
+        for read_num, read_start in enumerate(read_starts):
+            read = pysam.AlignedSegment()
+            read.query_name = "read%d" %(read_num)
+            read.flag = 0
+            read.reference_id = 0
+            read.reference_start = read_start
+            read.mapping_quality = 50
+            read.cigarstring = ["36M", "10M200N26M",
+                                "18M2000N18M"][read_num % 3]
+            read.query_sequence = "A" * 36
+            bam_out.write(read)
+        bam_out.close()
+        pysam.index(bam_fname)
+        # Overlapping genes, nested genes, a gene without
+        # reads and one on a chromosome without reads
+        genes = [("A", "chr1", 100, 300),
+                 ("B", "chr1", 250, 500),
+                 ("C", "chr1", 480, 600),
+                 ("D", "chr1", 520, 540),
+                 ("E", "chr1", 2000, 2100),
+                 ("F", "chr1", 2305, 2400),
+                 ("G", "chr1", 8000, 8100),
+                 ("H", "chr2", 100, 200)]
+        clusters = \
+            sam_utils.merge_gene_regions([(gene_id, start, end) \
+                                          for gene_id, chrom, start, end \
+                                          in genes if chrom == "chr1"])
+        assert([(start, end) for start, end, cluster_genes in clusters] == \
+               [(100, 600), (2000, 2100), (2305, 2400), (8000, 8100)]), \
+            "Overlapping genes merged incorrectly."
+        bamfile = pysam.Samfile(bam_fname, "rb")
+        swept_reads = dict([(gene_id, [read.qname for read in gene_reads]) \
+                            for gene_id, gene_reads in \
+                            sam_utils.sweep_bam_reads_in_genes(bamfile,
+                                                               genes)])
+        assert(sorted(swept_reads.keys()) == [gene[0] for gene in genes]), \
+            "Sweep did not yield every gene."
+        for gene_id, chrom, start, end in genes:
+            fetched_reads = \
+                [read.qname for read in \
+                 sam_utils.fetch_bam_reads_in_gene(bamfile, chrom,
+                                                   start, end)]
+            assert(swept_reads[gene_id] == fetched_reads), \
+                "Sweep gave gene %s different reads." %(gene_id)
+        assert(len(swept_reads["A"]) > 0 and len(swept_reads["G"]) == 0), \
+            "Unexpected reads in test genes."
+        bamfile.close()
+
+    def test_b_numpy_sampler(self):
+        """
+        Test the NumPy sampler on simulated reads of a
+        two-isoform event.
+        """
+        print "Testing NumPy sampler..."
+        read_len = 36
+        overhang_len = 4
+        true_psi = 0.7
+        num_reads = 1000
+        gene = se_event_to_gene(150, 100, 150, "chr1")
+        eff_lens = numpy_sampler.compute_single_end_lens(gene, read_len,
+                                                         overhang_len)
+        # Reads within the upstream or downstream exon are
+        # compatible with both isoforms
+        num_both = 2 * (150 - read_len + 1)
+        assert(eff_lens[1] == 300 - read_len + 1 - 2 * (overhang_len - 1)), \
+            "Wrong number of read positions in exclusion isoform."
+        # Sample the number of inclusion, exclusion and
+        # common reads
+        random_state = np.random.RandomState(0)
+        psi = np.array([true_psi, 1 - true_psi])
+        class_probs = np.array([psi[0] * (eff_lens[0] - num_both),
+                                psi[1] * (eff_lens[1] - num_both),
+                                psi.sum() * num_both])
+        ni, ne, nb = random_state.multinomial(num_reads,
+                                              class_probs / class_probs.sum())
+        reads = read_simulator.read_counts_to_read_list(ni, ne, nb)
+        read_counts = reads_utils.count_aligned_reads(reads)
+        class_weights = np.array([read_class for read_class, count in read_counts])
+        class_counts = np.array([count for read_class, count in read_counts])
+        psi_samples, log_scores, assigned_counts, num_accepted, num_rejected, \
+            num_iters_run, diagnostics = \
+            numpy_sampler.sample_psi(class_weights, class_counts, eff_lens,
+                                     2000, 500, 10, num_chains=4,
+                                     random_state=random_state)
+        assert(psi_samples.shape == (4 * 150, 2)), \
+            "Wrong number of Psi samples."
+        assert(np.allclose(psi_samples.sum(axis=1), 1)), \
+            "Psi samples must sum to 1."
+        assert(assigned_counts.sum() == num_reads), \
+            "All reads must be assigned to an isoform."
+        assert(abs(psi_samples[:, 0].mean() - true_psi) < 0.05), \
+            "NumPy sampler Psi %.2f far from true Psi %.2f" \
+            %(psi_samples[:, 0].mean(), true_psi)
+        assert(diagnostics[0] < 1.1), \
+            "Chains of NumPy sampler did not converge."
+
+    def make_se_event_reads(self, gene, true_psi, num_reads, random_state,
+                            read_len=36, overhang_len=4):
+        """
+        Simulate the collapsed single-end reads of a two-isoform
+        event made by se_event_to_gene(150, 100, 150, ...): reads
+        in the skipped exon, on the exclusion junction and in the
+        upstream exon.
+        """
+        eff_lens = numpy_sampler.compute_single_end_lens(gene, read_len,
+                                                         overhang_len)
+        num_both = 2 * (150 - read_len + 1)
+        psi = np.array([true_psi, 1 - true_psi])
+        class_probs = np.array([psi[0] * (eff_lens[0] - num_both),
+                                psi[1] * (eff_lens[1] - num_both),
+                                psi.sum() * num_both])
+        ni, ne, nb = random_state.multinomial(num_reads,
+                                              class_probs / class_probs.sum())
+        read_positions = [161] * ni + [129] * ne + [11] * nb
+        read_cigars = ["36M"] * ni + ["20M100N16M"] * ne + ["36M"] * nb
+        return sam_utils.collapse_reads(read_positions, read_cigars)
+
+    def test_b2_batch_sampler(self):
+        """
+        Test that sampling events in a batch gives the same Psi
+        as sampling them one at a time.
+        """
+        print "Testing batches of the NumPy sampler..."
+        read_len = 36
+        overhang_len = 4
+        num_iters, burn_in, lag, num_chains = 2000, 500, 10, 4
+        output_dir = os.path.abspath(os.path.join(self.tests_output_dir,
+                                                  "batch-output"))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        random_state = np.random.RandomState(0)
+        sampler_params = \
+            miso_sampler.get_single_end_sampler_params(2, read_len,
+                                                       overhang_len)
+        sampler = miso_sampler.MISOSampler(sampler_params,
+                                           log_dir=output_dir)
+        events = []
+        events_inputs = []
+        for n, (true_psi, num_reads) in enumerate([(0.2, 500),
+                                                   (0.5, 1000),
+                                                   (0.8, 2000)]):
+            gene = se_event_to_gene(150, 100, 150, "chr1",
+                                    label="event%d" %(n))
+            reads = self.make_se_event_reads(gene, true_psi, num_reads,
+                                             random_state,
+                                             read_len=read_len,
+                                             overhang_len=overhang_len)
+            events.append((reads, gene, os.path.join(output_dir, gene.label)))
+            class_weights, class_counts, reads_data, eff_lens = \
+                sampler.get_numpy_sampler_inputs(reads, gene)
+            events_inputs.append((class_weights, class_counts, eff_lens))
+        batch_results = \
+            numpy_sampler.sample_psi_batch([inputs[0] for inputs in events_inputs],
+                                           [inputs[1] for inputs in events_inputs],
+                                           [inputs[2] for inputs in events_inputs],
+                                           num_iters, burn_in, lag,
+                                           num_chains=num_chains,
+                                           random_state=random_state)
+        sampler.run_sampler_batch(num_iters, events,
+                                  num_chains=num_chains,
+                                  burn_in=burn_in,
+                                  lag=lag)
+        for (reads, gene, output_fname), inputs, results in \
+            zip(events, events_inputs, batch_results):
+            psi_samples = \
+                numpy_sampler.sample_psi(inputs[0], inputs[1], inputs[2],
+                                         num_iters, burn_in, lag,
+                                         num_chains=num_chains,
+                                         random_state=random_state)[0]
+            batch_psi_samples = results[0]
+            assert(batch_psi_samples.shape == psi_samples.shape), \
+                "Batched samples of %s differ in shape." %(gene.label)
+            assert(abs(batch_psi_samples[:, 0].mean() - \
+                       psi_samples[:, 0].mean()) < 0.03), \
+                "Batched Psi of %s differs from its Psi." %(gene.label)
+            # The batch run by the sampler outputs the event's samples
+            output_samples = \
+                samples_utils.load_samples("%s.miso" %(output_fname))[0]
+            assert(abs(output_samples[:, 0].mean() - \
+                       psi_samples[:, 0].mean()) < 0.03), \
+                "Psi of %s output by the batch differs from its Psi." \
+                %(gene.label)
+
+    def test_b3_convergence(self):
+        """
+        Test the convergence diagnostics of the NumPy sampler and
+        stopping sampling early.
+        """
+        print "Testing NumPy sampler convergence diagnostics..."
+        # Split R-hat of two chains that sample different values:
+        # the four half-chains have variance 0.5 and means
+        # 0.5, 2.5, 0.5, 2.5
+        samples = np.array([[0., 1., 0., 1.], [2., 3., 2., 3.]])
+        assert(np.allclose(numpy_sampler.compute_rhat(samples),
+                           np.sqrt((0.25 + 4 / 3.) / 0.5))), \
+            "Wrong R-hat of diverged chains."
+        assert(numpy_sampler.compute_rhat(np.ones((4, 10))) == 1.), \
+            "R-hat of constant chains must be 1."
+        assert(numpy_sampler.compute_rhat(np.ones((4, 3))) == np.inf), \
+            "R-hat of too few samples must be infinite."
+        random_state = np.random.RandomState(0)
+        num_chains, num_samples = 4, 2000
+        # Independent samples: the effective sample size is about
+        # the number of samples
+        iid_samples = random_state.normal(0, 1, (num_chains, num_samples))
+        ess = numpy_sampler.compute_ess(iid_samples)
+        assert(abs(ess / (num_chains * num_samples) - 1) < 0.2), \
+            "ESS %.1f of independent samples is far from %d" \
+            %(ess, num_chains * num_samples)
+        # AR(1) chains with autocorrelation rho have an effective
+        # sample size of about N * (1 - rho) / (1 + rho)
+        rho = 0.9
+        ar_samples = np.zeros((num_chains, num_samples))
+        ar_samples[:, 0] = random_state.normal(0, 1, num_chains)
+        for n in range(1, num_samples):
+            ar_samples[:, n] = rho * ar_samples[:, n - 1] + \
+                random_state.normal(0, np.sqrt(1 - rho ** 2), num_chains)
+        expected_ess = num_chains * num_samples * (1 - rho) / (1 + rho)
+        ess = numpy_sampler.compute_ess(ar_samples)
+        assert(abs(ess / expected_ess - 1) < 0.3), \
+            "ESS %.1f of AR(1) samples is far from %.1f" %(ess, expected_ess)
+        # Sampling a simple event stops once converged, and runs
+        # all iterations when the criteria cannot be met
+        gene = se_event_to_gene(150, 100, 150, "chr1")
+        reads = self.make_se_event_reads(gene, 0.5, 1000, random_state)
+        class_weights, class_counts = \
+            reads_utils.compute_read_classes(gene, reads, 36, 4)
+        eff_lens = numpy_sampler.compute_single_end_lens(gene, 36, 4)
+        num_iters = 20000
+        for max_rhat, stops_early in [(1.1, True), (0.5, False)]:
+            results = \
+                numpy_sampler.sample_psi(class_weights, class_counts, eff_lens,
+                                         num_iters, 500, 10, num_chains=4,
+                                         max_rhat=max_rhat, min_ess=100,
+                                         random_state=random_state)
+            num_iters_run = results[5]
+            assert((num_iters_run < num_iters) == stops_early), \
+                "Ran %d of %d iterations with max_rhat %.1f" \
+                %(num_iters_run, num_iters, max_rhat)
+
+    def test_c_miso_bin(self):
+        """
+        Test converting MISO samples to the binary format and back.
+        """
+        print "Testing binary MISO samples..."
+        output_dir = os.path.join(self.tests_output_dir, "bin-output")
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        miso_fname = os.path.join(output_dir, "event.miso")
+        header = "#isoforms=['A','B']\tcounts=(1,0):10\tassigned_counts=0:10"
+        with open(miso_fname, "w") as miso_file:
+            miso_file.write(header + "\n")
+            miso_file.write("sampled_psi\tlog_score\n")
+            miso_file.write("0.9001,0.0999\t-11565.70\n")
+            miso_file.write("0.8708,0.1292\t-11610.93\n")
+            # Large log scores must print back the same
+            miso_file.write("0.8813,0.1187\t-1234567.89\n")
+        with open(miso_fname) as miso_file:
+            miso_text = miso_file.read()
+        bin_fname = miso_bin.miso_file_to_bin(miso_fname)
+        bin_header, samples, log_scores = miso_bin.load_samples_bin(bin_fname)
+        assert(bin_header == header), "Header of binary samples changed."
+        assert(np.allclose(samples, [[0.9001, 0.0999], [0.8708, 0.1292],
+                                     [0.8813, 0.1187]])), \
+            "Samples changed in binary format."
+        assert(np.allclose(log_scores, [-11565.70, -11610.93, -1234567.89])), \
+            "Log scores changed in binary format."
+        os.remove(miso_fname)
+        miso_bin.bin_to_miso_file(bin_fname)
+        with open(miso_fname) as miso_file:
+            assert(miso_file.read() == miso_text), \
+                "Converting binary samples back to text changed them."
+
+    def test_c1_summarize_miso_bin(self):
+        """
+        Test summarizing more binary events than open files allowed.
+        """
+        print "Testing summary of binary MISO samples..."
+        output_dir = os.path.abspath(os.path.join(self.tests_output_dir,
+                                                  "bin-summary-output"))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        chrom_dir = os.path.join(output_dir, "chr1")
+        os.makedirs(chrom_dir)
+        num_events = 600
+        psi = np.linspace(0.2, 0.8, 100)
+        psi_vectors = np.transpose([psi, 1 - psi])
+        log_scores = -10 - psi
+        for n in range(num_events):
+            miso_bin.write_samples_bin(os.path.join(chrom_dir,
+                                                    "event%d.miso_bin" %(n)),
+                                       TEST_DB_HEADER.split("\n")[0],
+                                       psi_vectors, log_scores)
+        summary_fname = os.path.join(output_dir, "summary.miso_summary")
+        # Allow fewer open files than there are events
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (512, hard_limit))
+        try:
+            samples_utils.summarize_sampler_results(output_dir, summary_fname)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (soft_limit, hard_limit))
+        with open(summary_fname) as summary_file:
+            summary_lines = summary_file.readlines()[1:]
+        assert(len(summary_lines) == num_events), \
+            "Summarized %d of %d binary events." %(len(summary_lines),
+                                                    num_events)
+
+    def test_c3_summarize_pool(self):
+        """
+        Test that summarizing on several processes gives the
+        serial summary, in the same order.
+        """
+        print "Testing summary of MISO samples on several processes..."
+        output_dir = os.path.abspath(os.path.join(self.tests_output_dir,
+                                                  "pool-summary-output"))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        samples_dir = os.path.join(output_dir, "samples")
+        random_state = np.random.RandomState(0)
+        # More events than fit in one summary task
+        num_events = samples_utils.SUMMARY_TASK_SIZE + 100
+        self.write_samples_dir(samples_dir,
+                               ["event%d" %(n) for n in range(num_events)],
+                               random_state, chrom="chr1")
+        self.write_samples_dir(samples_dir,
+                               ["chr2_event%d" %(n) for n in range(20)],
+                               random_state, chrom="chr2")
+        db_writer = miso_db.MISODatabaseWriter(os.path.join(samples_dir,
+                                                            "chr3.miso_db"))
+        for n in range(20):
+            psis = random_state.beta(2, 5, 100)
+            db_writer.add_event("chr3_event%d" %(n), TEST_DB_HEADER,
+                                "".join(["%.4f,%.4f\t-10.00\n" %(psi, 1 - psi) \
+                                         for psi in psis]))
+        db_writer.close()
+        summaries_lines = []
+        for num_proc in [1, 3]:
+            summary_fname = os.path.join(output_dir,
+                                         "summary%d.miso_summary" %(num_proc))
+            samples_utils.summarize_sampler_results(samples_dir, summary_fname,
+                                                    num_proc=num_proc)
+            with open(summary_fname) as summary_file:
+                summaries_lines.append(summary_file.readlines())
+        serial_lines, pool_lines = summaries_lines
+        assert(len(serial_lines) == num_events + 40 + 1), \
+            "Summarized %d of %d events." %(len(serial_lines) - 1,
+                                             num_events + 40)
+        assert(pool_lines == serial_lines), \
+            "Summary on several processes differs from serial summary."
+        # Events are sorted by chromosome file, then by name
+        event_names = [line.split("\t", 1)[0] for line in serial_lines[1:]]
+        expected_names = \
+            sorted(["event%d" %(n) for n in range(num_events)]) + \
+            sorted(["chr2_event%d" %(n) for n in range(20)]) + \
+            sorted(["chr3_event%d" %(n) for n in range(20)])
+        assert(event_names == expected_names), \
+            "Summarized events are not sorted by chromosome and name."
+
+    def test_c2_load_samples(self):
+        """
+        Test loading the samples of *.miso files.
+        """
+        print "Testing loading of MISO samples..."
+        output_dir = os.path.join(self.tests_output_dir, "samples-output")
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        miso_fname = os.path.join(output_dir, "event.miso")
+        with open(miso_fname, "w") as miso_out:
+            miso_out.write("%s\n0.2500,0.7500\t-10.00\n" \
+                           "0.5000,0.5000\t-12.00\n" %(TEST_DB_HEADER))
+        samples = samples_utils.load_samples(miso_fname)
+        assert(np.allclose(samples[0], [[0.25, 0.75], [0.5, 0.5]])), \
+            "Samples loaded from filename differ."
+        assert(np.allclose(samples[2], [-10., -12.])), \
+            "Log scores loaded from filename differ."
+        # Malformed values must not be silently dropped
+        with open(miso_fname, "w") as miso_out:
+            miso_out.write("%s\n0.2500,0.7500\t-10.00\n" \
+                           "x0.5000,0.5000\t-12.00\n" %(TEST_DB_HEADER))
+        assert(samples_utils.load_samples(miso_fname) is None), \
+            "Malformed samples were loaded."
+
+    def test_c4_compressed_ids(self):
+        """
+        Test loading shelved mappings of compressed IDs to genes.
+        """
+        print "Testing loading of compressed IDs..."
+        output_dir = os.path.abspath(os.path.join(self.tests_output_dir,
+                                                  "compressed-ids-output"))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        shelve_fname = os.path.join(output_dir, "compressed_ids.shelve")
+        ids_shelve = shelve.open(shelve_fname)
+        ids_shelve["misocomp1"] = "gene1"
+        ids_shelve.close()
+        compressed_ids_to_genes = \
+            misc_utils.load_compressed_ids_to_genes(shelve_fname)
+        assert(compressed_ids_to_genes["misocomp1"] == "gene1"), \
+            "Compressed ID loaded from shelve differs."
+        compressed_ids_to_genes.close()
+        # A missing shelve is reported rather than created
+        missing_fname = os.path.join(output_dir, "missing.shelve")
+        self.assertRaises(SystemExit,
+                          misc_utils.load_compressed_ids_to_genes,
+                          missing_fname)
+        assert(not any([fname.startswith("missing") \
+                        for fname in os.listdir(output_dir)])), \
+            "Loading a missing shelve created it."
+
+    def test_d_bayes_factors(self):
+        """
+        Test that the vectorized Bayes factors match those of
+        the fitted kernel densities.
+        """
+        print "Testing Bayes factors..."
+        random_state = np.random.RandomState(0)
+        posterior_diffs = \
+            random_state.normal(random_state.uniform(-0.3, 0.3, (50, 1)),
+                                random_state.uniform(0.01, 0.2, (50, 1)),
+                                (50, 1000))
+        # Differences with mean close to zero are peaked at zero
+        posterior_diffs[0] = 0.001
+        bayes_factors, diff_posteriors = \
+            ht.compute_bayes_factors(posterior_diffs, smoothing_param=0.3)
+        for diffs, bayes_factor in zip(posterior_diffs, bayes_factors):
+            if np.mean(np.abs(diffs)) <= .009:
+                density = ht.NullPeakedDensity(diffs)
+            else:
+                density = ht.gaussian_kde_covfact(diffs, 0.3)
+            expected_bayes_factor = ht.compute_bayes_factor(None, density)[0]
+            assert(np.allclose(bayes_factor, expected_bayes_factor,
+                               rtol=1e-8)), \
+                "Bayes factor %s differs from kernel density Bayes factor %s" \
+                %(bayes_factor, expected_bayes_factor)
+
+    def write_samples_dir(self, samples_dir, event_names, random_state,
+                          num_samples=100, chrom="chr1"):
+        """
+        Write a chromosome directory of a samples directory with a
+        *.miso file of random two-isoform samples for each of the
+        given events.
+        """
+        chrom_dir = os.path.join(samples_dir, chrom)
+        os.makedirs(chrom_dir)
+        for event_name in event_names:
+            psis = random_state.beta(random_state.uniform(1, 20),
+                                     random_state.uniform(1, 20),
+                                     num_samples)
+            with open(os.path.join(chrom_dir, "%s.miso" %(event_name)),
+                      "w") as miso_out:
+                miso_out.write("%s\n" %(TEST_DB_HEADER))
+                for psi in psis:
+                    miso_out.write("%.4f,%.4f\t-10.00\n" %(psi, 1 - psi))
+
+    def test_d2_all_pairs(self):
+        """
+        Test that comparing all pairs of samples gives each pair
+        the comparison of that pair alone, and a combined table
+        with the lines of each event kept together.
+        """
+        print "Testing comparisons of all pairs..."
+        output_dir = os.path.abspath(os.path.join(self.tests_output_dir,
+                                                  "all-pairs-output"))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        random_state = np.random.RandomState(0)
+        # Samples share some of their events only
+        samples_events = {"s1": ["event%d" %(n) for n in range(0, 6)],
+                          "s2": ["event%d" %(n) for n in range(0, 5) + [7]],
+                          "s3": ["event%d" %(n) for n in range(2, 9)]}
+        sample_labels = sorted(samples_events.keys())
+        sample_dirs = [os.path.join(output_dir, "samples", sample_label) \
+                       for sample_label in sample_labels]
+        for sample_dir, sample_label in zip(sample_dirs, sample_labels):
+            self.write_samples_dir(sample_dir, samples_events[sample_label],
+                                   random_state)
+        combined_fname = os.path.join(output_dir, "all_pairs.miso_bf")
+        # Compare in several tasks on several processes
+        task_size = ht.COMPARISON_TASK_SIZE
+        ht.COMPARISON_TASK_SIZE = 2
+        try:
+            ht.output_all_pairs_comparisons(sample_dirs,
+                                            os.path.join(output_dir, "all"),
+                                            num_proc=2,
+                                            combined_filename=combined_fname)
+        finally:
+            ht.COMPARISON_TASK_SIZE = task_size
+        # Events of the first sample, then those only in later samples
+        event_order = []
+        for sample_dir in sample_dirs:
+            samples_obj = samples_utils.MISOSamples(sample_dir)
+            event_order.extend([event_name for event_name \
+                                in samples_obj.all_event_names \
+                                if event_name not in event_order])
+        pairs_lines = []
+        for sample1_num in range(len(sample_dirs)):
+            for sample2_num in range(sample1_num + 1, len(sample_dirs)):
+                pair_label = "%s_vs_%s" %(sample_labels[sample1_num],
+                                          sample_labels[sample2_num])
+                pair_output_dir = os.path.join(output_dir, "pair")
+                ht.output_samples_comparison(sample_dirs[sample1_num],
+                                             sample_dirs[sample2_num],
+                                             pair_output_dir)
+                bf_fname = os.path.join(pair_label, "bayes-factors",
+                                        "%s.miso_bf" %(pair_label))
+                with open(os.path.join(pair_output_dir, bf_fname)) as bf_in:
+                    pair_lines = bf_in.readlines()
+                with open(os.path.join(output_dir, "all", bf_fname)) as bf_in:
+                    assert(bf_in.readlines() == pair_lines), \
+                        "Comparison of %s differs from all pairs." \
+                        %(pair_label)
+                num_common_events = \
+                    len(set(samples_events[sample_labels[sample1_num]]) & \
+                        set(samples_events[sample_labels[sample2_num]]))
+                assert(len(pair_lines) == num_common_events + 1), \
+                    "Comparison of %s has %d events, expected %d." \
+                    %(pair_label, len(pair_lines) - 1, num_common_events)
+                pairs_lines.append((sample_labels[sample1_num],
+                                    sample_labels[sample2_num],
+                                    pair_lines))
+        # Combined table holds each pair's lines, grouped by event
+        # and ordered by pair within an event
+        expected_lines = ["sample1\tsample2\t%s" %(pairs_lines[0][2][0])]
+        for event_name in event_order:
+            for sample1_label, sample2_label, pair_lines in pairs_lines:
+                expected_lines.extend(["%s\t%s\t%s" %(sample1_label,
+                                                      sample2_label, line) \
+                                       for line in pair_lines[1:] \
+                                       if line.split("\t", 1)[0] == event_name])
+        with open(combined_fname) as combined_in:
+            combined_lines = combined_in.readlines()
+        assert(len(combined_lines) == \
+               sum([len(pair_lines) - 1 \
+                    for _, _, pair_lines in pairs_lines]) + 1), \
+            "Combined table has %d rows." %(len(combined_lines) - 1)
+        assert(combined_lines == expected_lines), \
+            "Combined table differs from the comparisons of each pair."
+
+    def test_e_miso_db(self):
+        """
+        Test reading MISO samples from a database.
+        """
+        print "Testing MISO databases..."
+        output_dir = os.path.abspath(os.path.join(self.tests_output_dir,
+                                                  "db-output"))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        db_fname = os.path.join(output_dir, "chr1.miso_db")
+        db_writer = miso_db.MISODatabaseWriter(db_fname)
+        event_names = ["event%d" %(n) for n in range(5)]
+        for n, event_name in enumerate(event_names):
+            db_writer.add_event(event_name, TEST_DB_HEADER,
+                                "%.4f,%.4f\t-10.00\n" %(n / 10., 1 - n / 10.))
+        db_writer.close()
+        samples_obj = samples_utils.MISOSamples(output_dir)
+        assert(sorted(samples_obj.all_event_names) == event_names), \
+            "Events of database changed."
+        events_samples = samples_obj.get_events_samples(event_names)
+        iter_samples = dict(samples_obj.iter_event_samples())
+        for n, event_name in enumerate(event_names):
+            samples = samples_obj.get_event_samples(event_name)[0]
+            assert(np.allclose(samples, [[n / 10., 1 - n / 10.]])), \
+                "Samples of %s changed in database." %(event_name)
+            assert(np.allclose(events_samples[event_name][0], samples)), \
+                "Samples of %s fetched together differ." %(event_name)
+            assert(np.allclose(iter_samples[event_name][0], samples)), \
+                "Samples of %s iterated over differ." %(event_name)
+        assert(len(samples_obj.get_dbs()) == 1), \
+            "Database was opened more than once."
+        samples_obj.close_dbs()
+
+    def test_e2_miso_db_pool(self):
+        """
+        Test that a local pool writes every event to the database.
+        """
+        print "Testing MISO databases written by a pool..."
+        output_dir = os.path.abspath(os.path.join(self.tests_output_dir,
+                                                  "db-pool-output"))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        db_fname = os.path.join(output_dir, "chr1.miso_db")
+        num_events = 25
+        # Writers keep their events pending across tasks; they
+        # are written when the workers exit
+        pool = multiprocessing.Pool(processes=2,
+                                    initializer=miso.init_pool_worker,
+                                    initargs=(None, {}, output_dir))
+        pool.map(write_db_event,
+                 [(db_fname, n) for n in range(num_events)],
+                 chunksize=1)
+        pool.close()
+        pool.join()
+        samples_obj = samples_utils.MISOSamples(output_dir)
+        assert(len(samples_obj.all_event_names) == num_events), \
+            "Pool wrote %d of %d events." %(len(samples_obj.all_event_names),
+                                             num_events)
+        samples_obj.close_dbs()
+
+    def test_e3_pack_zlib(self):
+        """
+        Test that directories packed into compressed databases on
+        several processes give back the samples of their *.miso files.
+        """
+        print "Testing packing of MISO directories with compression..."
+        output_dir = os.path.abspath(os.path.join(self.tests_output_dir,
+                                                  "pack-output"))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        random_state = np.random.RandomState(0)
+        chroms = ["chr1", "chr2", "chr3"]
+        for chrom in chroms:
+            self.write_samples_dir(output_dir,
+                                   ["%s_event%d" %(chrom, n) \
+                                    for n in range(30)],
+                                   random_state, chrom=chrom)
+        unpacked_obj = samples_utils.MISOSamples(output_dir)
+        unpacked_samples = \
+            unpacked_obj.get_events_samples(unpacked_obj.all_event_names)
+        dirs_and_db_fnames = \
+            [(os.path.join(output_dir, chrom),
+              os.path.join(output_dir, "%s.miso_db" %(chrom))) \
+             for chrom in chroms]
+        statuses = miso_db.pack_miso_dirs(dirs_and_db_fnames,
+                                          compression="zlib",
+                                          num_proc=2)
+        assert(statuses == [db_fname for chrom_dir, db_fname \
+                            in dirs_and_db_fnames]), \
+            "Packing failed: %s" %(str(statuses))
+        for chrom_dir, db_fname in dirs_and_db_fnames:
+            assert(not os.path.isdir(chrom_dir)), \
+                "Packed directory %s was not removed." %(chrom_dir)
+            packed_db = miso_db.MISODatabase(db_fname)
+            assert(packed_db.compression == "zlib"), \
+                "Compression of %s was not recorded." %(db_fname)
+            packed_db.close()
+        samples_obj = samples_utils.MISOSamples(output_dir)
+        assert(sorted(samples_obj.all_event_names) == \
+               sorted(unpacked_samples.keys())), \
+            "Events of packed databases differ from their directories."
+        packed_samples = \
+            samples_obj.get_events_samples(samples_obj.all_event_names)
+        for event_name, samples_results in unpacked_samples.iteritems():
+            assert(np.array_equal(packed_samples[event_name][0],
+                                  samples_results[0])), \
+                "Samples of %s changed by packing." %(event_name)
+            assert(np.array_equal(packed_samples[event_name][2],
+                                  samples_results[2])), \
+                "Log scores of %s changed by packing." %(event_name)
+        samples_obj.close_dbs()
+
+    def test_e4_migrate_db(self):
+        """
+        Test migrating databases whose event names are not indexed.
+        """
+        print "Testing migration of MISO databases..."
+        output_dir = os.path.abspath(os.path.join(self.tests_output_dir,
+                                                  "migrate-output"))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        def make_unindexed_db(db_fname, event_names):
+            conn = sqlite3.connect(db_fname)
+            table_name = "table_%s" \
+                         %(miso_db.get_table_name_from_file(db_fname))
+            conn.execute("CREATE TABLE %s (event_name text, " \
+                         "psi_vals_and_scores text, header text)" \
+                         %(table_name))
+            conn.executemany("INSERT INTO %s VALUES (?, ?, ?)" %(table_name),
+                             [(event_name,
+                               "%.4f,%.4f\t-10.00\n" %(n / 10., 1 - n / 10.),
+                               TEST_DB_HEADER) \
+                              for n, event_name in enumerate(event_names)])
+            conn.commit()
+            conn.close()
+            return table_name
+        def is_indexed(db_fname, table_name):
+            conn = sqlite3.connect(db_fname)
+            indexed = miso_db.is_event_name_indexed(conn, table_name)
+            conn.close()
+            return indexed
+        db_fname = os.path.join(output_dir, "chr1.miso_db")
+        event_names = ["event%d" %(n) for n in range(5)]
+        table_name = make_unindexed_db(db_fname, event_names)
+        assert(not is_indexed(db_fname, table_name)), \
+            "Event names of old database are indexed."
+        assert(miso_db.migrate_miso_db(db_fname)), \
+            "Old database was not migrated."
+        assert(is_indexed(db_fname, table_name)), \
+            "Event names of migrated database are not indexed."
+        assert(not miso_db.migrate_miso_db(db_fname)), \
+            "Indexed database was migrated again."
+        samples_obj = samples_utils.MISOSamples(output_dir)
+        assert(sorted(samples_obj.all_event_names) == event_names), \
+            "Events of migrated database changed."
+        for n, event_name in enumerate(event_names):
+            samples = samples_obj.get_event_samples(event_name)[0]
+            assert(np.allclose(samples, [[n / 10., 1 - n / 10.]])), \
+                "Samples of %s changed by migration." %(event_name)
+        samples_obj.close_dbs()
+        # A database with more than one entry for an event cannot be
+        # migrated, and is left as it was
+        dup_db_fname = os.path.join(output_dir, "chr2.miso_db")
+        dup_table_name = make_unindexed_db(dup_db_fname,
+                                           ["event0", "event1", "event0"])
+        self.assertRaises(Exception, miso_db.migrate_miso_db, dup_db_fname)
+        conn = sqlite3.connect(dup_db_fname)
+        table_names = [str(row[0]) for row in \
+                       conn.execute("SELECT name FROM sqlite_master " \
+                                    "WHERE type='table'")]
+        num_rows = conn.execute("SELECT COUNT(*) FROM %s" \
+                                %(dup_table_name)).fetchone()[0]
+        conn.close()
+        assert(table_names == [dup_table_name]), \
+            "Failed migration changed the tables: %s" %(str(table_names))
+        assert(num_rows == 3), \
+            "Failed migration changed the events of the database."
+
     def test_z_gene_psi(self):
         """
         Test gene-level Psi inferences using SAM/BAM reads.
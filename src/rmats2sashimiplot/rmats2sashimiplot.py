@@ -253,6 +253,18 @@ def get_python_executable():
     return python_executable
 
 
+def index_gff_command(options, python_executable, path_index_gff,
+                      gff_path, out_index):
+    """
+    the command line calling index_gff.py
+    """
+    command = "{} {} --index {} {}".format(python_executable, path_index_gff,
+                                           gff_path, out_index)
+    if options.index_cache_dir is not None:
+        command += " --cache-dir {}".format(options.index_cache_dir)
+    return command
+
+
 def plot_c(options, id_str):
     """
     the plot part of the coordinate method
@@ -265,8 +277,8 @@ def plot_c(options, id_str):
     python_executable = get_python_executable()
     # call python index_gff.py
     tmp_str = os.path.join(options.sashimi_path, "tmp.gff3")
-    os.system("{} {} --index {} {}".format(python_executable, path_index_gff,
-                                           tmp_str, options.sashimi_path))
+    os.system(index_gff_command(options, python_executable, path_index_gff,
+                                tmp_str, options.sashimi_path))
 
     # call python sashimi_plot.py
     setting_str = os.path.join(options.sashimi_path, "sashimi_plot_settings.txt")
@@ -304,8 +316,8 @@ def plot_e(options, id_str, gene_symbol, events_no):
     # call python index_gff.py
     out_index = os.path.join(options.out_dir, "Sashimi_index_" + gene_symbol + '_' + str(events_no))
     tmp_str = os.path.join(out_index, "tmp.gff3")
-    os.system("{} {} --index {} {}".format(python_executable, path_index_gff,
-                                           tmp_str, out_index))
+    os.system(index_gff_command(options, python_executable, path_index_gff,
+                                tmp_str, out_index))
 
     # call python sashimi_plot.py
     setting_str = os.path.join(out_index, "sashimi_plot_settings.txt")
@@ -839,6 +851,11 @@ def main():
     optional_group.add_argument(
         "--no-text-background", dest="text_background", action="store_false",
         help='Do not put a white box behind the junction read count')
+    optional_group.add_argument(
+        "--index-cache-dir", dest="index_cache_dir",
+        help=('A directory of previously indexed annotations, which can be'
+              ' shared between runs. Annotations already indexed there'
+              ' are reused instead of being indexed again'))
 
     options = parser.parse_args()
     out_path = os.path.abspath(os.path.expanduser(options.out_dir))
@@ -848,6 +865,9 @@ def main():
     if not os.path.isdir(sashimi_path):
         os.makedirs(sashimi_path)
     options.out_dir = out_path
+    if options.index_cache_dir is not None:
+        options.index_cache_dir = os.path.abspath(
+            os.path.expanduser(options.index_cache_dir))
     options.sashimi_path = sashimi_path
 
     convert_sam2bam(options)  # 1.convert sam to bam format